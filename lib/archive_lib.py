@@ -0,0 +1,552 @@
+#
+# This library packs many files into one encrypted archive.  A tree of
+# small files becomes a single file on disk instead of one encrypted file
+# per source, which is kinder to the file system's metadata and much
+# faster to copy.  Every member is encrypted and authenticated on its own,
+# and an encrypted index (table of contents) locates them, so a member is
+# listed and extracted without reading the rest of the archive.
+#
+# File layout (all integers are big-endian):
+#    ARCHIVE := HEADER MEMBER* INDEX TRAILER (MEMBER* INDEX TRAILER)*
+#    HEADER  := MAGIC(4) VERSION(1) CIPHER(1) FLAGS(1) COMPRESSION(1)
+#               CHUNK_SIZE(4) ARCHIVE_ID(16) KEY_ID(8)
+#    MEMBER  := FRAME+
+#    FRAME   := LENGTH(4) TOKEN(LENGTH)
+#    INDEX   := TOKEN
+#    TRAILER := INDEX_OFFSET(8) INDEX_LENGTH(4) MAGIC(4)
+#
+#    The header is the one of stream_lib.py with its own MAGIC, and every
+#    TOKEN is a raw stream_lib frame, BINDING(16) SEQUENCE(8) FRAME_FLAGS(1)
+#    DATA, sealed with the cipher and compression the header names.  The
+#    BINDING ties it to the random ARCHIVE_ID.  A member is its file cut in
+#    CHUNK_SIZE frames with SEQUENCE = NUMBER << FRAME_BITS | FRAME, NUMBER
+#    unique in the archive, and FRAME_FINAL on its last frame, so frames can
+#    not be moved between members or archives, reordered or dropped.
+#
+#    The INDEX holds Json, {"version", "next", "members": {NAME: {"number",
+#    "offset", "length", "frames", "size", "mtime_ns", "mode"}}}, with
+#    FRAME_INDEX in FRAME_FLAGS and its own offset as SEQUENCE.  Names and
+#    sizes of the members are only found in the encrypted index.
+#
+# Opening an archive reads the trailer at its end and decrypts the index.
+# Extracting a member is then one positioned read of its frames and one
+# decrypt per frame, a single decrypt for files up to CHUNK_SIZE.  The
+# positioned reads are os.pread(); where there is none (Windows) a seek
+# and a read under a lock stand in, so threads reading one archive take
+# turns there.  Extracted files get the permission bits of their member,
+# never setuid, setgid or sticky (as tar does for other users than root).
+#
+# Appending writes the new members after the last trailer, then a new index
+# of all members and a new trailer; nothing before them is rewritten, the
+# old index is left as dead bytes.  A member added under a name already in
+# the archive replaces it, like tar -r.  An append cut short by a crash
+# leaves a tail without a trailer: readers go back to the last complete
+# trailer and the next append cuts the tail off.
+#
+# Packing reads and encrypts the frames on jobs workers, every task being
+# one chunk of one file that the worker reads itself, so memory stays at
+# about 2 * jobs chunks whatever the file sizes.  Unpacking extracts whole
+# members on jobs workers, each reading the archive with its own positioned
+# reads.  Results are reported per file like batch_lib.py does.
+#
+# Function Prototypes:
+#    create_archive(crypto_key, archive_file, chunk_size=DEFAULT_CHUNK_SIZE, cipher="fernet", compression=None,
+#                   durability=None)
+#    Archive(archive_file, crypto_key)
+#       .names()   .members()   .info(name)   .iter_member(name)   .read(name)
+#       .extract(name, output_file, durability=None)   .close()
+#    pack_files(crypto_key, archive_file, sources, chunk_size=DEFAULT_CHUNK_SIZE, cipher="fernet", compression=None,
+#               jobs=1, executor="process", durability=None)
+#    unpack_files(crypto_key, archive_file, output_dir, names=None, jobs=1, executor="process", durability=None)
+#
+# The unit tests are in test_archive_lib.py, run them with pytest.
+
+import os
+import json
+import mmap
+import struct
+import threading
+import atomic_lib
+import batch_lib
+import cipher_lib
+import compress_lib
+import stream_lib
+from cryptography.fernet import InvalidToken
+
+MAGIC          = b"\x89HWA"
+FORMAT_VERSION = 1
+INDEX_VERSION  = 1
+FRAME_INDEX    = 0x80            # Frame flag: the token holds the index
+FRAME_BITS     = 24              # Low SEQUENCE bits that count the frames of a member
+MAX_FRAMES     = 1 << FRAME_BITS
+MAX_INDEX_SIZE = 1 << 32         # Json bytes a compressed index may expand to
+MAX_BATCH      = 256             # Members or frames per pool task at most
+
+_HEADER  = struct.Struct(">4sBBBBI16s8s")
+_TRAILER = struct.Struct(">QI4s")
+_LENGTH  = struct.Struct(">I")
+
+_ARCHIVES = {}  # Per process cache of open archives, see _cached_archive()
+
+# ----------------------------------------------------------------------------- _pack_header()
+def _pack_header(crypto_key, chunk_size, cipher, compression):
+   """ Builds a new archive header with a random archive id. """
+   if not 0 < chunk_size <= stream_lib.MAX_CHUNK_SIZE:
+      raise ValueError(f"Chunk size must be between 1 and {stream_lib.MAX_CHUNK_SIZE} bytes")
+   return _HEADER.pack(MAGIC, FORMAT_VERSION, cipher, stream_lib.FLAG_BINARY, compression,
+                       chunk_size, os.urandom(16), stream_lib.key_id(crypto_key))
+
+# ----------------------------------------------------------------------------- _unpack_header()
+def _unpack_header(header, crypto_key, archive_file):
+   """ Validates an archive header and returns a dictionary of its fields. """
+   if len(header) != _HEADER.size or not header.startswith(MAGIC):
+      raise ValueError(f"{archive_file} is not an encrypted archive")
+   magic, version, cipher, flags, compression, chunk_size, archive_id, kid = _HEADER.unpack(header)
+   if version != FORMAT_VERSION: raise ValueError(f"Unsupported archive format version {version}")
+   if cipher not in cipher_lib.CIPHERS.values(): raise ValueError(f"Unsupported cipher id {cipher}")
+   if compression not in compress_lib.COMPRESSIONS.values(): raise ValueError(f"Unsupported compression id {compression}")
+   if not 0 < chunk_size <= stream_lib.MAX_CHUNK_SIZE: raise ValueError(f"Invalid chunk size {chunk_size}")
+   if kid != stream_lib.key_id(crypto_key): raise ValueError(f"{archive_file} was encrypted with a different key")
+   return {"cipher": cipher, "compression": compression, "chunk_size": chunk_size, "archive_id": archive_id,
+           "binding": stream_lib._binding(header),
+           "max_token": stream_lib._max_token_length(chunk_size, True, cipher)}
+
+# ----------------------------------------------------------------------------- _open_header()
+def _open_header(in_file, crypto_key, archive_file):
+   """ Reads the header of an open archive and returns (the key of a key
+       ring it was written with, its header fields). """
+   in_file.seek(0)
+   header = stream_lib._read_full(in_file, _HEADER.size)
+   if len(header) == _HEADER.size: crypto_key = stream_lib._header_key(crypto_key, header)
+   else:                           crypto_key = stream_lib._key_ring(crypto_key)[0]
+   return crypto_key, _unpack_header(header, crypto_key, archive_file)
+
+# ----------------------------------------------------------------------------- _read_trailer()
+def _read_trailer(in_file, crypto_key, info, end, archive_file):
+   """ Returns the index of the trailer that ends at offset end, or None
+       if there is no trailer there.  Raises ValueError if there is one
+       but its index does not decrypt. """
+   if end < _HEADER.size + _TRAILER.size: return None
+   in_file.seek(end - _TRAILER.size)
+   offset, length, magic = _TRAILER.unpack(stream_lib._read_full(in_file, _TRAILER.size))
+   if magic != MAGIC or offset < _HEADER.size or offset + length + _TRAILER.size != end: return None
+   in_file.seek(offset)
+   token = stream_lib._read_full(in_file, length)
+   try:
+      binding, sequence, flags, data = stream_lib._open_frame(crypto_key, token, True, info["cipher"],
+                                                              info["compression"], MAX_INDEX_SIZE)
+   except (InvalidToken, ValueError):
+      raise ValueError(f"The index of {archive_file} is damaged")
+   if binding != info["binding"] or sequence != offset or not flags & FRAME_INDEX:
+      raise ValueError(f"The index of {archive_file} does not belong to it")
+   index = json.loads(data)
+   if index.get("version") != INDEX_VERSION: raise ValueError(f"Unsupported index version in {archive_file}")
+   return index
+
+# ----------------------------------------------------------------------------- _read_index()
+def _read_index(in_file, crypto_key, info, archive_file):
+   """ Returns (index, end) of the last complete index of an open archive,
+       end being the offset just past its trailer, where appends go.  That
+       is the end of the file unless an append was cut short, then the
+       trailer before the torn tail is searched for backwards. """
+   size  = os.fstat(in_file.fileno()).st_size
+   index = _read_trailer(in_file, crypto_key, info, size, archive_file)
+   if index is not None: return index, size
+   if size > _HEADER.size:
+      with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+         position = view.rfind(MAGIC, _HEADER.size)
+         while position >= 0:
+            end   = position + len(MAGIC)
+            index = _read_trailer(in_file, crypto_key, info, end, archive_file)
+            if index is not None: return index, end
+            position = view.rfind(MAGIC, _HEADER.size, end - 1)
+   raise ValueError(f"{archive_file} is damaged, no complete index found")
+
+# ----------------------------------------------------------------------------- _write_index()
+def _write_index(out_file, crypto_key, info, index, level=None, durability=None):
+   """ Appends index and its trailer at the current position of out_file.
+       Unless durability is "none" everything before the trailer is
+       fsync'd first, so a trailer never points at data not on disk. """
+   durability = atomic_lib.check_durability(durability)
+   offset = out_file.tell()
+   token  = stream_lib._seal_frame(crypto_key, info["binding"], offset, FRAME_INDEX, json.dumps(index).encode(),
+                                   True, info["cipher"], info["compression"], level)
+   out_file.write(token)
+   out_file.flush()
+   if durability != atomic_lib.DURABILITY_NONE: os.fsync(out_file.fileno())
+   out_file.write(_TRAILER.pack(offset, len(token), MAGIC))
+   out_file.flush()
+   if durability != atomic_lib.DURABILITY_NONE: os.fsync(out_file.fileno())
+
+# ----------------------------------------------------------------------------- create_archive()
+def create_archive(crypto_key, archive_file, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE, cipher="fernet",
+                   compression=None, durability=None):
+   """ Creates an empty archive, atomically with durability (see
+       atomic_lib).  cipher and compression work as in stream_lib and hold
+       for every member ever added.  crypto_key may be a key ring, the
+       primary key encrypts. """
+   crypto_key = stream_lib._key_ring(crypto_key)[0]
+   compression, level = compress_lib.parse_compression(compression)
+   header = _pack_header(crypto_key, chunk_size, cipher_lib.cipher_id(cipher), compression)
+   info   = _unpack_header(header, crypto_key, archive_file)
+   with atomic_lib.atomic_write(archive_file, durability=durability) as out_file:
+      out_file.write(header)
+      _write_index(out_file, crypto_key, info, {"version": INDEX_VERSION, "next": 1, "members": {}}, level,
+                   atomic_lib.DURABILITY_NONE)
+
+# ----------------------------------------------------------------------------- _member_name()
+def _member_name(source_file):
+   """ Returns the name a source file is stored under: its path with '/'
+       separators and without a leading '/' or '..' parts, like tar does. """
+   parts = [part for part in os.path.normpath(source_file).replace(os.sep, "/").split("/") if part not in ("", ".", "..")]
+   if not parts: raise ValueError(f"No member name for {source_file}")
+   return "/".join(parts)
+
+# ----------------------------------------------------------------------------- _output_path()
+def _output_path(output_dir, name):
+   """ Returns where member name is extracted to below output_dir.
+       Raises ValueError for names that would land outside of it. """
+   parts = name.split("/")
+   if any(part in ("", ".", "..") for part in parts) or "\\" in name:
+      raise ValueError(f"Unsafe member name {name}, not extracted")
+   return os.path.join(output_dir, *parts)
+
+# ----------------------------------------------------------------------------- _pread()
+def _pread(in_file, lock, size, offset):
+   """ Reads up to size bytes of in_file at offset without using its file
+       position, or, without os.pread(), seeking under lock. """
+   if hasattr(os, "pread"): return os.pread(in_file.fileno(), size, offset)
+   with lock:
+      in_file.seek(offset)
+      return in_file.read(size)
+
+# ----------------------------------------------------------------------------- class Archive
+class Archive:
+   """ An open archive for listing and extracting members.  The index is
+       read once, when it is opened; a member is then read with one
+       positioned read and one decrypt per frame.  Reads do not share a
+       file position, so threads may extract members at the same time.
+       crypto_key may be a key ring.  Use as a context manager or call
+       close() when done. """
+
+   def __init__(self, archive_file, crypto_key):
+      self.archive_file = archive_file
+      self._lock = threading.Lock()
+      self._file = open(archive_file, 'rb')
+      try:
+         self._key, self._info = _open_header(self._file, crypto_key, archive_file)
+         index, _ = _read_index(self._file, self._key, self._info, archive_file)
+      except BaseException:
+         self._file.close()
+         raise
+      self._members = index["members"]
+
+   # --- Context manager support
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      self.close()
+
+   def __contains__(self, name):
+      return name in self._members
+
+   def __len__(self):
+      return len(self._members)
+
+   def names(self):
+      """ Returns the member names, in the order they were added. """
+      return list(self._members)
+
+   def info(self, name):
+      """ Returns {"name", "size", "mtime_ns", "mode"} of a member.
+          Raises KeyError if there is no member name. """
+      entry = self._members[name]
+      return {"name": name, "size": entry["size"], "mtime_ns": entry["mtime_ns"], "mode": entry["mode"]}
+
+   def members(self):
+      """ Returns info() of every member, in the order they were added.
+          Nothing but the index is decrypted. """
+      return [self.info(name) for name in self._members]
+
+   def iter_member(self, name):
+      """ Generator of the clear text of member name, a chunk at a time.
+          Raises KeyError if there is no such member and ValueError if it
+          is damaged or was tampered with. """
+      entry  = self._members[name]
+      info   = self._info
+      offset, remaining, frames = entry["offset"], entry["length"], entry["frames"]
+      size   = 0
+      for frame in range(frames):
+         # One read gets the length and the whole token, for a member of
+         # one frame that is exactly the member.
+         data = _pread(self._file, self._lock, min(remaining, _LENGTH.size + info["max_token"]), offset)
+         if len(data) < _LENGTH.size: raise ValueError(f"Member {name} is truncated")
+         (token_length,) = _LENGTH.unpack_from(data)
+         if token_length > info["max_token"] or _LENGTH.size + token_length > len(data):
+            raise ValueError(f"Member {name} is damaged")
+         try:
+            binding, sequence, flags, chunk = stream_lib._open_frame(self._key, memoryview(data)[_LENGTH.size:_LENGTH.size + token_length],
+                                                                     True, info["cipher"], info["compression"], info["chunk_size"])
+         except InvalidToken:
+            raise ValueError(f"Member {name} is damaged or was tampered with")
+         if binding != info["binding"] or sequence != entry["number"] << FRAME_BITS | frame or \
+            bool(flags & stream_lib.FRAME_FINAL) != (frame == frames - 1) or flags & FRAME_INDEX:
+            raise ValueError(f"Member {name} is damaged or was tampered with")
+         offset    += _LENGTH.size + token_length
+         remaining -= _LENGTH.size + token_length
+         size      += len(chunk)
+         yield chunk
+      if size != entry["size"] or remaining != 0: raise ValueError(f"Member {name} is damaged")
+
+   def read(self, name):
+      """ Returns the clear text of member name as bytes. """
+      return b"".join(self.iter_member(name))
+
+   def extract(self, name, output_file, durability=None):
+      """ Writes member name to output_file, atomically with durability
+          (see atomic_lib), and gives it the member's permission bits,
+          without setuid, setgid and sticky, and mtime.
+          Returns the number of bytes written. """
+      entry = self._members[name]
+      total = 0
+      with atomic_lib.atomic_write(output_file, durability=durability) as out_file:
+         for chunk in self.iter_member(name):
+            out_file.write(chunk)
+            total += len(chunk)
+      os.chmod(output_file, entry["mode"] & 0o777)
+      os.utime(output_file, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+      return total
+
+   def close(self):
+      """ Closes the archive. """
+      self._file.close()
+
+# ----------------------------------------------------------------------------- _cached_archive()
+def _cached_archive(crypto_key, archive_file):
+   """ Returns an open Archive for archive_file, kept per process until the
+       file changes, so that workers read the index once and not once per
+       member.  Workers forked after the caller opened it inherit it. """
+   stat      = os.stat(archive_file)
+   signature = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+   cache_key = (os.path.abspath(archive_file), stream_lib._key_ring(crypto_key))
+   cached    = _ARCHIVES.get(cache_key)
+   if cached is None or cached[0] != signature:
+      if cached is not None: cached[1].close()
+      cached = _ARCHIVES[cache_key] = (signature, Archive(archive_file, crypto_key))
+   return cached[1]
+
+# ----------------------------------------------------------------------------- _seal_chunks()
+def _seal_chunks(crypto_key, binding, chunk_size, cipher, compression, level, frames):
+   """ Reads and seals a batch of member frames, given as (sequence, final,
+       source_file, position), on a pack worker.  Returns a list with
+       (token, clear text bytes, None) per frame, or (None, 0, exception)
+       so that an unreadable file does not stop the pack. """
+   sealed = []
+   for sequence, final, source_file, position in frames:
+      try:
+         with open(source_file, 'rb') as in_file:
+            in_file.seek(position)
+            chunk = stream_lib._read_full(in_file, chunk_size)
+         flags = stream_lib.FRAME_FINAL if final else 0
+         sealed.append((stream_lib._seal_frame(crypto_key, binding, sequence, flags, chunk, True, cipher, compression, level),
+                        len(chunk), None))
+      except Exception as e:
+         sealed.append((None, 0, e))
+   return sealed
+
+# ----------------------------------------------------------------------------- _plan_members()
+def _plan_members(sources, index, chunk_size):
+   """ Returns (source_file, name, stat, number, frames) for every file
+       named by sources (see batch_lib.expand_sources), numbering the
+       members from index["next"].  Missing files get stat None. """
+   plan = []
+   for source_file in batch_lib.expand_sources(sources, True, None):
+      try:
+         stat = os.stat(source_file) if os.path.isfile(source_file) else None
+      except OSError:
+         stat = None
+      if stat is None:
+         plan.append((source_file, None, None, 0, 0))
+         continue
+      frames = max(1, -(-stat.st_size // chunk_size))
+      plan.append((source_file, _member_name(source_file), stat, index["next"], frames))
+      index["next"] += 1
+   return plan
+
+# ----------------------------------------------------------------------------- _chunk_tasks()
+def _chunk_tasks(crypto_key, info, plan, level):
+   """ Generator of _seal_chunks() arguments for every frame of the plan.
+       Frames of small files are batched up to a chunk of clear text per
+       task, so tiny files do not cost a pool round trip each. """
+   chunk_size = info["chunk_size"]
+   batch, batched = [], 0
+   for source_file, name, stat, number, frames in plan:
+      if stat is None or frames > MAX_FRAMES: continue
+      for frame in range(frames):
+         batch.append((number << FRAME_BITS | frame, frame == frames - 1, source_file, frame * chunk_size))
+         batched += min(chunk_size, stat.st_size - frame * chunk_size)
+         if batched >= chunk_size or len(batch) >= MAX_BATCH:
+            yield (crypto_key, info["binding"], chunk_size, info["cipher"], info["compression"], level, batch)
+            batch, batched = [], 0
+   if batch: yield (crypto_key, info["binding"], chunk_size, info["cipher"], info["compression"], level, batch)
+
+# ----------------------------------------------------------------------------- pack_files()
+def pack_files(crypto_key, archive_file, sources, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE, cipher="fernet",
+               compression=None, jobs=1, executor="process", durability=None):
+   """ Generator that adds every file named by sources (files, directories
+       and glob patterns, see batch_lib.expand_sources) to archive_file,
+       creating it if need be, and yields one result dictionary per file,
+       like batch_lib.process_file(), with the member name as output and
+       'added' or 'replaced' as action.  Frames are read and encrypted on
+       jobs workers.  The new index is written when all files are done,
+       or the generator is closed; should anything else stop it the
+       archive is cut back to what it was.  An existing archive keeps its
+       chunk size, cipher and compression.  crypto_key may be a key ring,
+       an existing archive is added to under the key it was written with.
+       Raises ValueError if the archive can not be read with the keys. """
+   durability = atomic_lib.check_durability(durability)
+   if not os.path.exists(archive_file):
+      create_archive(crypto_key, archive_file, chunk_size, cipher, compression, durability)
+   wanted, level = compress_lib.parse_compression(compression)
+   with open(archive_file, 'r+b') as out_file:
+      crypto_key, info = _open_header(out_file, crypto_key, archive_file)
+      index, end = _read_index(out_file, crypto_key, info, archive_file)
+      if wanted != info["compression"]: level = None  # The archive's own, at the default level
+      out_file.seek(end)
+      out_file.truncate()  # A torn tail of an earlier append
+      members  = index["members"]
+      plan     = _plan_members(sources, index, info["chunk_size"])
+      batches  = stream_lib.ordered_map(_seal_chunks, _chunk_tasks(crypto_key, info, plan, level), jobs, executor)
+      tokens   = (sealed for batch in batches for sealed in batch)
+      added    = 0
+      complete = False
+      try:
+         for source_file, member, stat, number, frames in plan:
+            result = {"source": source_file, "output": member, "status": batch_lib.STATUS_OK, "error": "", "action": ""}
+            if stat is None:
+               result["status"] = batch_lib.STATUS_MISSING
+               result["error"]  = f"Unable to locate source file {source_file}"
+               yield result
+               continue
+            if frames > MAX_FRAMES:
+               result["status"] = batch_lib.STATUS_READ
+               result["error"]  = f"{source_file} is too large for the chunk size of the archive"
+               yield result
+               continue
+            start = out_file.tell()
+            size  = 0
+            error = None
+            for _ in range(frames):
+               token, length, e = next(tokens)
+               if error is None and e is not None: error = e
+               if error is not None: continue
+               out_file.write(_LENGTH.pack(len(token)))
+               out_file.write(token)
+               size += length
+            if error is not None:
+               out_file.seek(start)
+               out_file.truncate()
+               batch_lib.record_error(result, error, True)
+            else:
+               result["action"] = "replaced" if member in members else "added"
+               members.pop(member, None)  # A replaced member moves to the end
+               members[member] = {"number": number, "offset": start, "length": out_file.tell() - start,
+                                  "frames": frames, "size": size, "mtime_ns": stat.st_mtime_ns, "mode": stat.st_mode}
+               added += 1
+            yield result
+         complete = True
+      except GeneratorExit:
+         complete = True
+         raise
+      finally:
+         batches.close()
+         if complete and added:
+            _write_index(out_file, crypto_key, info, index, level, durability)
+         else:
+            out_file.seek(end)
+            out_file.truncate()
+
+# ----------------------------------------------------------------------------- _extract_member()
+def _extract_member(crypto_key, archive_file, name, output_dir, durability=None):
+   """ Extracts one member below output_dir, on an unpack worker, and
+       returns a result dictionary like batch_lib.process_file().  Never
+       raises.  Existing files, or links, are never overwritten, and
+       nothing is written outside output_dir through a link. """
+   result = {"source": name, "output": "", "status": batch_lib.STATUS_OK, "error": ""}
+   try:
+      archive = _cached_archive(crypto_key, archive_file)
+      if name not in archive:
+         result["status"] = batch_lib.STATUS_MISSING
+         raise ValueError(f"No member {name} in {archive_file}")
+      result["status"] = batch_lib.STATUS_WRITE
+      output_file = result["output"] = _output_path(output_dir, name)
+      if os.path.lexists(output_file): raise ValueError(f"Output file {output_file} exists, not overwriting it")
+      # A symbolic link on the way, planted or not, must not take the
+      # member out of output_dir
+      root = os.path.realpath(output_dir)
+      if os.path.commonpath([root, os.path.realpath(output_file)]) != root:
+         raise ValueError(f"Output file {output_file} leads out of {output_dir}, not extracted")
+      result["status"] = batch_lib.STATUS_OK
+      os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+      archive.extract(name, output_file, durability)
+   except Exception as e:
+      batch_lib.record_error(result, e, False)
+   return result
+
+# ----------------------------------------------------------------------------- _extract_members()
+def _extract_members(crypto_key, archive_file, names, output_dir, durability=None):
+   """ Runs _extract_member() for a batch of names, on an unpack worker,
+       and returns the list of their results. """
+   return [_extract_member(crypto_key, archive_file, name, output_dir, durability) for name in names]
+
+# ----------------------------------------------------------------------------- _name_batches()
+def _name_batches(archive, names, chunk_size):
+   """ Generator of lists of names, cut where the members add up to a
+       chunk of clear text, so small members share a pool task. """
+   batch, batched = [], 0
+   for name in names:
+      batch.append(name)
+      batched += archive.info(name)["size"] if name in archive else 0
+      if batched >= chunk_size or len(batch) >= MAX_BATCH:
+         yield batch
+         batch, batched = [], 0
+   if batch: yield batch
+
+# ----------------------------------------------------------------------------- _select()
+def _select(archive, names):
+   """ Generator of the members names selects: every member for None, a
+       name that is not a member picks the members below it as a folder. """
+   if names is None:
+      yield from archive.names()
+      return
+   for name in names:
+      prefix = name.rstrip("/") + "/"
+      below  = [] if name in archive else [member for member in archive.names() if member.startswith(prefix)]
+      if below: yield from below
+      else:     yield name
+
+# ----------------------------------------------------------------------------- unpack_files()
+def unpack_files(crypto_key, archive_file, output_dir, names=None, jobs=1, executor="process", durability=None):
+   """ Generator that extracts the members names selects (all of them for
+       None, see _select) below output_dir on jobs workers and yields one
+       result dictionary per member, in order, like batch_lib.process_file()
+       with the member name as source.  Names that are not in the archive
+       are reported missing; names that would land outside output_dir,
+       and existing files, are not written.  With durability "dir" the
+       output directories are fsync'd together at the end.  Raises
+       ValueError if the archive can not be read with crypto_key. """
+   group     = atomic_lib.GroupCommit(durability)
+   archive   = _cached_archive(crypto_key, archive_file)  # Opened before the workers fork, so they share it
+   cache_key = (os.path.abspath(archive_file), stream_lib._key_ring(crypto_key))
+   tasks     = ((crypto_key, archive_file, batch, output_dir, group.write_durability)
+                for batch in _name_batches(archive, _select(archive, names), archive._info["chunk_size"]))
+   try:
+      for results in stream_lib.ordered_map(_extract_members, tasks, jobs, executor):
+         for result in results:
+            if result["status"] == batch_lib.STATUS_OK: group.add(os.path.dirname(os.path.realpath(result["output"])))
+            yield result
+   finally:
+      group.commit()
+      cached = _ARCHIVES.pop(cache_key, None)
+      if cached is not None: cached[1].close()
@@ -0,0 +1,175 @@
+#
+# This library writes files atomically.  The data goes to a temporary file
+# in the same directory, which is flushed, fsync'd and only then renamed
+# over the target with os.replace().  Readers see either the old file or the
+# new one, never a partial one, and a crash or an exception part way leaves
+# the target untouched (at worst a stray temporary file behind).
+#
+# How much survives a power loss is the durability level:
+#    none  Atomic rename only; the OS writes the data back when it likes,
+#          so after a crash the file may be the old one or even empty.
+#    file  The data is fsync'd before the rename, so the file is never
+#          empty or partial, but the rename itself may be lost.
+#    dir   The directory is fsync'd after the rename too, so once the
+#          write returns the new file is on disk.  The default.
+#
+# Writing many files, one directory fsync per file is most of the cost.
+# Inside a group_commit() block the directory fsyncs are collected and done
+# once per directory when the block ends (or commit() is called); files
+# reach "dir" durability then, not file by file.  Work done in other
+# processes, or in generators that can not hold the block open across
+# their yields, uses a GroupCommit directly: the writes use its
+# write_durability and their directories are noted with add().
+#
+# Writes go through a BUFFER_SIZE buffer, so writers that produce many
+# small pieces still reach the disk in large writes.
+#
+# A replaced file keeps its permissions; a new file gets the permissions
+# open() would give it, 0666 less the umask, not the 0600 of the
+# temporary file.  A symbolic link is followed: the file it points to is
+# replaced, in its own directory, and the link stays a link.
+#
+# Function Prototypes:
+#    temp_name(file_name)
+#    check_durability(durability)
+#    atomic_write(file_name, mode='wb', durability=None, guard=None)
+#    class GroupCommit(durability=None)
+#    group_commit(durability=None)
+#
+# The unit tests are in test_atomic_lib.py, run them with pytest.
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import contextlib
+import contextvars
+
+TEMP_SUFFIX        = ".tmp"
+DURABILITY_NONE    = "none"
+DURABILITY_FILE    = "file"
+DURABILITY_DIR     = "dir"
+DURABILITIES       = (DURABILITY_NONE, DURABILITY_FILE, DURABILITY_DIR)
+DEFAULT_DURABILITY = DURABILITY_DIR
+BUFFER_SIZE        = 1024 * 1024
+
+_group = contextvars.ContextVar("atomic_lib_group", default=None)  # Active GroupCommit, if any
+_umask_lock = threading.Lock()
+
+# ----------------------------------------------------------------------------- temp_name()
+def temp_name(file_name):
+   """ Returns a new, unique temporary file name next to file_name.  The
+       file is created empty so that the name can not be taken by another
+       writer.  Temporary files are hidden and end in TEMP_SUFFIX. """
+   directory, base = os.path.split(os.path.abspath(file_name))
+   handle, name = tempfile.mkstemp(prefix=f".{base}.", suffix=TEMP_SUFFIX, dir=directory)
+   os.close(handle)
+   return name
+
+# ----------------------------------------------------------------------------- check_durability()
+def check_durability(durability):
+   """ Returns durability, or DEFAULT_DURABILITY for None.  Raises
+       ValueError if it is not one of DURABILITIES. """
+   if durability is None: return DEFAULT_DURABILITY
+   if durability not in DURABILITIES: raise ValueError(f"Unknown durability '{durability}', use one of {DURABILITIES}")
+   return durability
+
+# ----------------------------------------------------------------------------- _umask()
+def _umask():
+   """ Returns the process umask.  Read from /proc where there is one,
+       since setting it to read it back races with other threads. """
+   if sys.platform.startswith("linux"):
+      try:
+         with open("/proc/self/status") as status:
+            for line in status:
+               if line.startswith("Umask:"): return int(line.split()[1], 8)
+      except (OSError, ValueError, IndexError):
+         pass
+   with _umask_lock:
+      mask = os.umask(0o077)
+      os.umask(mask)
+   return mask
+
+# ----------------------------------------------------------------------------- _sync_directory()
+def _sync_directory(directory):
+   """ Flushes a directory entry change (the rename) to disk, where the
+       platform supports opening directories. """
+   try:
+      handle = os.open(directory, os.O_RDONLY)
+   except OSError:
+      return
+   try:
+      os.fsync(handle)
+   except OSError:
+      pass
+   finally:
+      os.close(handle)
+
+# ----------------------------------------------------------------------------- atomic_write()
+@contextlib.contextmanager
+def atomic_write(file_name, mode='wb', durability=None, guard=None):
+   """ Context manager that yields a file object open on a temporary file
+       and, when the block completes, replaces file_name with it.  The
+       permissions of an existing file_name are kept.  If the block raises
+       the temporary file is removed and file_name is left as it was.
+       durability is one of DURABILITIES, see above.  guard, if given, is
+       a context manager entered around the rename only; if entering it
+       raises, the write is abandoned like a failing block.  A symbolic
+       link file_name is followed, see above. """
+   durability = check_durability(durability)
+   file_name = os.path.realpath(file_name)
+   name = temp_name(file_name)
+   try:
+      with open(name, mode, buffering=BUFFER_SIZE) as out_file:
+         yield out_file
+         out_file.flush()
+         if durability != DURABILITY_NONE: os.fsync(out_file.fileno())
+      if os.path.exists(file_name): shutil.copymode(file_name, name)
+      else:                         os.chmod(name, 0o666 & ~_umask())
+      with guard if guard is not None else contextlib.nullcontext():
+         os.replace(name, file_name)
+   except BaseException:
+      if os.path.exists(name): os.remove(name)
+      raise
+   if durability == DURABILITY_DIR:
+      directory = os.path.dirname(os.path.abspath(file_name))
+      group = _group.get()
+      if group is not None: group.add(directory)
+      else:                 _sync_directory(directory)
+
+# ----------------------------------------------------------------------------- class GroupCommit
+class GroupCommit:
+   """ Set of directories whose fsync is due, see group_commit().  With a
+       durability other than "dir" nothing is collected. """
+
+   def __init__(self, durability=None):
+      self.durability  = check_durability(durability)
+      self.directories = set()
+      # What the writes of the group use themselves: the file is still
+      # fsync'd, the directory is left to the group.
+      self.write_durability = DURABILITY_FILE if self.durability == DURABILITY_DIR else self.durability
+
+   def add(self, directory):
+      """ Notes that a rename in directory still has to be made durable. """
+      if self.durability == DURABILITY_DIR: self.directories.add(os.path.abspath(directory))
+
+   def commit(self):
+      """ fsyncs every directory noted since the last commit, once. """
+      directories, self.directories = self.directories, set()
+      for directory in sorted(directories): _sync_directory(directory)
+
+# ----------------------------------------------------------------------------- group_commit()
+@contextlib.contextmanager
+def group_commit(durability=None):
+   """ Context manager that yields a GroupCommit.  atomic_write() calls
+       in the block, in this thread or task, leave their directory fsync to
+       it, and it does them once per directory when the block ends, also
+       if it raises. """
+   group = GroupCommit(durability)
+   token = _group.set(group)
+   try:
+      yield group
+   finally:
+      _group.reset(token)
+      group.commit()
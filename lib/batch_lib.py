@@ -0,0 +1,174 @@
+#
+# This library runs filecryptor.py style encrypt and decrypt jobs over many
+# files in one process, so the interpreter start up, the imports and the
+# key loading are paid once per batch instead of once per file.  Sources
+# may be files, directories (walked recursively), glob patterns or a list
+# of names read from a stream.  Every file gets its own status, using the
+# same codes filecryptor.py uses as exit codes for a single file.
+#
+# Outputs are written atomically (see atomic_lib.py), so a crash or a
+# failure never leaves a partial file.  With the default durability "dir"
+# a batch fsyncs every file but each output directory only once, at the
+# end of the batch (group commit), instead of once per file.
+#
+# Function Prototypes:
+#    expand_sources(sources, encrypt=True, extension="enc")
+#    read_file_list(stream)
+#    output_name(source_file, encrypt=True, extension="enc")
+#    process_file(crypto_key, source_file, encrypt=True, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, extension="enc", binary=False, cipher="fernet", compression=None, durability=None)
+#    record_error(result, e, encrypt)
+#    process_files(crypto_key, sources, encrypt=True, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, extension="enc", jobs=1, executor="process", binary=False, cipher="fernet", compression=None, durability=None)
+#    convert_file(crypto_key, source_file, binary=True, durability=None)
+#    convert_files(crypto_key, sources, binary=True, extension="enc", jobs=1, executor="process", durability=None)
+#
+# The unit tests are in test_batch_lib.py, run them with pytest.
+
+import os
+import glob
+import atomic_lib
+import stream_lib
+
+STATUS_OK      = 0
+STATUS_MISSING = 6  # \
+STATUS_READ    = 7  #  \__ Same meaning as the filecryptor.py exit codes
+STATUS_WRITE   = 8  #  /
+STATUS_DECRYPT = 9  # /
+
+# ----------------------------------------------------------------------------- _wanted()
+def _wanted(file_name, encrypt, extension):
+   """ When walking a directory only pick up files that make sense for
+       the operation: clear files to encrypt, .enc files to decrypt.
+       extension None picks up every file. """
+   if extension is None: return True
+   return file_name.endswith(f".{extension}") != encrypt
+
+# ----------------------------------------------------------------------------- expand_sources()
+def expand_sources(sources, encrypt=True, extension="enc"):
+   """ Generator that expands a list of files, directories and glob
+       patterns into file names.  Directories are walked recursively in
+       sorted order and filtered by extension, unless it is None.  Names
+       that do not exist are passed through so that they are reported as
+       missing. """
+   for source in sources:
+      if os.path.isdir(source):
+         for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+               if _wanted(file_name, encrypt, extension): yield os.path.join(root, file_name)
+      elif not os.path.exists(source) and glob.has_magic(source):
+         for match in sorted(glob.iglob(source, recursive=True)):
+            if os.path.isdir(match): yield from expand_sources([match], encrypt, extension)
+            else: yield match
+      else:
+         yield source
+
+# ----------------------------------------------------------------------------- read_file_list()
+def read_file_list(stream):
+   """ Generator of file names read from a stream, one per line.
+       Blank lines and lines starting with '#' are skipped. """
+   for line in stream:
+      line = line.rstrip("\r\n")
+      if len(line.strip()) == 0 or line.startswith('#'): continue
+      yield line
+
+# ----------------------------------------------------------------------------- output_name()
+def output_name(source_file, encrypt=True, extension="enc"):
+   """ Returns the output file name for a source file.  Encrypting adds
+       the extension, decrypting removes it (or adds .dec if it is absent). """
+   if encrypt: return f"{source_file}.{extension}"
+   if source_file.endswith(f".{extension}"): return source_file[:-len(extension) - 1]
+   return f"{source_file}.dec"
+
+# ----------------------------------------------------------------------------- process_file()
+def process_file(crypto_key, source_file, encrypt=True, stream=False, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE,
+                 extension="enc", binary=False, cipher="fernet", compression=None, durability=None):
+   """ Encrypts or decrypts one file and returns a result dictionary with
+       the source, output, status and error message.  Never raises, so one
+       bad file cannot stop a batch.  Decrypting never overwrites an
+       existing file.  The output is written atomically with durability
+       (see atomic_lib), nothing of it is left on failure.  Encrypting
+       with binary set or a cipher other than Fernet writes the binary
+       container, compression (see stream_lib) compresses the frames;
+       all three imply stream. """
+   output_file = output_name(source_file, encrypt, extension)
+   result = {"source": source_file, "output": output_file, "status": STATUS_OK, "error": ""}
+   try:
+      if not os.path.isfile(source_file):
+         result["status"] = STATUS_MISSING
+         raise ValueError(f"Unable to locate source file {source_file}")
+      if not encrypt and os.path.exists(output_file):
+         result["status"] = STATUS_WRITE
+         raise ValueError(f"Output file {output_file} exists, not overwriting it")
+      with open(source_file, 'rb') as in_file, atomic_lib.atomic_write(output_file, durability=durability) as out_file:
+         if not encrypt:
+            stream_lib.decrypt_file(crypto_key, source_file, out_file)
+         elif stream or binary or cipher != "fernet" or compression:
+            stream_lib.encrypt_stream(crypto_key, in_file, out_file, chunk_size, binary=binary, cipher=cipher,
+                                      compression=compression)
+         else:
+            out_file.write(stream_lib.get_cipher(crypto_key).encrypt(in_file.read()))
+   except Exception as e:
+      record_error(result, e, encrypt)
+   return result
+
+# ----------------------------------------------------------------------------- record_error()
+def record_error(result, e, encrypt):
+   """ Records exception e in result, picking the status from what failed. """
+   if result["status"] == STATUS_OK:
+      if isinstance(e, OSError) and e.filename == result["source"]: result["status"] = STATUS_READ
+      elif encrypt or isinstance(e, OSError):                        result["status"] = STATUS_WRITE
+      else:                                                           result["status"] = STATUS_DECRYPT
+   result["error"] = str(e) or type(e).__name__
+
+# ----------------------------------------------------------------------------- process_files()
+def process_files(crypto_key, sources, encrypt=True, stream=False, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE,
+                  extension="enc", jobs=1, executor="process", binary=False, cipher="fernet", compression=None,
+                  durability=None):
+   """ Generator that encrypts or decrypts every file named by sources
+       (see expand_sources) on jobs workers, yielding one result
+       dictionary per file in source order.  The key is loaded once per
+       worker, not once per file.  With durability "dir" the output
+       directories are fsync'd together when the batch ends (or the
+       generator is closed), not per file. """
+   group = atomic_lib.GroupCommit(durability)
+   tasks = ((crypto_key, source_file, encrypt, stream, chunk_size, extension, binary, cipher, compression,
+             group.write_durability)
+            for source_file in expand_sources(sources, encrypt, extension))
+   try:
+      for result in stream_lib.ordered_map(process_file, tasks, jobs, executor):
+         if result["status"] == STATUS_OK: group.add(os.path.dirname(os.path.realpath(result["output"])))
+         yield result
+   finally:
+      group.commit()
+
+# ----------------------------------------------------------------------------- convert_file()
+def convert_file(crypto_key, source_file, binary=True, durability=None):
+   """ Converts an encrypted file in place to the binary container (or
+       back to base64 tokens if binary is False), see
+       stream_lib.convert_file().  The new file replaces the old one
+       atomically with durability (see atomic_lib) only once it is
+       complete.  Returns a result dictionary like process_file(). """
+   result = {"source": source_file, "output": source_file, "status": STATUS_OK, "error": ""}
+   try:
+      if not os.path.isfile(source_file):
+         result["status"] = STATUS_MISSING
+         raise ValueError(f"Unable to locate source file {source_file}")
+      stream_lib.convert_file(crypto_key, source_file, source_file, binary, durability)
+   except Exception as e:
+      record_error(result, e, False)
+   return result
+
+# ----------------------------------------------------------------------------- convert_files()
+def convert_files(crypto_key, sources, binary=True, extension="enc", jobs=1, executor="process", durability=None):
+   """ Generator that converts every encrypted file named by sources in
+       place, yielding one result dictionary per file in source order.
+       Directories are fsync'd once per batch, as in process_files(). """
+   group = atomic_lib.GroupCommit(durability)
+   tasks = ((crypto_key, source_file, binary, group.write_durability)
+            for source_file in expand_sources(sources, False, extension))
+   try:
+      for result in stream_lib.ordered_map(convert_file, tasks, jobs, executor):
+         if result["status"] == STATUS_OK: group.add(os.path.dirname(os.path.realpath(result["output"])))
+         yield result
+   finally:
+      group.commit()
@@ -0,0 +1,120 @@
+#
+# This library holds the AEAD cipher backends of the framed file format in
+# stream_lib.py.  Fernet, the default, is AES-128-CBC with HMAC-SHA256 and
+# makes two passes over the data.  AES-256-GCM and ChaCha20-Poly1305
+# encrypt and authenticate in a single pass; AES-GCM runs on the AES-NI and
+# carry-less multiply instructions of the CPU where OpenSSL has them, and
+# ChaCha20-Poly1305 is the faster choice on CPUs without AES instructions.
+#
+# The cipher is recorded in the CIPHER byte of the stream header, so the
+# reader picks the right backend by itself.  Every backend is keyed from
+# the same Fernet key file: the AEAD keys are derived from its 32 bytes
+# with HKDF-SHA256 and a per cipher label, so one key file serves all modes
+# and no two modes ever share a key.
+#
+# Token layout of the AEAD backends:
+#    TOKEN := NONCE(12) CIPHERTEXT TAG(16)
+#
+#    The nonce is random for every token.  With 96 bit random nonces a key
+#    should seal no more than 2**32 tokens; at the default 1 MiB per frame
+#    that is 4 PiB of data per key.
+#
+# Function Prototypes:
+#    cipher_id(name)
+#    cipher_name(cipher)
+#    is_aead(cipher)
+#    derive_key(crypto_key, cipher)
+#    get_aead(crypto_key, cipher)
+#    seal(crypto_key, cipher, data)
+#    open_token(crypto_key, cipher, token)
+#    open_token_into(crypto_key, cipher, token, buffer)
+#
+# The unit tests are in test_cipher_lib.py, run them with pytest.
+
+import os
+import base64
+from cryptography.fernet import InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+CIPHER_FERNET   = 1
+CIPHER_AES_GCM  = 2
+CIPHER_CHACHA20 = 3
+CIPHERS         = {"fernet": CIPHER_FERNET, "aes-gcm": CIPHER_AES_GCM, "chacha20": CIPHER_CHACHA20}
+NONCE_SIZE      = 12
+TAG_SIZE        = 16
+AEAD_OVERHEAD   = NONCE_SIZE + TAG_SIZE
+
+_BACKENDS = {CIPHER_AES_GCM: AESGCM, CIPHER_CHACHA20: ChaCha20Poly1305}
+_AEADS    = {}  # Per process cache of AEAD objects, see get_aead()
+
+# ----------------------------------------------------------------------------- cipher_id()
+def cipher_id(name):
+   """ Returns the header id of a cipher name, one of CIPHERS. """
+   if name not in CIPHERS: raise ValueError(f"Unknown cipher '{name}', use one of {tuple(CIPHERS)}")
+   return CIPHERS[name]
+
+# ----------------------------------------------------------------------------- cipher_name()
+def cipher_name(cipher):
+   """ Returns the name of a header cipher id. """
+   for name, value in CIPHERS.items():
+      if value == cipher: return name
+   raise ValueError(f"Unsupported cipher id {cipher}")
+
+# ----------------------------------------------------------------------------- is_aead()
+def is_aead(cipher):
+   """ True if the header cipher id is one of the AEAD backends. """
+   return cipher in _BACKENDS
+
+# ----------------------------------------------------------------------------- derive_key()
+def derive_key(crypto_key, cipher):
+   """ Derives the 256 bit key of an AEAD backend from a Fernet key. """
+   raw = base64.urlsafe_b64decode(crypto_key)
+   if len(raw) != 32: raise ValueError("Fernet key must be 32 url-safe base64-encoded bytes")
+   label = f"filecryptor {cipher_name(cipher)}".encode()
+   return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=label).derive(raw)
+
+# ----------------------------------------------------------------------------- get_aead()
+def get_aead(crypto_key, cipher):
+   """ Returns the AEAD object for crypto_key and cipher, built once per
+       process so pool workers derive each key only once. """
+   aead = _AEADS.get((crypto_key, cipher))
+   if aead is None:
+      if not is_aead(cipher): raise ValueError(f"Cipher {cipher_name(cipher)} is not an AEAD backend")
+      aead = _AEADS[(crypto_key, cipher)] = _BACKENDS[cipher](derive_key(crypto_key, cipher))
+   return aead
+
+# ----------------------------------------------------------------------------- seal()
+def seal(crypto_key, cipher, data):
+   """ Encrypts and authenticates data, returns NONCE + CIPHERTEXT + TAG. """
+   nonce = os.urandom(NONCE_SIZE)
+   return nonce + get_aead(crypto_key, cipher).encrypt(nonce, bytes(data), None)
+
+# ----------------------------------------------------------------------------- open_token()
+def open_token(crypto_key, cipher, token):
+   """ Verifies and decrypts a token from seal().  Raises InvalidToken,
+       like Fernet does, if it was tampered with or the key is wrong. """
+   if len(token) < AEAD_OVERHEAD: raise InvalidToken
+   try:
+      return get_aead(crypto_key, cipher).decrypt(bytes(token[:NONCE_SIZE]), token[NONCE_SIZE:], None)
+   except InvalidTag:
+      raise InvalidToken
+
+# ----------------------------------------------------------------------------- open_token_into()
+def open_token_into(crypto_key, cipher, token, buffer):
+   """ Verifies and decrypts a token into the start of buffer and returns
+       the number of clear text bytes.  token may be a memoryview, e.g.
+       of a memory mapped file.  Raises InvalidToken on failure. """
+   if len(token) < AEAD_OVERHEAD: raise InvalidToken
+   size = len(token) - AEAD_OVERHEAD
+   aead = get_aead(crypto_key, cipher)
+   try:
+      if hasattr(aead, "decrypt_into"):  # cryptography 46 and later
+         aead.decrypt_into(bytes(token[:NONCE_SIZE]), token[NONCE_SIZE:], None, memoryview(buffer)[:size])
+      else:
+         buffer[:size] = aead.decrypt(bytes(token[:NONCE_SIZE]), bytes(token[NONCE_SIZE:]), None)
+   except InvalidTag:
+      raise InvalidToken
+   return size
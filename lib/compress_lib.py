@@ -0,0 +1,104 @@
+#
+# This library holds the compression stage of the framed file format in
+# stream_lib.py.  Cipher text does not compress, so data has to be
+# compressed before it is encrypted or not at all.  Every frame is
+# compressed on its own, on the same worker that encrypts it, so
+# compression streams with constant memory and runs in parallel with
+# --jobs like the encryption does.
+#
+# The algorithm is recorded in the COMPRESSION byte of the stream header
+# and each compressed frame carries the FRAME_COMPRESSED flag, so readers
+# decompress by themselves.  A frame that does not shrink is stored as it
+# is; for large frames a quick zlib probe of the first PROBE_SIZE bytes
+# decides that without compressing the whole frame, so already compressed
+# data (media, archives) costs next to nothing.
+#
+# Compression is named by a spec string, "zlib" or "lzma", optionally with
+# a level: "zlib:9", "lzma:1".  zlib levels are 1 - 9 and lzma presets
+# 0 - 9, both default to 6.
+#
+# Function Prototypes:
+#    parse_compression(spec)
+#    compression_name(compression)
+#    compress(compression, data, level=None)
+#    decompress(compression, data, max_size)
+#
+# The unit tests are in test_compress_lib.py, run them with pytest.
+
+import zlib
+
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_LZMA = 2
+COMPRESSIONS  = {"none": COMPRESS_NONE, "zlib": COMPRESS_ZLIB, "lzma": COMPRESS_LZMA}
+LEVELS        = {COMPRESS_ZLIB: range(1, 10), COMPRESS_LZMA: range(0, 10)}
+DEFAULT_LEVEL = 6
+PROBE_SIZE    = 16 * 1024  # Bytes of a large frame tried first
+PROBE_RATIO   = 0.95       # A probe that does not get below this is not worth the rest
+
+# ----------------------------------------------------------------------------- parse_compression()
+def parse_compression(spec):
+   """ Returns (header id, level) of a compression spec like "zlib" or
+       "lzma:9".  None or "none" give (COMPRESS_NONE, None). """
+   if spec is None: return COMPRESS_NONE, None
+   name, _, level = spec.lower().partition(":")
+   if name not in COMPRESSIONS: raise ValueError(f"Unknown compression '{name}', use one of {tuple(COMPRESSIONS)}")
+   compression = COMPRESSIONS[name]
+   if compression == COMPRESS_NONE:
+      if level: raise ValueError("No compression takes no level")
+      return COMPRESS_NONE, None
+   if not level: return compression, DEFAULT_LEVEL
+   if not level.isdigit() or int(level) not in LEVELS[compression]:
+      raise ValueError(f"Invalid {name} level '{level}', use {LEVELS[compression].start} - {LEVELS[compression].stop - 1}")
+   return compression, int(level)
+
+# ----------------------------------------------------------------------------- compression_name()
+def compression_name(compression):
+   """ Returns the name of a header compression id. """
+   for name, value in COMPRESSIONS.items():
+      if value == compression: return name
+   raise ValueError(f"Unsupported compression id {compression}")
+
+# ----------------------------------------------------------------------------- _worth_it()
+def _worth_it(data):
+   """ False if a quick look says data will not compress, e.g. because it
+       is compressed already.  Small data is always tried. """
+   if len(data) < 4 * PROBE_SIZE: return True
+   probe = bytes(data[:PROBE_SIZE])
+   return len(zlib.compress(probe, 1)) < PROBE_RATIO * PROBE_SIZE
+
+# ----------------------------------------------------------------------------- compress()
+def compress(compression, data, level=None):
+   """ Returns data compressed, or None if it would not get smaller. """
+   if level is None: level = DEFAULT_LEVEL
+   if compression == COMPRESS_NONE or not _worth_it(data): return None
+   if compression == COMPRESS_ZLIB:
+      packed = zlib.compress(data, level)
+   elif compression == COMPRESS_LZMA:
+      import lzma  # Seldom used, keep it off the startup path
+      packed = lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=level)
+   else:
+      raise ValueError(f"Unsupported compression id {compression}")
+   return packed if len(packed) < len(data) else None
+
+# ----------------------------------------------------------------------------- decompress()
+def decompress(compression, data, max_size):
+   """ Returns data decompressed.  Raises ValueError if it is damaged or
+       would expand beyond max_size bytes, so a crafted frame can not
+       blow up memory. """
+   if compression == COMPRESS_ZLIB:
+      decompressor = zlib.decompressobj()
+      error = zlib.error
+   elif compression == COMPRESS_LZMA:
+      import lzma
+      decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+      error = lzma.LZMAError
+   else:
+      raise ValueError(f"Unsupported compression id {compression}")
+   try:
+      clear = decompressor.decompress(data, max_size + 1)
+   except error as e:
+      raise ValueError(f"Damaged compressed frame: {e}")
+   if len(clear) > max_size: raise ValueError("Compressed frame expands beyond the chunk size")
+   if not decompressor.eof: raise ValueError("Truncated compressed frame")
+   return clear
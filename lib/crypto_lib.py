@@ -5,20 +5,129 @@
 # To access encrypt or decrypt functionality, just call the same method 
 # you would normally call but, add a key file argument.  
 # 
-# To execute the unit tests simply run this libray as a main program.
+# The unit tests are in test_crypto_lib.py, run them with pytest.
 # -- H. Wilson, July 2022
 
 # Function Prototypes:
-#    write_json_file(json_file, json_data, key_file=None)
-#    read_json_file(json_file, json_data, key_file=None)
-#    write_config_file(config_file, config_data, key_file=None, delimiter=' ')
+#    write_json_file(json_file, json_data, key_file=None, binary=False, cipher="fernet", compression=None, durability=None, fields=None)
+#    read_json_file(json_file, json_data, key_file=None, fields=False)
+#    read_json_file_lazy(json_file, key_file)
+#    write_config_file(config_file, config_data, key_file=None, delimiter=' ', binary=False, cipher="fernet", compression=None, durability=None)
 #    read_config_file(config_file, key_file=None, delimiter=' ')
+#    load_key(key_file)
+#    load_store_key(keystore_file, name, master_key_file=None)
+#    clear_key_cache()
+#    read_json_file_cached(json_file, key_file=None, copy=False)
+#    read_config_file_cached(config_file, key_file=None, delimiter=' ', copy=False)
+#    config_cache_stats()
+#    clear_config_cache()
+#    freeze(data) / thaw(data)
+#    write_json_lines_file(json_file, records, key_file=None, chunk_size=DEFAULT_CHUNK_SIZE, binary=False, cipher="fernet", compression=None, durability=None)
+#    iter_json_lines_file(json_file, key_file=None)
+#    iter_config_file(config_file, key_file=None, delimiter=' ')
+#    async aread_json_file(json_file, key_file=None, timeout=None)
+#    async aread_config_file(config_file, key_file=None, delimiter=' ', timeout=None)
+#    async awrite_json_file(json_file, json_data, key_file=None, binary=False, cipher="fernet", timeout=None, compression=None, durability=None)
+#    async awrite_config_file(config_file, config_data, key_file=None, delimiter=' ', binary=False, cipher="fernet", timeout=None, compression=None, durability=None)
+#    set_async_workers(max_workers)
+#    encrypt_values(values, key_file, cipher="fernet")
+#    decrypt_values(tokens, key_file, encoding="utf-8")
+#    encrypt_json_fields(json_data, paths, key_file, cipher="fernet")
+#    decrypt_json_fields(json_data, key_file)
+#    LazyJson(json_data, key_file)   .to_dict()
+#
+# Key files are loaded through a small process wide cache, so hot paths do
+# not re-read the key file and rebuild the cipher on every call.  A cached
+# key is dropped as soon as the key file's inode, size or mtime changes.
+# Wherever a key_file argument is accepted a CryptoContext, the already
+# loaded key, may be passed instead of a file name.  A list of key files
+# is a key ring: the first is the primary key that all writes use, the
+# others are old keys that are still accepted when reading, so files can
+# be moved to a new key gradually (see rotate_lib.py).
+# Many keys, one per tenant say, live in a key store rather than a file
+# each; load_store_key() loads one of them by name (see keystore_lib.py).
+#
+# The *_cached readers are an opt-in for hot paths that read the same file
+# over and over: the parsed result is kept, LRU bounded, and handed out
+# again while the file's inode, size and mtime and the key are unchanged.
+# They return read-only views (or private copies with copy=True) so that
+# no caller can change what the next caller gets.
+#
+# For documents too large to hold in memory, write_json_lines_file() and
+# iter_json_lines_file() stream one record per line (JSON Lines).  When 
+# encrypted they use the chunked format of stream_lib, so memory use is
+# bounded by the chunk size rather than by the size of the document.
+# iter_config_file() does the same for flat config files, yielding one
+# (key, value) pair at a time.  Config files are rendered into a StringIO
+# buffer and parsed a block at a time with one strip, one find and two
+# slices per line.
+#
+# Encrypted files are a url-safe base64 Fernet token by default.  The
+# writers take binary=True to use stream_lib's binary container instead,
+# about 25% smaller and without base64 work.  Readers detect the format.
+# They also take cipher="aes-gcm" or "chacha20" to encrypt with a single
+# pass AEAD cipher (see cipher_lib.py), which implies the binary container.
+# Json and config exports compress well, compression="zlib" or "lzma",
+# optionally with a level as in "zlib:9", compresses them before they are
+# encrypted (see compress_lib.py), also in the binary container.  Readers
+# decompress by themselves.  Clear text files are never compressed.
+#
+# All writers replace the file atomically through a temporary file (see
+# atomic_lib.py), so a crash never leaves a truncated file behind that then
+# fails to decrypt.  durability picks how far it is fsync'd: "none", "file"
+# or "dir" (the default).  To write many files, wrap the calls in
+# atomic_lib.group_commit() so they share the directory fsyncs.
+#
+# The a* functions are asyncio counterparts of the readers and writers.
+# File I/O, parsing and cipher work run on a small thread pool, never on
+# the event loop.  Concurrent reads of the same file with the same key are
+# coalesced into one read and decrypt (single-flight), each caller gets its
+# own copy of the result.  Writes go to a temporary file that replaces the
+# target only when complete (see atomic_lib.py); a write that times out
+# leaves the target as it was and no partial file behind.  The rename and
+# the caller giving up are serialized, so a timeout either stops the write
+# or comes after it, and then the call succeeds.  A cancellation is always
+# raised to the caller, but one that comes after the rename can not undo
+# it: the target is then the new file.
+# asyncio and the thread pool are imported by these functions only, so
+# the synchronous API does not pay for them at startup.
+#
+# Strings and small values are encrypted in batches: encrypt_values() and
+# decrypt_values() take a list of strings or bytes and set the key and the
+# cipher up once for all of them.  With the AEAD ciphers a value costs a
+# few microseconds, several times less than a Fernet token.  They are the
+# base of field level encryption of Json documents: encrypt_json_fields()
+# or write_json_file(fields=...) encrypt only the values at the key paths
+# given ("database.password", "tenants.*.api_key") and leave the rest of
+# the document readable.  read_json_file_lazy() returns a LazyJson view
+# that decrypts a field only when it is read, so a request that needs the
+# public parts of a large document does no decryption at all.
+#
+# The readers and writers report the time and bytes of each phase (key
+# load, read, decrypt, parse, serialize, encrypt, write) to the hooks of
+# metrics_lib.py, e.g. a metrics_lib.MetricsCollector.  Decoding the
+# bytes to text is part of parse.  Without a hook registered the
+# instrumentation is a no-op.
 
+import io
 import os
 import sys
 import json 
-import pytest 
-from cryptography.fernet import Fernet
+import base64
+import struct
+import codecs
+import binascii
+import cipher_lib
+import stream_lib
+import atomic_lib
+import metrics_lib
+import copy as copy_module
+import weakref
+import threading
+import collections
+import collections.abc
+from types import MappingProxyType
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
 # For support of Lunux console test colorization 
 # on windows platform systems.
@@ -29,12 +138,177 @@ if sys.platform == "win32":
    except: 
       sys.stderr.write("WARNING -- Sorry, No color for Windows platform systems.\nTry: pip install colorama.\n")
 
+KEY_CACHE_SIZE    = 64   # Maximum number of key files held in the key cache
+CONFIG_CACHE_SIZE = 128  # Maximum number of parsed files held in the config cache
+CONFIG_BLOCK_SIZE = 64 * 1024  # Bytes of a config file decoded and parsed at a time
+ASYNC_WORKERS     = 4    # Threads the async functions run file and cipher work on
+VALUE_MARKER      = 0x89   # First byte of an AEAD value token, Fernet's is 0x80
+FIELD_PREFIX      = "ENC["  # \__ An encrypted Json field is the string ENC[TOKEN]
+FIELD_SUFFIX      = "]"     # /
+
+_VALUE = struct.Struct(">BB8s")  # MARKER CIPHER KEY_ID of an AEAD value token
+
+_key_cache      = collections.OrderedDict()  # abspath or ring -> (stat signature, CryptoContext)
+_key_cache_lock = threading.Lock()
+
+# ----------------------------------------------------------------------------- class CryptoContext
+class CryptoContext:
+   """ An already loaded cryptographic key and the cipher built from it.
+       Pass one wherever a key_file argument is accepted to skip the key
+       file entirely, e.g. for keys that come from a vault.  old_keys make
+       it a key ring: crypto_key encrypts, every key decrypts. """
+
+   def __init__(self, crypto_key, old_keys=()):
+      keys = tuple(k.encode() if isinstance(k, str) else k for k in (crypto_key, *old_keys))
+      self.crypto_key = keys[0]
+      self.keys       = keys
+      if len(keys) == 1: self.cipher = Fernet(keys[0])
+      else:              self.cipher = MultiFernet([Fernet(k) for k in keys])
+
+   @classmethod
+   def from_key_file(cls, key_file):
+      """ Returns the (cached) context for a key file, see load_key(). """
+      return load_key(key_file)
+
+   def encrypt(self, data):
+      """ Encrypts bytes and returns a Fernet token. """
+      return self.cipher.encrypt(data)
+
+   def decrypt(self, token):
+      """ Verifies and decrypts a Fernet token and returns the bytes. """
+      return self.cipher.decrypt(token)
+
+   def rotate(self, token):
+      """ Returns a Fernet token re-encrypted under the primary key. """
+      return self.encrypt(self.decrypt(token))
+
+# ----------------------------------------------------------------------------- load_key()
+def load_key(key_file):
+   """ Returns a CryptoContext for key_file.  The context is cached per
+       path and reused until the file's inode, size or modification time
+       changes; at most KEY_CACHE_SIZE key files are kept, least recently
+       used first out.  A CryptoContext argument is returned unchanged.
+       A list or tuple of key files returns a key ring context, primary
+       key first.  Raises ValueError if a key file does not exist. """
+   if isinstance(key_file, CryptoContext): return key_file
+   if isinstance(key_file, (list, tuple)): return _load_key_ring(key_file)
+   with metrics_lib.phase("key_load") as timer:
+      try: 
+         stat = os.stat(key_file)
+      except FileNotFoundError: 
+         raise ValueError(f"Unable to locate key file '{key_file}'")
+      signature = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+      path = os.path.abspath(key_file)
+      with _key_cache_lock:
+         cached = _key_cache.get(path)
+         if cached is not None and cached[0] == signature:
+            _key_cache.move_to_end(path)
+            return cached[1]
+      with open(key_file, 'rb') as filekey: crypto_key = filekey.read()
+      timer.add(len(crypto_key))
+      context = CryptoContext(crypto_key)
+      with _key_cache_lock:
+         _key_cache[path] = (signature, context)
+         _key_cache.move_to_end(path)
+         while len(_key_cache) > KEY_CACHE_SIZE: _key_cache.popitem(last=False)
+      return context
+
+# ----------------------------------------------------------------------------- _load_key_ring()
+def _load_key_ring(key_files):
+   """ Returns the key ring context for a list of key files.  The ring is
+       cached on the contexts of its members, so it is rebuilt whenever
+       one of the key files changes. """
+   if len(key_files) == 0: raise ValueError("A key ring needs at least one key file")
+   members = tuple(load_key(key_file) for key_file in key_files)
+   if len(members) == 1: return members[0]
+   with _key_cache_lock:
+      cached = _key_cache.get(members)
+      if cached is not None:
+         _key_cache.move_to_end(members)
+         return cached[1]
+   context = CryptoContext(members[0].crypto_key, [member.crypto_key for member in members[1:]])
+   with _key_cache_lock:
+      _key_cache[members] = (None, context)
+      while len(_key_cache) > KEY_CACHE_SIZE: _key_cache.popitem(last=False)
+   return context
+
+# ----------------------------------------------------------------------------- load_store_key()
+def load_store_key(keystore_file, name, master_key_file=None):
+   """ Returns a CryptoContext for the key named name in a key store (see
+       keystore_lib.py), read with a single lookup however many keys the
+       store holds.  master_key_file is the key file (or CryptoContext) of
+       an encrypted store.  Cached like load_key(), until the store file
+       changes.  Raises ValueError if the store or the key does not exist. """
+   import keystore_lib
+   with metrics_lib.phase("key_load") as timer:
+      try: 
+         stat = os.stat(keystore_file)
+      except FileNotFoundError: 
+         raise ValueError(f"Unable to locate key store '{keystore_file}'")
+      master    = load_key(master_key_file) if master_key_file is not None else None
+      signature = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+      path      = (os.path.abspath(keystore_file), name, master)
+      with _key_cache_lock:
+         cached = _key_cache.get(path)
+         if cached is not None and cached[0] == signature:
+            _key_cache.move_to_end(path)
+            return cached[1]
+      crypto_key = keystore_lib.load_keystore_key(keystore_file, name, master.crypto_key if master else None)
+      timer.add(len(crypto_key))
+      context = CryptoContext(crypto_key)
+      with _key_cache_lock:
+         _key_cache[path] = (signature, context)
+         _key_cache.move_to_end(path)
+         while len(_key_cache) > KEY_CACHE_SIZE: _key_cache.popitem(last=False)
+      return context
+
+# ----------------------------------------------------------------------------- clear_key_cache()
+def clear_key_cache():
+   """ Forgets every cached key, e.g. after rotating keys in place. """
+   with _key_cache_lock: _key_cache.clear()
+
+# ----------------------------------------------------------------------------- _write_file()
+def _write_file(file_name, clear_text, cryptographic_component=None, binary=False, cipher="fernet", compression=None,
+                durability=None):
+   """ Atomically replaces file_name with clear_text, encrypted if a
+       cryptographic component is given: as a single Fernet token, or as
+       stream_lib's binary container if binary is set, cipher is not
+       Fernet or compression is given. """
+   with atomic_lib.atomic_write(file_name, durability=durability) as output_file:
+      if cryptographic_component is not None:
+         _encrypt_into(output_file, clear_text, cryptographic_component, binary, cipher, compression)
+      else:
+         with metrics_lib.phase("write", len(clear_text)): output_file.write(clear_text)
+
+# ----------------------------------------------------------------------------- _encrypt_into()
+def _encrypt_into(encrypted_file, clear_text, cryptographic_component, binary=False, cipher="fernet", compression=None):
+   """ Writes clear_text encrypted to an open binary file, see _write_file().
+       The encrypted bytes are built in memory first, so that the encrypt
+       and write phases are measured apart. """
+   if binary or cipher != "fernet" or compression:
+      buffer = io.BytesIO()
+      stream_lib.encrypt_iterable(cryptographic_component.crypto_key, [clear_text], buffer, binary=True, cipher=cipher,
+                                  compression=compression)
+      encrypted = buffer.getbuffer()
+   else:
+      with metrics_lib.phase("encrypt", len(clear_text)):
+         encrypted = cryptographic_component.encrypt(clear_text)
+   with metrics_lib.phase("write", len(encrypted)):
+      encrypted_file.write(encrypted)
+
 # 
 # ----------------------------------------------------------------------------- write_json_file()
-def write_json_file(json_file, json_data, key_file=None):
+def write_json_file(json_file, json_data, key_file=None, binary=False, cipher="fernet", compression=None,
+                    durability=None, fields=None):
    """ writes a json file from a Python dictionary supplied.  
-       Optionally supports a cryptographic key file if encrypting the 
-       json file is necessary. 
+       Optionally supports a cryptographic key file (or CryptoContext) 
+       if encrypting the json file is necessary, binary selects the
+       compact binary container over a base64 Fernet token, cipher
+       the frame cipher and compression how to compress it first. 
+       With fields, a list of key paths, the file is clear text Json
+       instead with only the values at those paths encrypted with the
+       key and cipher (see encrypt_json_fields).
+       The file is replaced atomically, fsync'd as durability says.
        If successful then True is returned.
        If anything goes wrong then False is returned. """
    WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
@@ -43,48 +317,165 @@ def write_json_file(json_file, json_data, key_file=None):
    try: 
       if type(json_data) != type({}): raise ValueError("The json_data argument must be of type Python Dictionary")
       if os.path.isfile(json_file): sys.stderr.write(f"\n{WARNING} -- Json File {json_file} exists and will be overwritten.\n")  
-      json_string = json.dumps(json_data)
-      if key_file != None:
-         if not os.path.isfile(key_file): raise ValueError(f"Unable to locate key file '{key_file}'")        
-         with open(key_file, 'rb') as filekey: crypto_key = filekey.read()
-         cryptographic_component = Fernet(crypto_key)
-         encrypted = cryptographic_component.encrypt(json_string.encode())
-         with open(json_file, 'wb') as encrypted_file: encrypted_file.write(encrypted)     
-      else: 
-         with open(json_file, 'w') as output_file: output_file.write(json_string)
-      if os.path.isfile(json_file):  return_value = True
-      else: raise ValueError(f"Unable to create Json file {json_file}" )    
+      with metrics_lib.operation("write_json_file"):
+         if fields:
+            if key_file == None: raise ValueError("Encrypting fields needs a key file")
+            json_data, key_file = encrypt_json_fields(json_data, fields, key_file, cipher), None
+         with metrics_lib.phase("serialize") as timer:
+            json_bytes = json.dumps(json_data).encode()
+            timer.add(len(json_bytes))
+         cryptographic_component = load_key(key_file) if key_file != None else None
+         _write_file(json_file, json_bytes, cryptographic_component, binary, cipher, compression, durability)
+      return_value = True
    except Exception as e: 
       sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
       sys.stderr.flush()
       return_value = False 
    finally: return return_value
 
+# ----------------------------------------------------------------------------- _load_json_file()
+def _load_json_file(json_file, key_file=None):
+   """ Reads, decrypts if a key is given, and parses a Json file.
+       Raises an exception if anything goes wrong. """
+   if not os.path.isfile(json_file): raise ValueError(f"Unable to locate input json file {json_file}")
+   with metrics_lib.operation("read_json_file"):
+      if key_file != None:
+         # Decrypt from a memory map into one buffer that json parses as is.
+         cryptographic_component = load_key(key_file)
+         json_bytes = stream_lib.read_decrypted(cryptographic_component.keys, json_file)
+      else:
+         with metrics_lib.phase("read") as timer, open(json_file, 'rb') as f:
+            json_bytes = f.read()
+            timer.add(len(json_bytes))
+      with metrics_lib.phase("parse", len(json_bytes)): return json.loads(json_bytes)
+
 # ----------------------------------------------------------------------------- read_json_file()
-def read_json_file(json_file, key_file=None):
+def read_json_file(json_file, key_file=None, fields=False):
    """ Read a Json file and returns a Python Dictionary.  Optionally supports 
-       a cryptographic key file if decrypting the json file is necessary.
+       a cryptographic key file (or CryptoContext) if decrypting the json 
+       file is necessary.  With fields set the file is clear text Json
+       with encrypted fields (see write_json_file), all of which are
+       decrypted; read_json_file_lazy() decrypts only those read.
        If anything goes wrong then an empty dictionary is returned. """
    WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
    ERROR   = "\033[31mERROR\033[0m"   # /
    json_data = {}
    try:
-      if not os.path.isfile(json_file): raise ValueError(f"Unable to locate input json file {json_file}")
-      if key_file != None:
-         if not os.path.isfile(key_file): raise ValueError(f"Unable to locate key file {key_file}")
-         with open(key_file, 'rb') as filekey: crypto_key = filekey.read()
-         cryptographic_component = Fernet(crypto_key)
-         with open(json_file, 'rb') as enc_file: encrypted = enc_file.read() 
-         file_data  = cryptographic_component.decrypt(encrypted).decode() 
-         json_data = json.loads(file_data) 
-      else: 
-         with open(json_file, 'r') as f: json_data = json.load(f)
+      if fields: json_data = decrypt_json_fields(_load_json_file(json_file), key_file)
+      else:      json_data = _load_json_file(json_file, key_file)
    except Exception as e:
       sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
       sys.stderr.flush()
       json_data = {} 
    finally: return json_data       
 
+# ----------------------------------------------------------------------------- read_json_file_lazy()
+def read_json_file_lazy(json_file, key_file):
+   """ Reads a clear text Json file with encrypted fields (see
+       write_json_file) and returns a LazyJson view of it: the clear parts
+       are parsed as usual, an encrypted field is decrypted only when it
+       is read, with the key file (or CryptoContext).  Requests that need
+       a field or two of a large, mostly public document skip the rest.
+       If anything goes wrong then an empty dictionary is returned;
+       fields that do not decrypt raise ValueError when read. """
+   ERROR = "\033[31mERROR\033[0m" # Linux-specific colorization
+   try:
+      json_data = _load_json_file(json_file)
+      if not isinstance(json_data, dict): raise ValueError(f"Json file {json_file} does not hold an object")
+      return LazyJson(json_data, key_file)
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return {}
+
+# ----------------------------------------------------------------------------- _load_config_file()
+def _load_config_file(config_file, key_file=None, delimiter=' '):
+   """ Reads, decrypts if a key is given, and parses a flat config file
+       into a dictionary.  Raises an exception if anything goes wrong. """
+   configs = {}
+   # Get the configuration data from the config file as one big string.
+   # Decrypt if necessary   
+   with metrics_lib.operation("read_config_file"):
+      if key_file != None:
+         cryptographic_component = load_key(key_file)
+         config_bytes = stream_lib.read_decrypted(cryptographic_component.keys, config_file)
+      else: 
+         with metrics_lib.phase("read") as timer, open(config_file, 'rb') as f:
+            config_bytes = f.read()
+            timer.add(len(config_bytes))
+      # Parse the config data obtained from the file and try to compile a 
+      # dictionary of key-value pairs from the lines of the file respecting 
+      # white space and comment lines.  The bytes are decoded and parsed a
+      # block at a time, which keeps the work in the CPU caches.
+      with metrics_lib.phase("parse", len(config_bytes)):
+         configs = _parse_config_bytes(config_bytes, delimiter, config_file)
+   return configs
+
+# ----------------------------------------------------------------------------- _parse_config_bytes()
+def _parse_config_bytes(config_bytes, delimiter, config_file):
+   """ Decodes and parses the whole text of a config file into a new
+       dictionary, see _parse_config(). """
+   configs    = {}
+   line_count = 1
+   for lines in _config_blocks([config_bytes]):
+      _parse_config(lines, delimiter, config_file, configs, line_count)
+      line_count += len(lines)
+   return configs
+
+# ----------------------------------------------------------------------------- _parse_config()
+def _parse_config(lines, delimiter, config_file, configs, first_line=1):
+   """ Parses config file lines into the configs dictionary and returns
+       it.  Blank and comment lines are skipped, lines without the
+       delimiter are warned about on stderr and skipped; first_line is
+       the number of lines[0] in those warnings.  This is the hot loop of
+       the config readers: one strip, one find and two slices per line,
+       and no tuple or list per line for the garbage collector to scan. """
+   WARNING = "\033[33mWARNING\033[0m" # Linux-specific colorization
+   if not delimiter: raise ValueError("The delimiter must not be empty")
+   size = len(delimiter)
+   for line_count, line in enumerate(lines, first_line):
+      line = line.strip()
+      if not line or line[0] == '#': continue
+      split = line.find(delimiter)
+      if split >= 0:
+         configs[line[:split]] = line[split + size:].lstrip()  # The line is stripped, so is the end of the value
+      else:
+         sys.stderr.write(f"{WARNING} -- Invalid line missing delimiter in {config_file} line {line_count}\n'{line}'\n")
+         sys.stderr.flush()
+   return configs
+
+# ----------------------------------------------------------------------------- _config_blocks()
+def _config_blocks(chunks):
+   """ Generator that decodes chunks of bytes and yields them as lists of
+       lines, at most CONFIG_BLOCK_SIZE bytes worth at a time.  Together
+       the lists are the lines of the whole text split at newlines; a
+       line or a UTF-8 sequence may span chunks. """
+   decoder = codecs.getincrementaldecoder("utf-8")()
+   partial = ""
+   for chunk in chunks:
+      view = memoryview(chunk)
+      for start in range(0, len(view), CONFIG_BLOCK_SIZE):
+         lines = (partial + decoder.decode(view[start:start + CONFIG_BLOCK_SIZE])).split('\n')
+         partial = lines.pop()
+         yield lines
+   yield [partial + decoder.decode(b"", final=True)]
+
+# ----------------------------------------------------------------------------- iter_config_file()
+def iter_config_file(config_file, key_file=None, delimiter=' '):
+   """ Generator that reads a flat config file and yields its (key, value)
+       pairs in file order, as read_config_file() parses them, without
+       holding the whole file in memory.  Optionally supports a 
+       cryptographic key file (or CryptoContext) if decrypting the file
+       is necessary; framed files are then decrypted one chunk at a time.
+       A repeated key may be yielded more than once, dict() of the pairs
+       is always what read_config_file() returns.
+       Unlike the read_* functions this raises on errors. """
+   with open(config_file, 'rb') as input_file:
+      line_count = 1
+      for lines in _config_blocks(_decrypted_chunks(input_file, key_file)):
+         yield from _parse_config(lines, delimiter, config_file, {}, line_count).items()
+         line_count += len(lines)
+
 # ----------------------------------------------------------------------------- read_config_file()
 def read_config_file(config_file, key_file=None, delimiter=' '):
    """ Read a text flat file where each line in the file is 
@@ -92,40 +483,12 @@ def read_config_file(config_file, key_file=None, delimiter=' '):
        pairs parsed from that file. Supports text flat files 
        with white space and comment lines starting with a '#' 
        character. 
-       Optionally supports a cryptographic key file 
+       Optionally supports a cryptographic key file (or CryptoContext)
        if decrypting the config file is necessary. """
    configs = {}
-   WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
-   ERROR   = "\033[31mERROR\033[0m"   # /
+   ERROR = "\033[31mERROR\033[0m" # Linux-specific colorization
    try:
-      # Get the configuration data from the config file as one big string.
-      # Decrypt if necessary   
-      if key_file != None:
-         if not os.path.isfile(key_file): raise ValueError(f"Unable to locate key file '{key_file}'")        
-         with open(key_file, 'rb') as filekey: crypto_key = filekey.read()
-         cryptographic_component = Fernet(crypto_key)
-         with open(config_file, 'rb') as enc_file: encrypted = enc_file.read() 
-         config_data  = cryptographic_component.decrypt(encrypted).decode() 
-      else: 
-         config_data = open(config_file, 'r').read() 
-      # Parse the config data obtained from the file and try to compile a 
-      # dictionary of key-value pairs from the lines of the file respecting 
-      # white space and comment lines .
-      line_counter = 0 
-      for line in config_data.split('\n'):   
-         line_counter += 1 
-         line = line.strip()
-         if len(line) == 0: pass
-         elif line.startswith('#') : pass
-         elif delimiter not in line: 
-            sys.stderr.write(f"{WARNING} -- Invalid line missing delimiter in {config_file} line {line_count}\n'{line}'\n")
-            sys.stderr.flush()
-         else:
-            data_elements = line.split(delimiter, 1)
-            if len(data_elements) != 2: 
-               sys.stderr.write(f"{WARNING} -- Invalid line in {config_file} line {line_count}\n'{line}'\n")
-               sys.stderr.flush()
-            configs[data_elements[0]] = str(data_elements[-1]).strip()    
+      configs = _load_config_file(config_file, key_file, delimiter)
    except Exception as e: 
       sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
       sys.stderr.flush()
@@ -133,11 +496,15 @@ def read_config_file(config_file, key_file=None, delimiter=' '):
    finally: return configs
 
 # ----------------------------------------------------------------------------- write_config_file()
-def write_config_file(config_file, config_data, key_file=None, delimiter=' '):
+def write_config_file(config_file, config_data, key_file=None, delimiter=' ', binary=False, cipher="fernet",
+                      compression=None, durability=None):
    """ writes a text flat file where each line in the file is 
        a key-value pair obtained from the config_data dictoinary supplied.  
-       Optionally supports a cryptographic key file if decrypting the 
-       config file is necessary. 
+       Optionally supports a cryptographic key file (or CryptoContext) 
+       if encrypting the config file is necessary, binary selects the
+       compact binary container over a base64 Fernet token, cipher
+       the frame cipher and compression how to compress it first. 
+       The file is replaced atomically, fsync'd as durability says.
        If successful then True is returned.
        If anything goes wrong then False is returned. """
    WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
@@ -147,83 +514,638 @@ def write_config_file(config_file, config_data, key_file=None, delimiter=' '):
    try: 
       if not type(config_data) == type({}): raise ValueError(f"The config_data argument must be of type dictionary")
       if os.path.isfile(config_file): sys.stderr.write(f"\n{WARNING} -- Config file {config_file} exists and will be overwritten\n")
-      for item in config_data:
-         config_string += f"{str(item)}{delimiter}{str(config_data[item])}\n"
-      print(f"CONFIG STRING:\n{config_string}")   
-      if key_file != None:
-         if not os.path.isfile(key_file): raise ValueError(f"Unable to locate key file '{key_file}'")        
-         with open(key_file, 'rb') as filekey: crypto_key = filekey.read()
-         cryptographic_component = Fernet(crypto_key)
-         encrypted = cryptographic_component.encrypt(config_string.encode())
-         with open(config_file, 'wb') as encrypted_file: encrypted_file.write(encrypted)
-      else:
-         with open(config_file, 'w') as output_file: output_file.write(config_string)
-      if os.path.isfile(config_file): return_value = True
-      else: raise ValueError(f"Unable to create configfile {config_file}")   
+      with metrics_lib.operation("write_config_file"):
+         with metrics_lib.phase("serialize") as timer:
+            config_string = _config_string(config_data, delimiter)
+            config_bytes  = config_string.encode()
+            timer.add(len(config_bytes))
+         cryptographic_component = load_key(key_file) if key_file != None else None
+         _write_file(config_file, config_bytes, cryptographic_component, binary, cipher, compression, durability)
+      return_value = True
    except Exception as e:
       sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
       sys.stderr.flush()
       return_value = False 
    finally: return return_value   
    
-# === UNIT TESTS ==============================================================   
-@pytest.fixture(scope="class")
-def setup(request):
-   # Test Setup: Define test data and create test files 
-   key             = Fernet.generate_key()
-   key_file        = "a.key"
-   config_file     = "test_config_file.txt"
-   enc_config_file = "test_config_file.txt.enc"
-   config_data     = {"Key_1":"Value 1", "Key_2":"2", "Key_3":"3.1415926"}
-   json_data       = {"Key_1":"Value 1", "Key_2":2, "Key_3":3.1415926}
-   json_file       = "json_file.json"
-   enc_json_file   = "json_file.json.enc" 
-   request.cls.key_file        = key_file         # \
-   request.cls.config_data     = config_data      #  \
-   request.cls.config_file     = config_file      #   \
-   request.cls.enc_config_file = enc_config_file  #    >-- Data for test cases 
-   request.cls.json_file       = json_file        #   /
-   request.cls.enc_json_file   = enc_json_file    #  /
-   request.cls.json_data       = json_data        # /
-   with open(key_file, 'wb') as filekey: filekey.write(key)
-   # Execute test cases in class Test_crypto_lib
-   yield  
-   # Test Takedown: Clean up any left over files
-   cleanup_filelist = [key_file, config_file, enc_config_file, json_file, enc_json_file]
-   for file_name in cleanup_filelist:
-      if os.path.isfile(file_name): os.remove(file_name) 
-
-@pytest.mark.usefixtures("setup")
-class Test_crypto_lib:
-
-   def test_01_write_config_file(self):
-      assert write_config_file(self.config_file, self.config_data)
-
-   def test_02_read_config_file(self):
-      config_data = read_config_file(self.config_file)
-      assert config_data == self.config_data
-
-   def test_03_write_enc_config_file(self):
-      assert write_config_file(self.enc_config_file, self.config_data, self.key_file)
-
-   def test_04_read_enc_config_file(self):
-      config_data = read_config_file(self.enc_config_file, self.key_file)
-      assert config_data == self.config_data
-
-   def test_05_write_json_file(self):
-      assert write_json_file(self.json_file, self.json_data)
-
-   def test_06_read_json_file(self):
-      json_data = read_json_file(self.json_file)
-      assert json_data == self.json_data
-
-   def test_07_write_enc_json_file(self):
-      assert write_json_file(self.enc_json_file, self.json_data, self.key_file)
-
-   def test_08_read_enc_json_file(self):
-      json_data = read_json_file(self.enc_json_file, self.key_file)
-      assert json_data == self.json_data
-
-
-if __name__ == "__main__":
-   pytest.main(['-vv', '-s', __file__])
+# ----------------------------------------------------------------------------- _config_string()
+def _config_string(config_data, delimiter=' '):
+   """ Renders a dictionary as config file lines of key delimiter value.
+       The lines go to an io.StringIO buffer rather than being added to
+       a string one by one, so this is linear in the size of the output
+       and holds no more than the buffer and the result. """
+   buffer = io.StringIO()
+   write  = buffer.write
+   for item, value in config_data.items():
+      write(f"{item!s}{delimiter}{value!s}\n")
+   return buffer.getvalue()
+
+# ----------------------------------------------------------------------------- _json_lines()
+def _json_lines(records, batch_size):
+   """ Generator that encodes records as JSON Lines, yielding the encoded
+       bytes in pieces of roughly batch_size bytes. """
+   encoder = json.JSONEncoder()
+   batch   = []
+   size    = 0
+   for record in records:
+      line = (encoder.encode(record) + "\n").encode()
+      batch.append(line)
+      size += len(line)
+      if size >= batch_size:
+         yield b"".join(batch)
+         batch, size = [], 0
+   if batch: yield b"".join(batch)
+
+# ----------------------------------------------------------------------------- write_json_lines_file()
+def write_json_lines_file(json_file, records, key_file=None, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE, binary=False,
+                          cipher="fernet", compression=None, durability=None):
+   """ Writes an iterable of Json serializable records to a JSON Lines
+       file, one record per line, without building the whole document in
+       memory.  Optionally supports a cryptographic key file (or 
+       CryptoContext), the file is then written in the chunked streaming
+       format with chunk_size bytes of clear text per frame, with raw
+       rather than base64 tokens if binary is set, encrypted with cipher,
+       every chunk compressed first if compression is given.  The file
+       is replaced atomically once complete, fsync'd as durability says.
+       If successful then True is returned.
+       If anything goes wrong then False is returned. """
+   WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
+   ERROR   = "\033[31mERROR\033[0m"   # /
+   return_value = False
+   try:
+      if os.path.isfile(json_file): sys.stderr.write(f"\n{WARNING} -- Json File {json_file} exists and will be overwritten.\n")
+      pieces = _json_lines(records, chunk_size)
+      with atomic_lib.atomic_write(json_file, durability=durability) as output_file:
+         if key_file != None:
+            context = load_key(key_file)
+            stream_lib.encrypt_iterable(context.crypto_key, pieces, output_file, chunk_size, binary=binary, cipher=cipher,
+                                        compression=compression)
+         else:
+            for piece in pieces: output_file.write(piece)
+      return_value = True
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return_value = False
+   finally: return return_value
+
+# ----------------------------------------------------------------------------- iter_json_lines_file()
+def iter_json_lines_file(json_file, key_file=None):
+   """ Generator that reads a JSON Lines file and yields one parsed record
+       at a time.  Optionally supports a cryptographic key file (or
+       CryptoContext) if decrypting the file is necessary; the file is then
+       decrypted one chunk at a time.  Blank lines are skipped.
+       Unlike the read_* functions this raises on errors, so a damaged
+       file can never look like a shorter, valid one. """
+   with open(json_file, 'rb') as input_file:
+      if key_file == None:
+         for line in input_file:
+            if line.strip(): yield json.loads(line)
+         return
+      partial = b""
+      for chunk in _decrypted_chunks(input_file, key_file):
+         lines = (partial + chunk).split(b"\n")
+         partial = lines.pop()
+         for line in lines:
+            if line.strip(): yield json.loads(line)
+      if partial.strip(): yield json.loads(partial)
+
+# ----------------------------------------------------------------------------- _decrypted_chunks()
+def _decrypted_chunks(input_file, key_file=None, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE):
+   """ Generator that yields the clear text of an open file in chunks: as
+       it is without a key, one frame at a time for the chunked streaming
+       format, or all at once for a single token. """
+   if key_file == None:
+      yield from iter(lambda: input_file.read(chunk_size), b"")
+      return
+   context = load_key(key_file)
+   if stream_lib.detect_format(input_file.read(stream_lib.DETECT_SIZE)) == "framed":
+      input_file.seek(0)
+      yield from stream_lib.iter_decrypt_stream(context.keys, input_file)
+   else:
+      input_file.seek(0)
+      yield context.decrypt(input_file.read())
+
+# ----------------------------------------------------------------------------- encrypt_values()
+def encrypt_values(values, key_file, cipher="fernet"):
+   """ Encrypts a list of strings (as utf-8) or bytes with one key and one
+       cipher set up and returns a list of text tokens, in order.  Fernet
+       tokens are the ones CryptoContext.encrypt() makes; with cipher
+       "aes-gcm" or "chacha20" a token is the url-safe base64 of MARKER(1)
+       CIPHER(1) KEY_ID(8) NONCE(12) CIPHERTEXT TAG(16), several times
+       faster per value and 20 bytes shorter. """
+   context = load_key(key_file)
+   data    = [value.encode() if isinstance(value, str) else bytes(value) for value in values]
+   with metrics_lib.phase("encrypt", sum(len(d) for d in data)):
+      if cipher == "fernet":
+         fernet = Fernet(context.crypto_key) if len(context.keys) > 1 else context.cipher
+         return [fernet.encrypt(d).decode() for d in data]
+      cipher_id = cipher_lib.cipher_id(cipher)
+      if not cipher_lib.is_aead(cipher_id): raise ValueError(f"Unsupported value cipher '{cipher}'")
+      prefix = _VALUE.pack(VALUE_MARKER, cipher_id, stream_lib.key_id(context.crypto_key))
+      return [base64.urlsafe_b64encode(prefix + cipher_lib.seal(context.crypto_key, cipher_id, d)).decode() for d in data]
+
+# ----------------------------------------------------------------------------- decrypt_values()
+def decrypt_values(tokens, key_file, encoding="utf-8"):
+   """ Decrypts a list of tokens from encrypt_values(), whatever their
+       cipher, with one key (or key ring) set up and returns the values in
+       order, as str, or as bytes with encoding None.  Raises ValueError
+       if a token is damaged or was made with another key. """
+   context = load_key(key_file)
+   keys    = {stream_lib.key_id(key): key for key in context.keys}
+   values  = []
+   with metrics_lib.phase("decrypt") as timer:
+      for i, token in enumerate(tokens):
+         token = token.encode() if isinstance(token, str) else bytes(token)
+         try:
+            if token.startswith(stream_lib.FERNET_PREFIX):
+               value = context.cipher.decrypt(token)
+            else:
+               raw = base64.urlsafe_b64decode(token)
+               marker, cipher_id, kid = _VALUE.unpack_from(raw)
+               if marker != VALUE_MARKER or not cipher_lib.is_aead(cipher_id): raise ValueError(f"Value {i} is not a token")
+               if kid not in keys: raise ValueError(f"Value {i} was encrypted with a different key")
+               value = cipher_lib.open_token(keys[kid], cipher_id, memoryview(raw)[_VALUE.size:])
+         except (InvalidToken, TypeError, struct.error, binascii.Error):
+            raise ValueError(f"Value {i} is damaged or was encrypted with a different key")
+         timer.add(len(value))
+         values.append(value.decode(encoding) if encoding else value)
+   return values
+
+# ----------------------------------------------------------------------------- _field_targets()
+def _field_targets(node, pattern, path=()):
+   """ Generator of (container, key, path) of every value of a Json
+       document that the key path pattern, a tuple, matches. """
+   if not pattern: return
+   head, rest = pattern[0], pattern[1:]
+   if isinstance(node, dict):
+      keys = list(node) if head == "*" else [head] if head in node else []
+   elif isinstance(node, list):
+      keys = range(len(node)) if head == "*" else [int(head)] if str(head).isdigit() and int(head) < len(node) else []
+   else:
+      return
+   for key in keys:
+      if rest: yield from _field_targets(node[key], rest, path + (key,))
+      else:    yield node, key, path + (key,)
+
+# ----------------------------------------------------------------------------- _encrypted_fields()
+def _encrypted_fields(node, path=()):
+   """ Generator of (container, key, path) of every encrypted field below
+       node, in document order. """
+   items = node.items() if isinstance(node, dict) else enumerate(node) if isinstance(node, list) else ()
+   for key, value in items:
+      if _is_field(value): yield node, key, path + (key,)
+      else:                yield from _encrypted_fields(value, path + (key,))
+
+# ----------------------------------------------------------------------------- _is_field()
+def _is_field(value):
+   """ True if value is an encrypted field, ENC[TOKEN]. """
+   return isinstance(value, str) and value.startswith(FIELD_PREFIX) and value.endswith(FIELD_SUFFIX)
+
+# ----------------------------------------------------------------------------- _open_fields()
+def _open_fields(fields, context):
+   """ Decrypts a list of (field, path) in one batch and returns their
+       values.  Raises ValueError for a field found at another path than
+       the one it was encrypted for. """
+   tokens = [field[len(FIELD_PREFIX):-len(FIELD_SUFFIX)] for field, _ in fields]
+   values = []
+   for clear, (_, path) in zip(decrypt_values(tokens, context, None), fields):
+      stored_path, value = json.loads(clear)
+      if stored_path != list(path): raise ValueError(f"Encrypted field {'.'.join(map(str, path))} was moved from {'.'.join(map(str, stored_path))}")
+      values.append(value)
+   return values
+
+# ----------------------------------------------------------------------------- encrypt_json_fields()
+def encrypt_json_fields(json_data, paths, key_file, cipher="fernet"):
+   """ Returns a copy of a Json document with only the values at the key
+       paths encrypted, in one batch (see encrypt_values), and the rest
+       left as it is.  A path is "database.password", or a tuple of keys;
+       "*" matches every key of an object or item of a list, digits an
+       item of a list.  An encrypted value becomes the string ENC[TOKEN];
+       TOKEN holds the Json of the value and its path, so numbers, lists
+       and objects come back as they were and a value can not be moved
+       to another path.  Values already encrypted are left alone. """
+   json_data = copy_module.deepcopy(json_data)
+   targets   = []
+   for path in paths:
+      pattern = tuple(path.split(".")) if isinstance(path, str) else tuple(path)
+      targets.extend(target for target in _field_targets(json_data, pattern) if not _is_field(target[0][target[1]]))
+   clear  = [json.dumps([list(path), container[key]]) for container, key, path in targets]
+   tokens = encrypt_values(clear, key_file, cipher)
+   for (container, key, _), token in zip(targets, tokens): container[key] = f"{FIELD_PREFIX}{token}{FIELD_SUFFIX}"
+   return json_data
+
+# ----------------------------------------------------------------------------- decrypt_json_fields()
+def decrypt_json_fields(json_data, key_file):
+   """ Returns a copy of a Json document with every encrypted field (see
+       encrypt_json_fields) decrypted, in one batch.  Raises ValueError if
+       a field does not decrypt with the key or was moved. """
+   return _decrypted_copy(json_data, load_key(key_file))
+
+# ----------------------------------------------------------------------------- _decrypted_copy()
+def _decrypted_copy(node, context, path=()):
+   """ Returns a deep copy of node, found at path in its document, with
+       every encrypted field decrypted in one batch. """
+   node    = copy_module.deepcopy(node)
+   targets = list(_encrypted_fields(node, path))
+   values  = _open_fields([(container[key], field_path) for container, key, field_path in targets], context)
+   for (container, key, _), value in zip(targets, values): container[key] = value
+   return node
+
+# ----------------------------------------------------------------------------- class LazyJson
+class LazyJson(collections.abc.Mapping):
+   """ A read-only view of a Json object with encrypted fields (see
+       encrypt_json_fields) that decrypts a field only when it is read,
+       once; fields that are never read are never decrypted.  Objects and
+       lists in it are LazyJson and LazyJsonList views too, decrypted
+       values read-only views (see freeze).  to_dict() returns a plain
+       copy with every field decrypted in one batch. """
+
+   def __init__(self, json_data, key_file, path=()):
+      self._data    = json_data
+      self._context = load_key(key_file)
+      self._path    = path
+      self._values  = {}  # key -> decrypted value or nested view, filled on first read
+
+   def __getitem__(self, key):
+      value = self._values.get(key, self._values)
+      if value is self._values: value = self._values[key] = _lazy_value(self._data[key], self._context, self._path + (key,))
+      return value
+
+   def __iter__(self):
+      return iter(self._data)
+
+   def __len__(self):
+      return len(self._data)
+
+   def __repr__(self):
+      return f"LazyJson({len(self._data)} keys)"
+
+   def to_dict(self):
+      """ Returns a plain, mutable copy with every field decrypted. """
+      return _decrypted_copy(self._data, self._context, self._path)
+
+# ----------------------------------------------------------------------------- class LazyJsonList
+class LazyJsonList(collections.abc.Sequence):
+   """ A read-only view of a Json list, the list counterpart of LazyJson. """
+
+   def __init__(self, json_data, key_file, path=()):
+      self._data    = json_data
+      self._context = load_key(key_file)
+      self._path    = path
+      self._values  = {}
+
+   def __getitem__(self, index):
+      if isinstance(index, slice): return [self[i] for i in range(*index.indices(len(self._data)))]
+      index = range(len(self._data))[index]  # Negative indexes and range check
+      value = self._values.get(index, self._values)
+      if value is self._values: value = self._values[index] = _lazy_value(self._data[index], self._context, self._path + (index,))
+      return value
+
+   def __len__(self):
+      return len(self._data)
+
+   def __repr__(self):
+      return f"LazyJsonList({len(self._data)} items)"
+
+   def to_list(self):
+      """ Returns a plain, mutable copy with every field decrypted. """
+      return _decrypted_copy(self._data, self._context, self._path)
+
+# ----------------------------------------------------------------------------- _lazy_value()
+def _lazy_value(value, context, path):
+   """ Returns what a lazy view hands out for value at path. """
+   if _is_field(value):        return freeze(_open_fields([(value, path)], context)[0])
+   if isinstance(value, dict): return LazyJson(value, context, path)
+   if isinstance(value, list): return LazyJsonList(value, context, path)
+   return value
+
+# ----------------------------------------------------------------------------- freeze()
+def freeze(data):
+   """ Returns a read-only view of parsed Json data: dictionaries become
+       MappingProxyType views and lists become tuples, all the way down. """
+   if isinstance(data, dict): return MappingProxyType({k: freeze(v) for k, v in data.items()})
+   if isinstance(data, list): return tuple(freeze(v) for v in data)
+   return data
+
+# ----------------------------------------------------------------------------- class ConfigCache
+class ConfigCache:
+   """ A bounded LRU cache of parsed Json and config files.  An entry is
+       valid while the file's device, inode, size and mtime are unchanged
+       and it was decrypted with the key currently loaded for key_file. """
+
+   def __init__(self, max_entries=CONFIG_CACHE_SIZE):
+      self.max_entries = max_entries
+      self.hits        = 0
+      self.misses      = 0
+      self.evictions   = 0
+      self._entries    = collections.OrderedDict()
+      self._lock       = threading.Lock()
+
+   def load(self, loader, file_name, key_file=None, *args):
+      """ Returns the frozen result of loader(file_name, key_file, *args),
+          from the cache when the file and the key are unchanged.  Loader
+          exceptions propagate and nothing is cached for them. """
+      stat      = os.stat(file_name)
+      signature = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+      context   = load_key(key_file) if key_file != None else None
+      entry_key = (loader, os.path.abspath(file_name), args, 
+                   context.keys if context != None else None)
+      with self._lock:
+         cached = self._entries.get(entry_key)
+         if cached is not None and cached[0] == signature and cached[1] is context:
+            self._entries.move_to_end(entry_key)
+            self.hits += 1
+            return cached[2]
+         self.misses += 1
+      # Parse outside the lock so slow files do not block other callers.
+      # The signature was taken first, so a file that changes meanwhile 
+      # is simply parsed again on the next call.
+      data = freeze(loader(file_name, context, *args))
+      with self._lock:
+         self._entries[entry_key] = (signature, context, data)
+         self._entries.move_to_end(entry_key)
+         while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+      return data
+
+   def stats(self):
+      """ Returns the hit, miss and eviction counters and the entry count. """
+      with self._lock:
+         return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                 "entries": len(self._entries), "max_entries": self.max_entries}
+
+   def clear(self):
+      """ Drops every entry and resets the counters. """
+      with self._lock:
+         self._entries.clear()
+         self.hits = self.misses = self.evictions = 0
+
+_config_cache = ConfigCache()
+
+# ----------------------------------------------------------------------------- thaw()
+def thaw(data):
+   """ Returns a plain, mutable deep copy of data returned by freeze(). """
+   if isinstance(data, MappingProxyType): return {k: thaw(v) for k, v in data.items()}
+   if isinstance(data, tuple): return [thaw(v) for v in data]
+   return copy_module.copy(data)
+
+# ----------------------------------------------------------------------------- read_json_file_cached()
+def read_json_file_cached(json_file, key_file=None, copy=False):
+   """ Cached read_json_file().  Returns a read-only view of the parsed
+       Json (see freeze) that is shared between callers, or a private
+       mutable copy if copy is True. 
+       If anything goes wrong then an empty dictionary is returned. """
+   ERROR = "\033[31mERROR\033[0m" # Linux-specific colorization
+   try:
+      json_data = _config_cache.load(_load_json_file, json_file, key_file)
+      return thaw(json_data) if copy else json_data
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return {} if copy else MappingProxyType({})
+
+# ----------------------------------------------------------------------------- read_config_file_cached()
+def read_config_file_cached(config_file, key_file=None, delimiter=' ', copy=False):
+   """ Cached read_config_file().  Returns a read-only view of the 
+       key-value pairs that is shared between callers, or a private 
+       mutable copy if copy is True. 
+       If anything goes wrong then an empty dictionary is returned. """
+   ERROR = "\033[31mERROR\033[0m" # Linux-specific colorization
+   try:
+      configs = _config_cache.load(_load_config_file, config_file, key_file, delimiter)
+      return dict(configs) if copy else configs
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return {} if copy else MappingProxyType({})
+
+# ----------------------------------------------------------------------------- config_cache_stats()
+def config_cache_stats():
+   """ Returns the hit/miss counters of the cached readers. """
+   return _config_cache.stats()
+
+# ----------------------------------------------------------------------------- clear_config_cache()
+def clear_config_cache():
+   """ Empties the cache used by the cached readers. """
+   _config_cache.clear()
+
+_async_executor = None
+_async_lock     = threading.Lock()
+_flights_lock   = threading.Lock()
+_flights        = weakref.WeakKeyDictionary()  # loop -> {(loader, abspath, key, args): Future of a read in progress}
+
+# ----------------------------------------------------------------------------- set_async_workers()
+def set_async_workers(max_workers=ASYNC_WORKERS):
+   """ Sets the number of threads the async functions run on.  Work that
+       is already queued finishes on the previous pool. """
+   from concurrent.futures import ThreadPoolExecutor
+   global _async_executor
+   with _async_lock:
+      previous, _async_executor = _async_executor, ThreadPoolExecutor(max_workers, thread_name_prefix="crypto_lib")
+   if previous is not None: previous.shutdown(wait=False)
+
+# ----------------------------------------------------------------------------- _get_async_executor()
+def _get_async_executor():
+   """ Returns the bounded thread pool of the async functions. """
+   from concurrent.futures import ThreadPoolExecutor
+   global _async_executor
+   with _async_lock:
+      if _async_executor is None:
+         _async_executor = ThreadPoolExecutor(ASYNC_WORKERS, thread_name_prefix="crypto_lib")
+      return _async_executor
+
+# ----------------------------------------------------------------------------- _key_token()
+def _key_token(key_file):
+   """ Returns a hashable stand-in for a key_file argument. """
+   if isinstance(key_file, (list, tuple)): return tuple(_key_token(k) for k in key_file)
+   if key_file is None or isinstance(key_file, CryptoContext): return key_file
+   return os.path.abspath(key_file)
+
+# ----------------------------------------------------------------------------- _single_flight()
+async def _single_flight(loader, file_name, key_file, args, timeout):
+   """ Runs loader(file_name, key_file, *args) on the async executor, or
+       joins the run already in flight for the same file, key and args.
+       The run is shielded, so a caller that is cancelled or times out
+       does not cancel it for the others.  Every caller, the one that
+       started the run too, gets its own deep copy, so changes one of them
+       makes to its result are never seen by the others.  Each event loop
+       has its own table of runs, a future is only ever awaited on the
+       loop it belongs to. """
+   import asyncio
+   loop = asyncio.get_running_loop()
+   flight_key = (loader, os.path.abspath(file_name), _key_token(key_file), args)
+   with _flights_lock:
+      flights = _flights.setdefault(loop, {})
+      flight  = flights.get(flight_key)
+      if flight is None:
+         flight = flights[flight_key] = loop.run_in_executor(_get_async_executor(), loader, file_name, key_file, *args)
+         def landed(future):
+            with _flights_lock:
+               if flights.get(flight_key) is future: del flights[flight_key]
+            if not future.cancelled(): future.exception()  # Retrieved, even if nobody waits any more
+         flight.add_done_callback(landed)
+   data = await asyncio.wait_for(asyncio.shield(flight), timeout)
+   return copy_module.deepcopy(data)
+
+# ----------------------------------------------------------------------------- _forget_flights()
+def _forget_flights(file_name):
+   """ Stops later reads of file_name from joining a read that started
+       before it was written, so they see the new contents. """
+   path = os.path.abspath(file_name)
+   with _flights_lock:
+      for flights in _flights.values():
+         for flight_key in [k for k in flights if k[1] == path]: del flights[flight_key]
+
+# ----------------------------------------------------------------------------- class _Commit
+class _Commit:
+   """ Handshake between an async write and its caller.  The rename of the
+       write and the caller giving up both take the lock, so either the
+       rename happens before the caller gives up, or never. """
+
+   def __init__(self):
+      self.lock      = threading.Lock()
+      self.cancelled = False
+      self.committed = False
+
+   def __enter__(self):
+      import asyncio
+      self.lock.acquire()
+      if self.cancelled:
+         self.lock.release()
+         raise asyncio.CancelledError()
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.committed = exc_type is None
+      self.lock.release()
+
+   def cancel(self):
+      """ Stops a rename that has not started.  Returns True if the write
+          was already committed, then the new file is in place. """
+      with self.lock:
+         self.cancelled = True
+         return self.committed
+
+# ----------------------------------------------------------------------------- _write_atomic()
+def _write_atomic(file_name, render, data, key_file, binary, cipher, compression, durability, commit):
+   """ Executor side of the async writers: renders data to bytes, encrypts
+       it if a key is given and atomically replaces file_name.  If the
+       caller gave up meanwhile the temporary file is dropped instead. """
+   with metrics_lib.phase("serialize") as timer:
+      clear_text = render(data)
+      timer.add(len(clear_text))
+   with atomic_lib.atomic_write(file_name, durability=durability, guard=commit) as out_file:
+      if key_file != None: _encrypt_into(out_file, clear_text, load_key(key_file), binary, cipher, compression)
+      else:
+         with metrics_lib.phase("write", len(clear_text)): out_file.write(clear_text)
+
+# ----------------------------------------------------------------------------- _write_async()
+async def _write_async(file_name, render, data, key_file, binary, cipher, compression, durability, timeout):
+   """ Runs _write_atomic() on the async executor and waits for it.  On
+       cancellation or timeout the write is told to abandon its temporary
+       file and the exception is raised to the caller.  A timeout that
+       comes after the rename is not an error any more, the file was
+       written.  A cancellation is always raised; if it comes after the
+       rename the new file stays in place. """
+   import asyncio
+   loop = asyncio.get_running_loop()
+   commit = _Commit()
+   job = loop.run_in_executor(_get_async_executor(), _write_atomic, file_name, render, data, 
+                              key_file, binary, cipher, compression, durability, commit)
+   job.add_done_callback(lambda future: future.cancelled() or future.exception())
+   try:
+      await asyncio.wait_for(asyncio.shield(job), timeout)
+   except asyncio.TimeoutError:
+      if not commit.cancel(): raise
+   except BaseException:
+      commit.cancel()
+      raise
+   finally:
+      _forget_flights(file_name)
+
+# ----------------------------------------------------------------------------- aread_json_file()
+async def aread_json_file(json_file, key_file=None, timeout=None):
+   """ Async read_json_file().  Concurrent reads of the same file share
+       one read and decrypt.  Raises asyncio.TimeoutError if timeout 
+       seconds pass first.
+       If anything else goes wrong then an empty dictionary is returned. """
+   import asyncio
+   ERROR = "\033[31mERROR\033[0m" # Linux-specific colorization
+   try:
+      return await _single_flight(_load_json_file, json_file, key_file, (), timeout)
+   except asyncio.TimeoutError:
+      raise
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return {}
+
+# ----------------------------------------------------------------------------- aread_config_file()
+async def aread_config_file(config_file, key_file=None, delimiter=' ', timeout=None):
+   """ Async read_config_file().  Concurrent reads of the same file share
+       one read and decrypt.  Raises asyncio.TimeoutError if timeout 
+       seconds pass first.
+       If anything else goes wrong then an empty dictionary is returned. """
+   import asyncio
+   ERROR = "\033[31mERROR\033[0m" # Linux-specific colorization
+   try:
+      return await _single_flight(_load_config_file, config_file, key_file, (delimiter,), timeout)
+   except asyncio.TimeoutError:
+      raise
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return {}
+
+# ----------------------------------------------------------------------------- awrite_json_file()
+async def awrite_json_file(json_file, json_data, key_file=None, binary=False, cipher="fernet", timeout=None,
+                           compression=None, durability=None):
+   """ Async write_json_file().  The file is replaced atomically; if the
+       call raises asyncio.TimeoutError after timeout seconds the old
+       file stays as it was.  If the call is cancelled the old file stays
+       too, unless the new one was already in place.  Do not change json_data
+       until the call returns.
+       If successful then True is returned.
+       If anything else goes wrong then False is returned. """
+   import asyncio
+   WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
+   ERROR   = "\033[31mERROR\033[0m"   # /
+   try:
+      if type(json_data) != type({}): raise ValueError("The json_data argument must be of type Python Dictionary")
+      if os.path.isfile(json_file): sys.stderr.write(f"\n{WARNING} -- Json File {json_file} exists and will be overwritten.\n")
+      render = lambda data: json.dumps(data).encode()
+      await _write_async(json_file, render, json_data, key_file, binary, cipher, compression, durability, timeout)
+      return True
+   except asyncio.TimeoutError:
+      raise
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return False
+
+# ----------------------------------------------------------------------------- awrite_config_file()
+async def awrite_config_file(config_file, config_data, key_file=None, delimiter=' ', binary=False, cipher="fernet",
+                             timeout=None, compression=None, durability=None):
+   """ Async write_config_file().  The file is replaced atomically; if the
+       call raises asyncio.TimeoutError after timeout seconds the old
+       file stays as it was.  If the call is cancelled the old file stays
+       too, unless the new one was already in place.
+       If successful then True is returned.
+       If anything else goes wrong then False is returned. """
+   import asyncio
+   WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
+   ERROR   = "\033[31mERROR\033[0m"   # /
+   try:
+      if not type(config_data) == type({}): raise ValueError("The config_data argument must be of type dictionary")
+      if os.path.isfile(config_file): sys.stderr.write(f"\n{WARNING} -- Config file {config_file} exists and will be overwritten\n")
+      render = lambda data: _config_string(data, delimiter).encode()
+      await _write_async(config_file, render, config_data, key_file, binary, cipher, compression, durability, timeout)
+      return True
+   except asyncio.TimeoutError:
+      raise
+   except Exception as e:
+      sys.stderr.write(f"{ERROR} -- \n{str(e)}\n")
+      sys.stderr.flush()
+      return False
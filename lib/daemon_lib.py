@@ -0,0 +1,276 @@
+#
+# This library is the optional encryption daemon of filecryptor.py and its
+# client.  The daemon loads the key files once, imports the cryptography
+# library once and forks a set of warm worker processes that take turns
+# accepting jobs on a local Unix domain socket.  A client hands over an
+# encrypt or decrypt job together with open file descriptors for its input
+# and output, so the data never passes through the socket and the daemon
+# never opens a path on the client's behalf.  A run of filecryptor.py that
+# finds the daemon skips the interpreter work of importing cryptography
+# and loading keys, which is most of its run time for small files.
+#
+# The client side of this library imports only light standard modules, so
+# using it costs next to nothing.  The daemon side imports stream_lib when
+# the daemon starts.
+#
+# Access control: the socket is created mode 0600, and on platforms with
+# SO_PEERCRED both ends check that the other runs as the same user, so
+# neither is the daemon usable by other users nor does the client hand
+# its files to a daemon somebody else put in place.  Keys are named by a
+# fingerprint (SHA-256 with a label), the key material never leaves the
+# daemon or the client.  A daemon that does not hold the requested keys
+# answers STATUS_UNKNOWN_KEY and the client does the work itself.
+#
+# Request, client to daemon, with the file descriptors IN and OUT attached:
+#    REQUEST := VERSION(1) OPERATION(1) FLAGS(1) KEY_COUNT(1) CHUNK_SIZE(4)
+#               CIPHER_LENGTH(1) CIPHER KEY_COUNT * FINGERPRINT(32)
+#    OPERATION is b'E' (encrypt) or b'D' (decrypt), FLAGS holds FLAG_STREAM
+#    and FLAG_BINARY, CIPHER is the cipher name in ASCII.
+#
+# Response, daemon to client:
+#    RESPONSE := STATUS(1) SIZE(8) ERROR_LENGTH(4) ERROR
+#    STATUS uses the exit codes of filecryptor.py, SIZE is the number of
+#    clear text bytes, ERROR a UTF-8 message when STATUS is not 0.
+#
+# Function Prototypes:
+#    default_socket_path()
+#    key_fingerprint(crypto_key)
+#    submit(operation, keys, in_fd, out_fd, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, binary=False,
+#           cipher="fernet", socket_path=None)
+#    serve(keys, socket_path=None, workers=None)
+#
+# The unit tests are in test_daemon_lib.py, run them with pytest.
+
+import os
+import sys
+import socket
+import signal
+import struct
+import hashlib
+
+VERSION            = 1
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # Same as stream_lib.DEFAULT_CHUNK_SIZE
+SOCKET_VARIABLE    = "FILECRYPTOR_SOCKET"  # Environment variable naming the socket
+FLAG_STREAM        = 0x01
+FLAG_BINARY        = 0x02
+STATUS_OK          = 0
+STATUS_UNKNOWN_KEY = 5
+STATUS_ENCRYPT     = 8
+STATUS_DECRYPT     = 9
+REQUEST_TIMEOUT    = 10  # Seconds a worker waits for a connected client to send its request
+LISTEN_BACKLOG     = 128
+
+_REQUEST     = struct.Struct(">BcBBIB")
+_RESPONSE    = struct.Struct(">BQI")
+_PEERCRED    = struct.Struct("3i")
+_FINGERPRINT = 32
+_MAX_REQUEST = _REQUEST.size + 255 + 255 * _FINGERPRINT
+
+# ----------------------------------------------------------------------------- default_socket_path()
+def default_socket_path():
+   """ Returns the socket path: $FILECRYPTOR_SOCKET if set, otherwise a
+       per user name in $XDG_RUNTIME_DIR or /tmp. """
+   if os.environ.get(SOCKET_VARIABLE): return os.environ[SOCKET_VARIABLE]
+   directory = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+   return os.path.join(directory, f"filecryptor-{os.getuid()}.sock")
+
+# ----------------------------------------------------------------------------- key_fingerprint()
+def key_fingerprint(crypto_key):
+   """ Returns the 32 byte fingerprint that names a key to the daemon. """
+   return hashlib.sha256(b"filecryptor daemon\x00" + crypto_key.strip()).digest()
+
+# ----------------------------------------------------------------------------- _same_user()
+def _same_user(connection):
+   """ True if the process at the other end of connection runs as this
+       user.  Without SO_PEERCRED the socket permissions have to do. """
+   if not hasattr(socket, "SO_PEERCRED"): return True
+   credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size)
+   return _PEERCRED.unpack(credentials)[1] == os.getuid()
+
+# ----------------------------------------------------------------------------- _receive()
+def _receive(connection, size):
+   """ Reads exactly size bytes from connection, raises ConnectionError
+       if it closes first. """
+   data = bytearray()
+   while len(data) < size:
+      piece = connection.recv(size - len(data))
+      if not piece: raise ConnectionError("Connection closed by the daemon")
+      data += piece
+   return bytes(data)
+
+# ----------------------------------------------------------------------------- submit()
+def submit(operation, keys, in_fd, out_fd, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, binary=False,
+           cipher="fernet", socket_path=None):
+   """ Runs an 'encrypt' or 'decrypt' job on the daemon, reading from the
+       open file descriptor in_fd and writing to out_fd.  keys is the key
+       ring, primary key first.  Returns (status, size, error), see the
+       response layout above, or None if no daemon is running or it does
+       not hold the keys, in which case nothing has been read or written
+       and the caller should do the work itself. """
+   socket_path = socket_path or default_socket_path()
+   if not os.path.exists(socket_path): return None
+   failed = STATUS_ENCRYPT if operation == "encrypt" else STATUS_DECRYPT
+   flags  = (FLAG_STREAM if stream else 0) | (FLAG_BINARY if binary else 0)
+   name   = cipher.encode("ascii")
+   keys   = tuple(keys)
+   request = _REQUEST.pack(VERSION, operation[0].upper().encode(), flags, len(keys), chunk_size, len(name)) + \
+             name + b"".join(key_fingerprint(key) for key in keys)
+   connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   with connection:
+      try:
+         connection.connect(socket_path)
+         if not _same_user(connection): return None
+         socket.send_fds(connection, [request], [in_fd, out_fd])
+      except OSError:
+         return None  # Stale socket or a daemon that is going away
+      try:
+         status, size, length = _RESPONSE.unpack(_receive(connection, _RESPONSE.size))
+         error = _receive(connection, length).decode("utf-8", "replace")
+      except OSError as e:
+         return (failed, 0, f"Lost the connection to the daemon: {e}")
+   if status == STATUS_UNKNOWN_KEY: return None
+   return (status, size, error)
+
+# ----------------------------------------------------------------------------- _parse_request()
+def _parse_request(message):
+   """ Splits a request into (operation, flags, chunk_size, cipher,
+       fingerprints).  Raises ValueError if it is malformed. """
+   if len(message) < _REQUEST.size: raise ValueError("Short request")
+   version, operation, flags, count, chunk_size, length = _REQUEST.unpack_from(message)
+   if version != VERSION: raise ValueError(f"Unsupported request version {version}")
+   if operation not in (b"E", b"D"): raise ValueError(f"Unknown operation {operation!r}")
+   offset = _REQUEST.size
+   cipher = message[offset:offset + length].decode("ascii")
+   offset += length
+   if count == 0 or len(message) != offset + count * _FINGERPRINT: raise ValueError("Malformed key list")
+   fingerprints = [message[offset + i * _FINGERPRINT:offset + (i + 1) * _FINGERPRINT] for i in range(count)]
+   return operation, flags, chunk_size, cipher, fingerprints
+
+# ----------------------------------------------------------------------------- _run_job()
+def _run_job(operation, flags, chunk_size, cipher, keys, in_fd, out_fd):
+   """ Does the work of one request on the worker, returns the number of
+       clear text bytes. """
+   import stream_lib
+   if operation == b"D": return stream_lib.mmap_decrypt_file(keys, in_fd, out_fd)
+   with open(in_fd, 'rb', closefd=False) as in_file, open(out_fd, 'wb', closefd=False) as out_file:
+      if flags & FLAG_STREAM:
+         return stream_lib.encrypt_stream(keys[0], in_file, out_file, chunk_size, binary=bool(flags & FLAG_BINARY),
+                                          cipher=cipher)
+      clear_text = in_file.read()
+      out_file.write(stream_lib.get_cipher(keys[0]).encrypt(clear_text))
+      return len(clear_text)
+
+# ----------------------------------------------------------------------------- _handle()
+def _handle(connection, ring):
+   """ Serves one connection on a worker: reads the request and its file
+       descriptors, runs the job and sends the response. """
+   connection.settimeout(REQUEST_TIMEOUT)
+   if not _same_user(connection): return
+   message, fds, _, _ = socket.recv_fds(connection, _MAX_REQUEST, 2)
+   if not message and not fds: return  # Probed, e.g. by a second daemon, and closed
+   try:
+      status, size, error = STATUS_DECRYPT, 0, ""
+      operation, flags, chunk_size, cipher, fingerprints = _parse_request(message)
+      if operation == b"E": status = STATUS_ENCRYPT
+      if len(fds) != 2: raise ValueError("Expected an input and an output file descriptor")
+      if any(fingerprint not in ring for fingerprint in fingerprints):
+         status, error = STATUS_UNKNOWN_KEY, "The daemon does not hold the requested key"
+      else:
+         keys = tuple(ring[fingerprint] for fingerprint in fingerprints)
+         connection.settimeout(None)
+         size   = _run_job(operation, flags, chunk_size, cipher, keys, fds[0], fds[1])
+         status = STATUS_OK
+   except Exception as e:
+      error = str(e) or type(e).__name__
+   finally:
+      for fd in fds: os.close(fd)
+   error = error.encode("utf-8")
+   connection.sendall(_RESPONSE.pack(status, size, len(error)) + error)
+
+# ----------------------------------------------------------------------------- _worker()
+def _worker(listener, ring):
+   """ Body of a forked worker process: accepts and serves connections
+       until it is terminated.  Never returns. """
+   signal.signal(signal.SIGTERM, signal.SIG_DFL)
+   signal.signal(signal.SIGINT, signal.SIG_DFL)
+   try:
+      while True:
+         connection, _ = listener.accept()
+         with connection:
+            try:
+               _handle(connection, ring)
+            except Exception as e:
+               sys.stderr.write(f"daemon worker {os.getpid()}: {e}\n")
+               sys.stderr.flush()
+   finally:
+      os._exit(0)
+
+# ----------------------------------------------------------------------------- _bind()
+def _bind(socket_path):
+   """ Returns a listening socket at socket_path, readable and writable by
+       this user only.  A stale socket left by a daemon that died is
+       replaced; raises ValueError if a daemon is listening there. """
+   if os.path.exists(socket_path):
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      with probe:
+         try:
+            probe.connect(socket_path)
+            raise ValueError(f"A daemon is already listening on {socket_path}")
+         except (ConnectionRefusedError, FileNotFoundError):
+            pass
+      if os.lstat(socket_path).st_uid != os.getuid(): raise ValueError(f"{socket_path} belongs to another user")
+      os.remove(socket_path)
+   # Bound and listening under a temporary name first, so that the socket
+   # path never exists without a daemon accepting on it.
+   temp_path = f"{socket_path}.{os.getpid()}"
+   listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   umask = os.umask(0o177)
+   try:
+      listener.bind(temp_path)
+   finally:
+      os.umask(umask)
+   try:
+      listener.listen(LISTEN_BACKLOG)
+      os.rename(temp_path, socket_path)
+   except BaseException:
+      listener.close()
+      if os.path.exists(temp_path): os.remove(temp_path)
+      raise
+   return listener
+
+# ----------------------------------------------------------------------------- serve()
+def serve(keys, socket_path=None, workers=None):
+   """ Runs the daemon in the foreground for the key ring keys until it
+       gets SIGTERM or SIGINT.  workers processes, default one per CPU,
+       are forked up front and replaced if they die.  Removes the socket
+       on the way out.  Raises ValueError if a key is invalid or another
+       daemon holds the socket. """
+   import stream_lib
+   keys = tuple(keys)
+   for key in keys: stream_lib.get_cipher(key)  # Validates the key, warms the cipher cache
+   ring        = {key_fingerprint(key): key for key in keys}
+   socket_path = socket_path or default_socket_path()
+   workers     = workers or os.cpu_count() or 1
+   listener    = _bind(socket_path)
+   children    = set()
+   def stop(signum, frame): raise SystemExit(0)
+   signal.signal(signal.SIGTERM, stop)
+   try:
+      while True:
+         while len(children) < workers:
+            pid = os.fork()
+            if pid == 0: _worker(listener, ring)
+            children.add(pid)
+         pid, _ = os.wait()
+         children.discard(pid)
+   except KeyboardInterrupt:
+      pass
+   finally:
+      for pid in children:
+         try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+         except (ProcessLookupError, ChildProcessError):
+            pass
+      listener.close()
+      if os.path.exists(socket_path): os.remove(socket_path)
@@ -0,0 +1,300 @@
+#
+# This library implements a key store: many named Fernet keys in a single
+# file, e.g. one key per tenant, instead of a key file per key.  A key is
+# found by name with a hash table lookup on disk, so loading one key reads
+# the header, a slot or two and one record, however many keys the store
+# holds; nothing is loaded up front.
+#
+# A store is one file:
+#    STORE   := HEADER SLOT{SLOTS} RECORD*
+#    HEADER  := MAGIC(4) VERSION(1) FLAGS(1) MASTER_ID(8) SALT(16) SLOTS(4) COUNT(4)
+#    SLOT    := DIGEST(16) OFFSET(8) LENGTH(4), all zero for a free slot
+#    RECORD  := NAME_LENGTH(2) NAME KEY, or a Fernet token of that
+#
+#    SLOTS is a power of two, at least twice COUNT, and a name lives in
+#    the slot its DIGEST selects or, taken, the next free one after it
+#    (linear probing).  Without a master key the DIGEST is a salted
+#    SHA-256 of the name and the records are clear text.  With a master
+#    key (FLAG_ENCRYPTED) the DIGEST is an HMAC-SHA256 under the master
+#    key, so the index does not give the names away, every record is a
+#    Fernet token under the master key and MASTER_ID, its fingerprint,
+#    makes a wrong master key fail with a clear message.
+#
+# A store is written whole, atomically (see atomic_lib.py).  Adding keys
+# to an existing store copies its records and slots as they are, without
+# decrypting them, and refuses names that are already taken: a key that
+# has encrypted data must never be replaced by accident.
+#
+# generate_keys() makes and verifies keys for bulk provisioning, it is
+# the work function keygen.py runs on its worker processes.
+#
+# The cryptography library is only imported for stores under a master key
+# and for generate_keys(), so that filecryptor.py can load a key from a
+# clear store without it, e.g. to hand it to the encryption daemon.
+#
+# Function Prototypes:
+#    write_keystore(keystore_file, named_keys, master_key=None, durability=None)
+#    iter_keystore(keystore_file, master_key=None)
+#    load_keystore_key(keystore_file, name, master_key=None)
+#    class KeyStore(keystore_file, master_key=None)
+#       .get(name, default=None)   .names()   .close()
+#    generate_keys(count, check=CHECK_TEXT)
+#
+# The unit tests are in test_keystore_lib.py, run them with pytest.
+
+import os
+import hmac
+import base64
+import struct
+import hashlib
+import threading
+
+MAGIC          = b"\x89HWY"  # Not stream_lib.MAGIC, a store is never taken for a framed file
+FORMAT_VERSION = 1
+FLAG_ENCRYPTED = 0x01
+MIN_SLOTS      = 8
+CHECK_TEXT     = b"Wish you were here."  # Encrypted and decrypted by generate_keys()
+
+_HEADER = struct.Struct(">4sBB8s16sII")
+_SLOT   = struct.Struct(">16sQI")
+_NAME   = struct.Struct(">H")
+_FREE   = bytes(_SLOT.size)
+
+# ----------------------------------------------------------------------------- _master_id()
+def _master_id(master_key):
+   """ Returns the 8 byte fingerprint of a master key, zeros for none. """
+   if master_key is None: return bytes(8)
+   if isinstance(master_key, str): master_key = master_key.encode()
+   return hashlib.sha256(b"filecryptor keystore\x00" + master_key.strip()).digest()[:8]
+
+# ----------------------------------------------------------------------------- _check_key()
+def _check_key(name, key):
+   """ Returns key as bytes.  Raises ValueError if it is not a Fernet key
+       (32 bytes, url-safe base64) or name can not be stored. """
+   if not isinstance(name, str) or not name: raise ValueError("A key name must be a non-empty string")
+   if len(name.encode()) > 0xFFFF: raise ValueError(f"Key name '{name[:40]}...' is too long")
+   key = key.encode() if isinstance(key, str) else bytes(key)
+   try:
+      valid = len(base64.urlsafe_b64decode(key)) == 32
+   except ValueError:
+      valid = False
+   if not valid: raise ValueError(f"Invalid cryptographic key for '{name}'")
+   return key
+
+# ----------------------------------------------------------------------------- class _Codec
+class _Codec:
+   """ The digests and records of one store: clear, or under a master
+       key.  The Fernet cipher is only built for a master key. """
+
+   def __init__(self, salt, master_key=None):
+      if isinstance(master_key, str): master_key = master_key.encode()
+      self.salt       = salt
+      self.master_key = master_key.strip() if master_key is not None else None
+      self.cipher     = None
+      if master_key is not None:
+         from cryptography.fernet import Fernet
+         self.cipher = Fernet(self.master_key)
+
+   def digest(self, name):
+      if self.cipher is None: return hashlib.sha256(self.salt + name.encode()).digest()[:16]
+      return hmac.new(self.master_key, name.encode(), hashlib.sha256).digest()[:16]
+
+   def encode(self, name, key):
+      encoded = name.encode()
+      record  = _NAME.pack(len(encoded)) + encoded + key
+      return record if self.cipher is None else self.cipher.encrypt(record)
+
+   def decode(self, record):
+      if self.cipher is not None: record = self.cipher.decrypt(bytes(record))
+      if len(record) < _NAME.size: raise ValueError("Truncated key store record")
+      (length,) = _NAME.unpack_from(record)
+      if len(record) < _NAME.size + length: raise ValueError("Truncated key store record")
+      return bytes(record[_NAME.size:_NAME.size + length]).decode(), bytes(record[_NAME.size + length:])
+
+# ----------------------------------------------------------------------------- _read_header()
+def _read_header(in_file, keystore_file, master_key):
+   """ Reads and checks the header of an open store and returns
+       (codec, slots, count, size), size being that of the file. """
+   magic, version, flags, master_id, salt, slots, count = _HEADER.unpack(in_file.read(_HEADER.size).ljust(_HEADER.size, b"\0"))
+   if magic != MAGIC: raise ValueError(f"{keystore_file} is not a key store")
+   if version != FORMAT_VERSION: raise ValueError(f"Unsupported key store format version {version}")
+   if flags & FLAG_ENCRYPTED and master_key is None:
+      raise ValueError(f"{keystore_file} is encrypted, a master key is needed")
+   if not flags & FLAG_ENCRYPTED and master_key is not None:
+      raise ValueError(f"{keystore_file} is not encrypted, it takes no master key")
+   if master_id != _master_id(master_key): raise ValueError(f"{keystore_file} was encrypted with a different master key")
+   size = os.fstat(in_file.fileno()).st_size
+   if slots < MIN_SLOTS or slots & (slots - 1) or count > slots // 2 or \
+      size < _HEADER.size + slots * _SLOT.size: raise ValueError(f"{keystore_file} is damaged")
+   return _Codec(salt, master_key), slots, count, size
+
+# ----------------------------------------------------------------------------- _check_record()
+def _check_record(offset, length, slots, size, keystore_file):
+   """ Raises ValueError unless a slot's record lies between the table and
+       the end of the file. """
+   if offset < _HEADER.size + slots * _SLOT.size or offset + length > size:
+      raise ValueError(f"{keystore_file} is damaged")
+
+# ----------------------------------------------------------------------------- _slot_of()
+def _slot_of(digest, slots):
+   """ Returns the home slot of a digest. """
+   return int.from_bytes(digest[:8], "big") & (slots - 1)
+
+# ----------------------------------------------------------------------------- write_keystore()
+def write_keystore(keystore_file, named_keys, master_key=None, durability=None):
+   """ Writes the (name, key) pairs of named_keys to keystore_file, a new
+       store or, if it exists, the store with these keys added.  Keys are
+       Fernet keys as bytes or str.  master_key, a Fernet key, encrypts
+       the store and must match an existing one.  Raises ValueError if a
+       name is given twice or is already in the store, or a key is not
+       valid; nothing is written then.  Returns the number of keys added.
+       The file is replaced atomically, fsync'd as durability says. """
+   entries = []  # (digest, record), existing records first
+   if os.path.exists(keystore_file):
+      with open(keystore_file, 'rb') as in_file:
+         codec, slots, count, size = _read_header(in_file, keystore_file, master_key)
+         table = in_file.read(slots * _SLOT.size)
+         for digest, offset, length in _SLOT.iter_unpack(table):
+            if length == 0: continue
+            _check_record(offset, length, slots, size, keystore_file)
+            in_file.seek(offset)
+            entries.append((offset, digest, in_file.read(length)))
+      entries = [entry[1:] for entry in sorted(entries)]  # Keep the record order
+   else:
+      codec = _Codec(os.urandom(16), master_key)
+   taken = {digest for digest, _ in entries}
+   added = 0
+   for name, key in named_keys:
+      key    = _check_key(name, key)
+      digest = codec.digest(name)
+      if digest in taken: raise ValueError(f"Key '{name}' is already in {keystore_file}")
+      taken.add(digest)
+      entries.append((digest, codec.encode(name, key)))
+      added += 1
+   # Lay out the table, then the records after it
+   slots = MIN_SLOTS
+   while slots < 2 * len(entries): slots *= 2
+   table  = bytearray(slots * _SLOT.size)
+   offset = _HEADER.size + len(table)
+   for digest, record in entries:
+      slot = _slot_of(digest, slots)
+      while table[slot * _SLOT.size:(slot + 1) * _SLOT.size] != _FREE: slot = (slot + 1) & (slots - 1)
+      _SLOT.pack_into(table, slot * _SLOT.size, digest, offset, len(record))
+      offset += len(record)
+   import atomic_lib  # Only writers need it, lookups stay light
+   flags = FLAG_ENCRYPTED if master_key is not None else 0
+   with atomic_lib.atomic_write(keystore_file, durability=durability) as out_file:
+      out_file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, flags, _master_id(master_key), codec.salt, slots, len(entries)))
+      out_file.write(table)
+      for _, record in entries: out_file.write(record)
+   return added
+
+# ----------------------------------------------------------------------------- iter_keystore()
+def iter_keystore(keystore_file, master_key=None):
+   """ Generator that yields the (name, key) pairs of a store in the order
+       they were added.  Raises ValueError on a damaged store or the wrong
+       master key. """
+   with open(keystore_file, 'rb') as in_file:
+      codec, slots, count, size = _read_header(in_file, keystore_file, master_key)
+      locations = sorted((offset, length) for _, offset, length in _SLOT.iter_unpack(in_file.read(slots * _SLOT.size)) if length)
+      for offset, length in locations:
+         _check_record(offset, length, slots, size, keystore_file)
+         in_file.seek(offset)
+         yield codec.decode(in_file.read(length))
+
+# ----------------------------------------------------------------------------- load_keystore_key()
+def load_keystore_key(keystore_file, name, master_key=None):
+   """ Returns the key named name in keystore_file, as bytes.  Raises
+       ValueError if there is no such key.  To load many keys keep a
+       KeyStore open instead, it reads the header only once. """
+   with KeyStore(keystore_file, master_key) as store:
+      key = store.get(name)
+   if key is None: raise ValueError(f"No key named '{name}' in {keystore_file}")
+   return key
+
+# ----------------------------------------------------------------------------- class KeyStore
+class KeyStore:
+   """ An open key store for lookups by name, each one a probe of the
+       hash table and one record read (and decryption, under a master
+       key).  master_key is the Fernet key the store is encrypted with,
+       if it is.  Use as a context manager or call close() when done. """
+
+   def __init__(self, keystore_file, master_key=None):
+      self.keystore_file = keystore_file
+      self._lock = threading.Lock()
+      self._file = open(keystore_file, 'rb')
+      try:
+         self._codec, self._slots, self._count, self._size = _read_header(self._file, keystore_file, master_key)
+      except Exception:
+         self._file.close()
+         raise
+
+   # --- Context manager support
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      self.close()
+
+   # --- Public interface
+   def get(self, name, default=None):
+      """ Returns the key named name, as bytes, or default.  Raises
+          ValueError if the store is damaged. """
+      digest = self._codec.digest(name)
+      slot   = _slot_of(digest, self._slots)
+      with self._lock:
+         for _ in range(self._slots):  # A sound table is never full, a damaged one must not loop forever
+            self._file.seek(_HEADER.size + slot * _SLOT.size)
+            stored, offset, length = _SLOT.unpack(self._file.read(_SLOT.size))
+            if length == 0: return default
+            if stored == digest: break
+            slot = (slot + 1) & (self._slots - 1)
+         else:
+            raise ValueError(f"{self.keystore_file} is damaged")
+         _check_record(offset, length, self._slots, self._size, self.keystore_file)
+         self._file.seek(offset)
+         record = self._file.read(length)
+      stored_name, key = self._codec.decode(record)
+      if stored_name != name: return default  # Digest collision, practically impossible
+      return key
+
+   def __contains__(self, name):
+      return self.get(name) is not None
+
+   def __len__(self):
+      return self._count
+
+   def __getitem__(self, name):
+      key = self.get(name)
+      if key is None: raise KeyError(name)
+      return key
+
+   def names(self):
+      """ Returns all key names, reading (and decrypting) every record. """
+      with self._lock:
+         self._file.seek(_HEADER.size)
+         locations = sorted((offset, length) for _, offset, length in _SLOT.iter_unpack(self._file.read(self._slots * _SLOT.size)) if length)
+         records = []
+         for offset, length in locations:
+            _check_record(offset, length, self._slots, self._size, self.keystore_file)
+            self._file.seek(offset)
+            records.append(self._file.read(length))
+      return [self._codec.decode(record)[0] for record in records]
+
+   def close(self):
+      """ Closes the store. """
+      self._file.close()
+
+# ----------------------------------------------------------------------------- generate_keys()
+def generate_keys(count, check=CHECK_TEXT):
+   """ Returns a list of count new Fernet keys, each verified by
+       encrypting and decrypting check with it.  Raises ValueError if a
+       key fails, which would mean a broken cryptography installation. """
+   from cryptography.fernet import Fernet
+   keys = []
+   for _ in range(count):
+      key    = Fernet.generate_key()
+      fernet = Fernet(key)
+      if fernet.decrypt(fernet.encrypt(check)) != check: raise ValueError("Generated key FAILED validation")
+      keys.append(key)
+   return keys
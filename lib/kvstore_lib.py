@@ -0,0 +1,342 @@
+#
+# This library implements an encrypted key-value store for large secret
+# configurations.  Every record is encrypted on its own, so reading or
+# writing one key costs a single decryption or encryption no matter how
+# many keys the store holds, instead of decrypting and re-encrypting the
+# whole file the way read_config_file() and write_config_file() must.
+#
+# A store is two files:
+#    STORE      := MAGIC(4) VERSION(1) STORE_ID(16) KEY_ID(8) EPOCH(16) RECORD*
+#    RECORD     := LENGTH(4) TOKEN(LENGTH)
+#    TOKEN      := Fernet( OP(1) KEY_LENGTH(4) STORE_ID(16) KEY VALUE )
+#    STORE.idx  := MAGIC(4) VERSION(1) STORE_ID(16) EPOCH(16) ENTRY*
+#    ENTRY      := DIGEST(16) OFFSET(8) LENGTH(4) OP(1) MAC(16)
+#
+#    Updates and deletes are appended, the last record for a key wins.
+#    The index maps a keyed digest (HMAC-SHA256 under the store key) of
+#    each key to the offset of its latest record, so key names are not
+#    readable from the index.  A missing, stale or short index is rebuilt
+#    or completed from the store on open.  compact() rewrites only the
+#    live records, under a new EPOCH, and swaps both files in atomically.
+#
+#    Every record carries its key and the STORE_ID, so a record can not be
+#    moved to another key or another store.  The index is authenticated:
+#    MAC is a keyed BLAKE2b chain under a key derived from the store key,
+#    over the previous MAC (for the first entry, STORE_ID and EPOCH) and
+#    DIGEST OFFSET LENGTH OP.  Entries must follow the records one after
+#    the other and lie inside the store.  From the first entry that does
+#    not, e.g. an index edited to point a key back to one of its older
+#    records, or one that got ahead of the store in a crash with sync
+#    False, the index is dropped and completed from the store instead.
+#    What can not be detected is the whole store set back to an older
+#    copy of both files.
+#
+# Import and export use the flat config format of crypto_lib, so a store
+# can be created from, and turned back into, a regular config file.
+#
+# Function Prototypes:
+#    EncryptedKVStore(store_file, key_file, sync=False, compact_ratio=0.5)
+#       .get(key, default=None)   .put(key, value)   .delete(key)
+#       .keys()   .items()   .compact()   .close()
+#       .import_config(config_file, key_file=None, delimiter=' ')
+#       .export_config(config_file, key_file=None, delimiter=' ')
+#
+# The unit tests are in test_kvstore_lib.py, run them with pytest.
+
+import os
+import hmac
+import shutil
+import struct
+import hashlib
+import threading
+import atomic_lib
+import crypto_lib
+import stream_lib
+from cryptography.fernet import InvalidToken
+
+MAGIC          = b"\x89HWK"
+INDEX_MAGIC    = b"\x89HWI"
+FORMAT_VERSION = 2
+OP_PUT         = 1
+OP_DELETE      = 2
+MIN_COMPACT    = 1024 * 1024  # Never auto compact stores with less garbage
+
+_HEADER       = struct.Struct(">4sB16s8s16s")
+_INDEX_HEADER = struct.Struct(">4sB16s16s")
+_ENTRY        = struct.Struct(">16sQIB16s")
+_MACED        = _ENTRY.size - 16  # The part of an entry its MAC covers
+_LENGTH       = struct.Struct(">I")
+_RECORD       = struct.Struct(">BI16s")
+
+# ----------------------------------------------------------------------------- class EncryptedKVStore
+class EncryptedKVStore:
+   """ An encrypted key-value store with O(1) decryptions per get and O(1)
+       encryptions per put or delete.  Keys and values are strings.
+       key_file may be a key file name or a crypto_lib.CryptoContext.
+       Use as a context manager or call close() when done. """
+
+   def __init__(self, store_file, key_file, sync=False, compact_ratio=0.5):
+      self.store_file    = store_file
+      self.index_file    = f"{store_file}.idx"
+      self.sync          = sync
+      self.compact_ratio = compact_ratio
+      self._context      = crypto_lib.load_key(key_file)
+      self._key_id       = stream_lib.key_id(self._context.crypto_key)
+      self._mac_key      = hmac.digest(self._context.crypto_key, b"filecryptor kvstore index", "sha256")
+      self._index        = {}     # digest -> (offset, length) of the latest PUT
+      self._live_bytes   = 0
+      self._lock         = threading.RLock()
+      self._open()
+
+   # --- Context manager support
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      self.close()
+
+   # --- Internals
+   def _digest(self, key):
+      return hmac.new(self._context.crypto_key, key.encode(), hashlib.sha256).digest()[:16]
+
+   def _chain(self, previous, entry):
+      return hashlib.blake2b(previous + entry, digest_size=16, key=self._mac_key).digest()
+
+   def _open(self):
+      """ Opens or creates the store and loads the index, completing it
+          from the store if the store has records the index lacks. """
+      if not os.path.isfile(self.store_file):
+         self._create(self.store_file, self.index_file, os.urandom(16), os.urandom(16))
+      self._data = open(self.store_file, 'r+b')
+      magic, version, store_id, kid, epoch = _HEADER.unpack(self._data.read(_HEADER.size).ljust(_HEADER.size, b"\0"))
+      if magic != MAGIC: raise ValueError(f"{self.store_file} is not an encrypted key-value store")
+      if version != FORMAT_VERSION: raise ValueError(f"Unsupported store format version {version}")
+      if kid != self._key_id: raise ValueError(f"{self.store_file} was encrypted with a different key")
+      self._store_id = store_id
+      self._epoch    = epoch
+      covered = self._load_index()
+      self._index_out = open(self.index_file, 'ab')
+      self._data.seek(0, os.SEEK_END)
+      if self._data.tell() > covered: self._scan(covered)
+
+   def _create(self, store_file, index_file, store_id, epoch):
+      with open(store_file, 'wb') as f: f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, store_id, self._key_id, epoch))
+      with open(index_file, 'wb') as f: f.write(_INDEX_HEADER.pack(INDEX_MAGIC, FORMAT_VERSION, store_id, epoch))
+
+   def _load_index(self):
+      """ Loads the index file and returns the store offset it covers.
+          A foreign or damaged index is discarded and started afresh, an
+          index is cut at the first entry that fails its MAC, is out of
+          order or points past the end of the store. """
+      covered = _HEADER.size
+      self._mac = self._store_id + self._epoch
+      try:
+         with open(self.index_file, 'rb') as f: index_data = f.read()
+         magic, version, store_id, epoch = _INDEX_HEADER.unpack_from(index_data)
+         if magic != INDEX_MAGIC or version != FORMAT_VERSION or store_id != self._store_id or epoch != self._epoch:
+            raise ValueError()
+      except (OSError, struct.error, ValueError):
+         with open(self.index_file, 'wb') as f: f.write(_INDEX_HEADER.pack(INDEX_MAGIC, FORMAT_VERSION, self._store_id, self._epoch))
+         return covered
+      store_size = os.fstat(self._data.fileno()).st_size
+      end = _INDEX_HEADER.size
+      while end + _ENTRY.size <= len(index_data):
+         digest, offset, length, op, mac = _ENTRY.unpack_from(index_data, end)
+         expected = self._chain(self._mac, index_data[end:end + _MACED])
+         if not hmac.compare_digest(mac, expected) or offset != covered or \
+            offset + _LENGTH.size + length > store_size: break
+         self._apply(digest, offset, length, op)
+         self._mac = expected
+         covered   = offset + _LENGTH.size + length
+         end      += _ENTRY.size
+      if end != len(index_data):
+         with open(self.index_file, 'r+b') as f: f.truncate(end)
+      return covered
+
+   def _scan(self, offset):
+      """ Decrypts the records from offset to the end of the store and
+          adds them to the index, e.g. after a crash between the store
+          write and the index write.  A torn last record, or one that does
+          not decrypt or belong to this store, is cut off with all after
+          it. """
+      self._data.seek(offset)
+      while True:
+         length = self._data.read(_LENGTH.size)
+         if len(length) < _LENGTH.size: break
+         (token_length,) = _LENGTH.unpack(length)
+         token = self._data.read(token_length)
+         if len(token) < token_length: break
+         try:
+            op, key, _ = self._decode(token)
+         except ValueError:
+            break
+         self._append_index(self._digest(key), offset, token_length, op)
+         offset += _LENGTH.size + token_length
+      self._data.truncate(offset)
+      self._index_out.flush()
+
+   def _apply(self, digest, offset, length, op):
+      old = self._index.pop(digest, None)
+      if old is not None: self._live_bytes -= _LENGTH.size + old[1]
+      if op == OP_PUT:
+         self._index[digest] = (offset, length)
+         self._live_bytes += _LENGTH.size + length
+
+   def _append_index(self, digest, offset, length, op):
+      entry = _ENTRY.pack(digest, offset, length, op, bytes(16))[:_MACED]
+      self._mac = self._chain(self._mac, entry)
+      self._index_out.write(entry + self._mac)
+      self._apply(digest, offset, length, op)
+
+   def _decode(self, token):
+      """ Returns (op, key, value) of a record token.  Raises ValueError
+          if it does not decrypt or belongs to another store. """
+      try:
+         record = self._context.decrypt(token)
+         op, key_length, store_id = _RECORD.unpack_from(record)
+      except (InvalidToken, struct.error):
+         raise ValueError(f"{self.store_file} has a damaged record") from None
+      if store_id != self._store_id: raise ValueError(f"{self.store_file} has a record of another store")
+      key = record[_RECORD.size:_RECORD.size + key_length].decode()
+      return op, key, record[_RECORD.size + key_length:].decode()
+
+   def _append(self, op, key, value=""):
+      encoded_key = key.encode()
+      token = self._context.encrypt(_RECORD.pack(op, len(encoded_key), self._store_id) + encoded_key + value.encode())
+      self._data.seek(0, os.SEEK_END)
+      offset = self._data.tell()
+      self._data.write(_LENGTH.pack(len(token)) + token)
+      self._data.flush()
+      if self.sync: os.fsync(self._data.fileno())
+      self._append_index(self._digest(key), offset, len(token), op)
+      self._index_out.flush()
+
+   def _read(self, offset, length):
+      self._data.seek(offset)
+      data = self._data.read(_LENGTH.size + length)
+      if len(data) != _LENGTH.size + length or _LENGTH.unpack_from(data)[0] != length:
+         raise ValueError(f"{self.store_file} is damaged")
+      return self._decode(data[_LENGTH.size:])
+
+   # --- Public interface
+   def get(self, key, default=None):
+      """ Returns the value of key, or default.  One decryption.  Raises
+          ValueError if the record the index points to is not the key's. """
+      key = str(key)
+      with self._lock:
+         location = self._index.get(self._digest(key))
+         if location is None: return default
+         op, stored_key, value = self._read(*location)
+      if stored_key != key: raise ValueError(f"{self.store_file} has a record under the wrong key")
+      return value
+
+   def put(self, key, value):
+      """ Sets key to value.  One encryption, appended to the store. """
+      with self._lock:
+         self._append(OP_PUT, str(key), str(value))
+         self._maybe_compact()
+
+   def delete(self, key):
+      """ Removes key.  Returns True if it was present. """
+      key = str(key)
+      with self._lock:
+         if self._digest(key) not in self._index: return False
+         self._append(OP_DELETE, key)
+         self._maybe_compact()
+         return True
+
+   def __contains__(self, key):
+      with self._lock: return self._digest(str(key)) in self._index
+
+   def __len__(self):
+      with self._lock: return len(self._index)
+
+   def __getitem__(self, key):
+      value = self.get(key, self)
+      if value is self: raise KeyError(key)
+      return value
+
+   def __setitem__(self, key, value):
+      self.put(key, value)
+
+   def items(self):
+      """ Returns all (key, value) pairs, decrypting every live record. """
+      with self._lock:
+         return [self._read(offset, length)[1:] for offset, length in sorted(self._index.values())]
+
+   def keys(self):
+      """ Returns all keys, decrypting every live record. """
+      return [key for key, _ in self.items()]
+
+   def garbage_bytes(self):
+      """ Returns the bytes taken by overwritten or deleted records. """
+      with self._lock:
+         self._data.seek(0, os.SEEK_END)
+         return self._data.tell() - _HEADER.size - self._live_bytes
+
+   def _maybe_compact(self):
+      garbage = self.garbage_bytes()
+      if self.compact_ratio and garbage >= MIN_COMPACT and garbage > self.compact_ratio * (garbage + self._live_bytes):
+         self.compact()
+
+   def compact(self):
+      """ Rewrites the live records into fresh files and atomically
+          replaces the store and its index.  The records are copied as
+          they are, nothing is decrypted. """
+      with self._lock:
+         store_tmp, index_tmp = atomic_lib.temp_name(self.store_file), atomic_lib.temp_name(self.index_file)
+         try:
+            epoch = os.urandom(16)
+            self._create(store_tmp, index_tmp, self._store_id, epoch)
+            shutil.copymode(self.store_file, store_tmp)
+            shutil.copymode(self.store_file, index_tmp)
+            index = {}
+            mac   = self._store_id + epoch
+            with open(store_tmp, 'ab') as data_out, open(index_tmp, 'ab') as index_out:
+               offset = _HEADER.size
+               for digest, (old_offset, length) in sorted(self._index.items(), key=lambda item: item[1]):
+                  self._data.seek(old_offset)
+                  data_out.write(self._data.read(_LENGTH.size + length))
+                  entry = _ENTRY.pack(digest, offset, length, OP_PUT, bytes(16))[:_MACED]
+                  mac   = self._chain(mac, entry)
+                  index_out.write(entry + mac)
+                  index[digest] = (offset, length)
+                  offset += _LENGTH.size + length
+               for f in (data_out, index_out):
+                  f.flush()
+                  os.fsync(f.fileno())
+         except BaseException:
+            for name in (store_tmp, index_tmp):
+               if os.path.exists(name): os.remove(name)
+            raise
+         self._data.close()
+         self._index_out.close()
+         # The store goes first; should we stop in between, the old index
+         # no longer matches the epoch and is rebuilt on the next open.
+         os.replace(store_tmp, self.store_file)
+         os.replace(index_tmp, self.index_file)
+         self._data       = open(self.store_file, 'r+b')
+         self._index_out  = open(self.index_file, 'ab')
+         self._epoch      = epoch
+         self._mac        = mac
+         self._index      = index
+         self._live_bytes = offset - _HEADER.size
+
+   def import_config(self, config_file, key_file=None, delimiter=' '):
+      """ Puts every key-value pair of a crypto_lib config file into the
+          store.  Returns the number of keys imported. """
+      configs = crypto_lib.read_config_file(config_file, key_file, delimiter)
+      for key, value in configs.items(): self.put(key, value)
+      return len(configs)
+
+   def export_config(self, config_file, key_file=None, delimiter=' '):
+      """ Writes the whole store as a crypto_lib config file.
+          Returns True on success, like write_config_file(). """
+      return crypto_lib.write_config_file(config_file, dict(self.items()), key_file, delimiter)
+
+   def close(self):
+      """ Flushes and closes the store. """
+      with self._lock:
+         if self._data.closed: return
+         self._index_out.close()
+         self._data.close()
@@ -0,0 +1,199 @@
+#
+# This library is the instrumentation surface of the cryptographic
+# libraries.  The hot paths time their phases (key_load, read, decrypt,
+# parse, serialize, encrypt, write) and count the bytes each phase
+# handled, and hand every measurement to the hooks registered here.
+# Turning bytes into text is part of parse: the config parser decodes a
+# block at a time while it parses, and json.loads() takes bytes.
+#
+# With no hook registered, which is the default, phase() returns a shared
+# do-nothing context manager, so the instrumented code pays one list check
+# per phase and nothing else.
+#
+# A hook is any callable hook(operation, phase, seconds, size).  The
+# operation is the outermost operation() in effect, e.g. 'read_json_file',
+# so the same phase can be told apart per API.  MetricsCollector is a ready
+# made hook that aggregates calls, seconds and bytes per operation and
+# phase and exports them as Json or in the Prometheus text format.
+#
+# Note: decrypting a memory mapped file (stream_lib.mmap_decrypt_file)
+# pages the file in while it is decrypted, so for those the disk time is
+# part of decrypt and read covers only opening and mapping the file.  HMAC
+# verification is always part of decrypt.
+#
+# Function Prototypes:
+#    add_hook(hook)
+#    remove_hook(hook)
+#    enabled()
+#    phase(name, size=0)
+#    operation(name)
+#    record(name, seconds, size=0)
+#    class MetricsCollector()
+#
+# The unit tests are in test_metrics_lib.py, run them with pytest.
+
+import time
+import threading
+import contextvars
+
+PHASES = ("key_load", "read", "decrypt", "parse", "serialize", "encrypt", "write")
+
+_hooks     = []  # Registered hooks, replaced (never changed in place) so readers need no lock
+_operation = contextvars.ContextVar("metrics_lib_operation", default="")
+_lock      = threading.Lock()
+
+# ----------------------------------------------------------------------------- add_hook()
+def add_hook(hook):
+   """ Registers hook(operation, phase, seconds, size) for every measurement. """
+   global _hooks
+   with _lock: _hooks = _hooks + [hook]
+
+# ----------------------------------------------------------------------------- remove_hook()
+def remove_hook(hook):
+   """ Unregisters a hook added with add_hook(); unknown hooks are ignored. """
+   global _hooks
+   with _lock: _hooks = [h for h in _hooks if h is not hook]
+
+# ----------------------------------------------------------------------------- enabled()
+def enabled():
+   """ True if at least one hook is registered. """
+   return len(_hooks) > 0
+
+# ----------------------------------------------------------------------------- record()
+def record(name, seconds, size=0):
+   """ Hands one measurement of phase name to every hook.  A failing hook
+       must not break the operation it measures, so exceptions are dropped. """
+   operation = _operation.get()
+   for hook in _hooks:
+      try:
+         hook(operation, name, seconds, size)
+      except Exception:
+         pass
+
+# ----------------------------------------------------------------------------- class _Phase
+class _Phase:
+   """ Times one phase; add() counts the bytes it handled. """
+   __slots__ = ("name", "size", "start")
+
+   def __init__(self, name, size):
+      self.name = name
+      self.size = size
+
+   def add(self, size):
+      self.size += size
+
+   def __enter__(self):
+      self.start = time.perf_counter()
+      return self
+
+   def __exit__(self, *exc_info):
+      record(self.name, time.perf_counter() - self.start, self.size)
+      return False
+
+# ----------------------------------------------------------------------------- class _NoPhase
+class _NoPhase:
+   """ The do-nothing stand in for _Phase and operation() with no hooks. """
+   __slots__ = ()
+
+   def add(self, size):
+      pass
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc_info):
+      return False
+
+_NO_PHASE = _NoPhase()
+
+# ----------------------------------------------------------------------------- phase()
+def phase(name, size=0):
+   """ Returns a context manager that times phase name, one of PHASES.
+       Bytes may be given up front or counted with add() on the result. """
+   if not _hooks: return _NO_PHASE
+   return _Phase(name, size)
+
+# ----------------------------------------------------------------------------- class _Operation
+class _Operation:
+   """ Names the operation that phases inside it are reported under.
+       Nested operations keep the outermost name. """
+   __slots__ = ("name", "token")
+
+   def __init__(self, name):
+      self.name  = name
+      self.token = None
+
+   def __enter__(self):
+      if not _operation.get(): self.token = _operation.set(self.name)
+      return self
+
+   def __exit__(self, *exc_info):
+      if self.token is not None: _operation.reset(self.token)
+      return False
+
+# ----------------------------------------------------------------------------- operation()
+def operation(name):
+   """ Returns a context manager naming the operation of the phases in it. """
+   if not _hooks: return _NO_PHASE
+   return _Operation(name)
+
+# ----------------------------------------------------------------------------- class MetricsCollector
+class MetricsCollector:
+   """ A hook that aggregates calls, seconds, bytes and the slowest call
+       per (operation, phase).  Register it with add_hook(collector). """
+
+   def __init__(self):
+      self._lock  = threading.Lock()
+      self._stats = {}
+
+   def __call__(self, operation, name, seconds, size):
+      with self._lock:
+         stats = self._stats.get((operation, name))
+         if stats is None: stats = self._stats[(operation, name)] = {"calls": 0, "seconds": 0.0, "bytes": 0, "max_seconds": 0.0}
+         stats["calls"]      += 1
+         stats["seconds"]    += seconds
+         stats["bytes"]      += size
+         stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+   def snapshot(self):
+      """ Returns a list of dictionaries, one per operation and phase, in
+          PHASES order within each operation. """
+      order = {name: index for index, name in enumerate(PHASES)}
+      with self._lock:
+         items = sorted(self._stats.items(), key=lambda item: (item[0][0], order.get(item[0][1], len(order)), item[0][1]))
+         return [dict(operation=operation, phase=name, **stats) for (operation, name), stats in items]
+
+   def reset(self):
+      """ Forgets everything collected so far. """
+      with self._lock: self._stats.clear()
+
+   def to_json(self):
+      """ Returns the snapshot as a Json string. """
+      import json
+      return json.dumps(self.snapshot(), indent=2)
+
+   def to_prometheus(self, prefix="filecryptor"):
+      """ Returns the snapshot in the Prometheus text exposition format. """
+      metrics = (("phase_calls_total", "calls", "Number of times the phase ran"),
+                 ("phase_seconds_total", "seconds", "Seconds spent in the phase"),
+                 ("phase_bytes_total", "bytes", "Bytes handled by the phase"),
+                 ("phase_max_seconds", "max_seconds", "Slowest single run of the phase"))
+      snapshot = self.snapshot()
+      lines = []
+      for metric, field, text in metrics:
+         kind = "gauge" if field == "max_seconds" else "counter"
+         lines.append(f"# HELP {prefix}_{metric} {text}")
+         lines.append(f"# TYPE {prefix}_{metric} {kind}")
+         for stats in snapshot:
+            operation = stats["operation"].replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'{prefix}_{metric}{{operation="{operation}",phase="{stats["phase"]}"}} {stats[field]}')
+      return "\n".join(lines) + "\n"
+
+   def to_text(self):
+      """ Returns the snapshot as a table for people. """
+      lines = [f"{'OPERATION':<24}{'PHASE':<12}{'CALLS':>8}{'TOTAL ms':>12}{'MAX ms':>10}{'BYTES':>14}{'MB/s':>10}"]
+      for stats in self.snapshot():
+         rate = f"{stats['bytes'] / stats['seconds'] / 1e6:10.1f}" if stats["bytes"] and stats["seconds"] else f"{'-':>10}"
+         lines.append(f"{stats['operation'] or '-':<24}{stats['phase']:<12}{stats['calls']:>8}"
+                      f"{stats['seconds'] * 1000:12.3f}{stats['max_seconds'] * 1000:10.3f}{stats['bytes']:>14}{rate}")
+      return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+#
+# This library rotates encrypted files to a new key.  It takes a key ring,
+# the new primary key first followed by the old keys.  Every file is
+# decrypted with whichever key of the ring wrote it and encrypted again
+# under the primary key, keeping its format: legacy single token, or framed
+# with the same chunk size, token encoding, cipher and compression.  Files
+# that are already under the primary key are skipped without decrypting
+# them; framed files name their key in the header, for legacy tokens only
+# the HMAC is checked (see stream_lib.token_signed_by).
+#
+# Files are replaced atomically (see atomic_lib.py) and are rotated on a
+# pool of workers.  An optional journal records every finished file, so an
+# interrupted rotation of millions of files can be restarted with the same
+# journal and carries on where it stopped.  Journal lines are held in
+# memory and only written once the directories of their files have been
+# fsync'd together (group commit), so the journal never lists a file as
+# done whose new version could still be lost.
+#
+# Journal layout, a text file:
+#    # filecryptor rotate KEY_ID        <- hex key id of the primary key
+#    STATUS<tab>"SOURCE_FILE"           <- one line per file, name as Json
+#
+# Function Prototypes:
+#    key_is_current(crypto_key, source_file, header=UNREAD)
+#    rotate_file(keys, source_file, durability=None)
+#    class RotationJournal(journal_file, crypto_key, group=None)
+#    rotate_files(keys, sources, journal_file=None, extension="enc", jobs=1, executor="process", durability=None)
+#
+# The unit tests are in test_rotate_lib.py, run them with pytest.
+
+import os
+import json
+import batch_lib
+import atomic_lib
+import cipher_lib
+import stream_lib
+import compress_lib
+
+JOURNAL_SYNC = 1000      # Journal entries between fsync() calls
+UNREAD       = object()  # key_is_current() reads the header itself
+
+# ----------------------------------------------------------------------------- key_is_current()
+def key_is_current(crypto_key, source_file, header=UNREAD):
+   """ True if source_file is already encrypted with crypto_key.  Reads
+       the header of a framed file, or checks only the HMAC of a legacy
+       token; nothing is decrypted.  header is what
+       stream_lib.read_header() returned for source_file, if the caller
+       has read it already. """
+   if header is UNREAD: header = stream_lib.read_header(source_file)
+   if header is not None: return header["key_id"] == stream_lib.key_id(crypto_key)
+   with open(source_file, 'rb') as in_file: token = in_file.read().strip()
+   return stream_lib.token_signed_by(crypto_key, token)
+
+# ----------------------------------------------------------------------------- rotate_file()
+def rotate_file(keys, source_file, durability=None):
+   """ Re-encrypts one file in place under the primary key of the key ring
+       keys.  Returns a result dictionary like batch_lib.process_file() with
+       an extra action: 'rotated', or 'current' if nothing had to be done.
+       Never raises; on failure the file is left exactly as it was.  The
+       new version is written with durability, see atomic_lib. """
+   keys    = tuple(keys)
+   primary = keys[0]
+   result  = {"source": source_file, "output": source_file, "status": batch_lib.STATUS_OK,
+              "error": "", "action": "current"}
+   try:
+      if not os.path.isfile(source_file):
+         result["status"] = batch_lib.STATUS_MISSING
+         raise ValueError(f"Unable to locate source file {source_file}")
+      header = stream_lib.read_header(source_file)
+      if key_is_current(primary, source_file, header): return result
+      with open(source_file, 'rb') as in_file, atomic_lib.atomic_write(source_file, durability=durability) as out_file:
+         if header is None:
+            clear_text = stream_lib.get_cipher(keys).decrypt(in_file.read().strip())
+            out_file.write(stream_lib.get_cipher(primary).encrypt(clear_text))
+         else:
+            chunks = stream_lib.iter_decrypt_stream(keys, in_file)
+            compression = None
+            if header["compression"]: compression = compress_lib.compression_name(header["compression"])
+            stream_lib.encrypt_iterable(primary, chunks, out_file, header["chunk_size"], binary=header["binary"],
+                                        cipher=cipher_lib.cipher_name(header["cipher"]), compression=compression)
+      result["action"] = "rotated"
+   except Exception as e:
+      batch_lib.record_error(result, e, False)
+   return result
+
+# ----------------------------------------------------------------------------- class RotationJournal
+class RotationJournal:
+   """ Append only record of the files a rotation to crypto_key has
+       finished.  Files that failed are recorded too but are not counted
+       as done, so they are tried again when the rotation is resumed.
+       Lines are kept in memory until sync(), which commits the group
+       (atomic_lib.GroupCommit) first and only then writes and fsyncs
+       them. """
+
+   def __init__(self, journal_file, crypto_key, group=None):
+      self.journal_file = journal_file
+      self.group        = group
+      self.done         = set()
+      self._pending     = []  # Lines not written yet
+      marker = f"# filecryptor rotate {stream_lib.key_id(crypto_key).hex()}\n"
+      exists = os.path.isfile(journal_file) and os.path.getsize(journal_file) > 0
+      if exists:
+         with open(journal_file, 'r') as in_file:
+            if in_file.readline() != marker:
+               raise ValueError(f"Journal {journal_file} belongs to a rotation to another key")
+            for line in in_file:
+               if not line.endswith("\n"): break  # Torn last line of an interrupted run
+               status, name = line.rstrip("\n").split("\t", 1)
+               if int(status) == batch_lib.STATUS_OK: self.done.add(json.loads(name))
+      self._file = open(journal_file, 'a')
+      if not exists: self._file.write(marker)
+
+   def __contains__(self, source_file):
+      return os.path.abspath(source_file) in self.done
+
+   def record(self, result):
+      """ Notes the outcome of one file.  It reaches the journal with the
+          next sync(), done every JOURNAL_SYNC entries. """
+      name = os.path.abspath(result["source"])
+      self._pending.append(f"{result['status']}\t{json.dumps(name)}\n")
+      if result["status"] == batch_lib.STATUS_OK: self.done.add(name)
+      if len(self._pending) >= JOURNAL_SYNC: self.sync()
+
+   def sync(self):
+      """ Makes the files recorded so far durable, and then writes and
+          fsyncs their journal lines. """
+      if self.group is not None: self.group.commit()
+      self._file.write("".join(self._pending))
+      self._file.flush()
+      os.fsync(self._file.fileno())
+      self._pending = []
+
+   def close(self):
+      """ Flushes the journal to disk and closes it. """
+      if self._file.closed: return
+      self.sync()
+      self._file.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc_info):
+      self.close()
+
+# ----------------------------------------------------------------------------- rotate_files()
+def rotate_files(keys, sources, journal_file=None, extension="enc", jobs=1, executor="process", durability=None):
+   """ Generator that rotates every encrypted file named by sources (see
+       batch_lib.expand_sources) to the primary key of keys on jobs
+       workers, yielding one result dictionary per file in source order.
+       With a journal_file, files it lists as done are skipped and every
+       result is recorded, so an interrupted rotation can be resumed.
+       durability works as in batch_lib.process_files(). """
+   keys    = tuple(keys)
+   group   = atomic_lib.GroupCommit(durability)
+   journal = RotationJournal(journal_file, keys[0], group) if journal_file else None
+   try:
+      tasks = ((keys, source_file, group.write_durability) for source_file in batch_lib.expand_sources(sources, False, extension)
+               if journal is None or source_file not in journal)
+      for result in stream_lib.ordered_map(rotate_file, tasks, jobs, executor):
+         if result["action"] == "rotated": group.add(os.path.dirname(os.path.realpath(result["source"])))
+         if journal is not None: journal.record(result)
+         yield result
+   finally:
+      if journal is not None: journal.close()
+      group.commit()
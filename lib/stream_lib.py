@@ -0,0 +1,713 @@
+#
+# This library implements a chunked, streaming encryption format so that
+# files of any size can be encrypted and decrypted with constant memory.
+# The input is split into fixed-size frames and every frame is encrypted
+# and authenticated on its own (Fernet: AES-CBC + HMAC-SHA256, fresh IV
+# per frame).  Each frame also carries a sequence number and a final-frame
+# marker inside the authenticated payload so that dropped, reordered or
+# truncated frames are detected on decrypt.
+#
+# Files written by earlier versions of filecryptor.py are a single Fernet
+# token.  detect_format() tells the two apart, so readers can accept both.
+#
+# File layout (all integers are big-endian):
+#    HEADER := MAGIC(4) VERSION(1) CIPHER(1) FLAGS(1) COMPRESSION(1)
+#              CHUNK_SIZE(4) FILE_ID(16) KEY_ID(8)
+#    FRAME  := LENGTH(4) TOKEN(LENGTH)
+#    TOKEN  := Fernet( BINDING(16) SEQUENCE(8) FRAME_FLAGS(1) DATA )
+#
+#    BINDING is the first 16 bytes of SHA-256(HEADER).  It ties every frame
+#    to the header (and so to the random FILE_ID) of the file it belongs to,
+#    so frames cannot be spliced in from another file.
+#
+#    With FLAG_BINARY set in FLAGS the tokens are stored raw, i.e. without
+#    Fernet's url-safe base64: VERSION(1) TIMESTAMP(8) IV(16) CIPHERTEXT
+#    HMAC(32).  Files are about 25% smaller and no base64 work is done on
+#    either end.  The flag is left out of BINDING, so convert_file() can
+#    switch a framed file between the two encodings without decrypting
+#    the frames (the key is still needed, to check the header's KEY_ID).
+#
+#    CIPHER selects the frame cipher (see lib/cipher_lib.py): Fernet, or
+#    the single pass AEAD modes AES-256-GCM and ChaCha20-Poly1305.  AEAD
+#    tokens are NONCE(12) CIPHERTEXT TAG(16), always raw (FLAG_BINARY set),
+#    around the same BINDING SEQUENCE FRAME_FLAGS DATA payload.
+#
+#    COMPRESSION names the algorithm frames are compressed with before they
+#    are encrypted (see lib/compress_lib.py), zero for none.  A frame with
+#    FRAME_COMPRESSED in FRAME_FLAGS holds compressed DATA, frames that did
+#    not shrink are stored as they are.  Compressed files are written as
+#    VERSION 2, so readers that predate compression reject them instead of
+#    returning compressed data; all other files stay VERSION 1.
+#
+# Function Prototypes:
+#    detect_format(prefix)
+#    read_header(source_file)
+#    get_cipher(crypto_key)
+#    ordered_map(function, tasks, jobs=1, executor="process")
+#    encrypt_stream(crypto_key, in_stream, out_stream, chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, executor="process")
+#    iter_decrypt_stream(crypto_key, in_stream, jobs=1, executor="process")
+#    decrypt_stream(crypto_key, in_stream, out_stream, jobs=1, executor="process")
+#    encrypt_iterable(crypto_key, pieces, out_stream, chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, executor="process")
+#    encrypt_file(crypto_key, source_file, output_file, chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, executor="process")
+#    decrypt_file(crypto_key, source_file, out_stream, jobs=1, executor="process")
+#    encrypt_token(crypto_key, data, encoded=True)
+#    decrypt_token_into(crypto_key, token, buffer, encoded=True)
+#    token_signed_by(crypto_key, token, encoded=True)
+#    mmap_decrypt_file(crypto_key, source_file, out)
+#    read_decrypted(crypto_key, source_file)
+#    convert_file(crypto_key, source_file, output_file, binary=True, durability=None)
+#    reencrypt_changed(crypto_key, in_stream, old_stream, out_stream, unchanged, level=None)
+#
+# The encrypt functions take binary=False; set it to write raw tokens,
+# cipher="fernet"; "aes-gcm" or "chacha20" select an AEAD backend, and
+# compression=None; "zlib" or "lzma", with an optional ":LEVEL", compress
+# every frame first.
+#
+# Wherever crypto_key is accepted a key ring, a list or tuple of keys with
+# the primary key first, may be passed instead.  Encrypting uses the
+# primary key; decrypting picks the key named by KEY_ID in the header, or
+# tries each key in turn for legacy single token files (MultiFernet).
+#
+# Frames are independent, so with jobs > 1 they are encrypted or decrypted
+# on a process (or thread) pool.  Results are written in order through a
+# bounded reorder buffer, so memory stays at roughly 2 * jobs chunks.
+#
+# mmap_decrypt_file() is the low copy decrypt path.  The input is memory
+# mapped, each token is verified and decrypted straight into a reused
+# bytearray (Fernet's algorithm, done with the primitives it is built on),
+# and raw bytes go to the output file descriptor or binary stream.  Clear
+# text is never decoded to str, so binary files decrypt correctly.
+#
+# The file level functions report their read, encrypt and decrypt phases
+# to metrics_lib.py; with no metrics hook registered that costs nothing.
+#
+# The unit tests are in test_stream_lib.py, run them with pytest.
+
+import os
+import io
+import mmap
+import base64
+import time
+import struct
+import hashlib
+import collections
+import atomic_lib
+import cipher_lib
+import metrics_lib
+import compress_lib
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+MAGIC              = b"\x89HWS"        # Not valid base64, so never a Fernet token
+FORMAT_VERSION     = 1
+COMPRESSED_VERSION = 2                 # Format version of files with compressed frames
+CIPHER_FERNET      = cipher_lib.CIPHER_FERNET
+DEFAULT_CHUNK_SIZE = 1024 * 1024       # 1 MiB of plain text per frame
+MAX_CHUNK_SIZE     = 256 * 1024 * 1024
+FRAME_FINAL        = 0x01              # Frame flag: last frame of the stream
+FRAME_COMPRESSED   = 0x02              # Frame flag: DATA is compressed
+FLAG_BINARY        = 0x01              # Header flag: tokens are raw, not base64
+FERNET_PREFIX      = b"gAAAAA"         # urlsafe base64 of Fernet version byte 0x80
+EXECUTORS          = ("process", "thread")
+DETECT_SIZE        = 16                # Bytes detect_format() needs to look at
+
+_HEADER = struct.Struct(">4sBBBBI16s8s")
+_LENGTH = struct.Struct(">I")
+_FRAME  = struct.Struct(">16sQB")
+_TIME   = struct.Struct(">Q")
+
+_FLAGS_OFFSET = 6  # Offset of FLAGS in the header
+
+HEADER_SIZE = _HEADER.size
+
+_CIPHERS = {}  # Per process cache of (Multi)Fernet objects, see get_cipher()
+_KEYS    = {}  # Per process cache of split Fernet keys, see _fernet_keys()
+
+FERNET_OVERHEAD = 1 + 8 + 16 + 32  # Version, timestamp, IV and HMAC of a raw token
+
+# ----------------------------------------------------------------------------- key_id()
+def key_id(crypto_key):
+   """ Returns an 8 byte fingerprint of a key.  It is stored in the
+       header so that decrypting with the wrong key fails fast with a
+       clear message instead of an HMAC error on the first frame. """
+   return hashlib.sha256(b"filecryptor key id\x00" + crypto_key.strip()).digest()[:8]
+
+# ----------------------------------------------------------------------------- detect_format()
+def detect_format(prefix):
+   """ Inspects the first bytes of a file and returns 'framed' for the
+       chunked streaming format, 'fernet' for a legacy single token file
+       or None if the data is neither. """
+   if prefix.startswith(MAGIC): return "framed"
+   if prefix.lstrip().startswith(FERNET_PREFIX): return "fernet"
+   return None
+
+# ----------------------------------------------------------------------------- _key_ring()
+def _key_ring(crypto_key):
+   """ Returns a key or a key ring (list or tuple, primary first) as a tuple. """
+   return tuple(crypto_key) if isinstance(crypto_key, (list, tuple)) else (crypto_key,)
+
+# ----------------------------------------------------------------------------- _max_token_length()
+def _max_token_length(chunk_size, binary=False, cipher=CIPHER_FERNET):
+   """ Upper bound of a token holding one frame of chunk_size bytes.
+       Used to reject corrupt length fields before allocating memory. """
+   clear = _FRAME.size + chunk_size
+   if cipher_lib.is_aead(cipher): return clear + cipher_lib.AEAD_OVERHEAD
+   raw   = 1 + 8 + 16 + (clear // 16 + 1) * 16 + 32
+   return raw if binary else (raw + 2) // 3 * 4
+
+# ----------------------------------------------------------------------------- _read_full()
+def _read_full(stream, size):
+   """ Reads exactly size bytes unless end of file is reached first.
+       Pipes and sockets may return short reads so loop until done. """
+   data = stream.read(size)
+   if data is None: data = b""
+   if len(data) == size or len(data) == 0: return data
+   parts = [data]
+   remaining = size - len(data)
+   while remaining > 0:
+      more = stream.read(remaining)
+      if not more: break
+      parts.append(more)
+      remaining -= len(more)
+   return b"".join(parts)
+
+# ----------------------------------------------------------------------------- _pack_header()
+def _pack_header(crypto_key, chunk_size, flags=0, cipher=CIPHER_FERNET, compression=compress_lib.COMPRESS_NONE):
+   """ Builds a new header with a random file id. """
+   if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+      raise ValueError(f"Chunk size must be between 1 and {MAX_CHUNK_SIZE} bytes")
+   version = COMPRESSED_VERSION if compression else FORMAT_VERSION
+   return _HEADER.pack(MAGIC, version, cipher, flags, compression,
+                       chunk_size, os.urandom(16), key_id(crypto_key))
+
+# ----------------------------------------------------------------------------- _binding()
+def _binding(header):
+   """ Returns the 16 byte value that binds frames to their header.  The
+       token encoding flag does not take part, it does not change what
+       is authenticated, only how the tokens are stored. """
+   masked = bytearray(header)
+   masked[_FLAGS_OFFSET] &= ~FLAG_BINARY & 0xFF
+   return hashlib.sha256(masked).digest()[:16]
+
+# ----------------------------------------------------------------------------- _header_key()
+def _header_key(crypto_key, header):
+   """ Returns the key of a key ring that the header was written with, or
+       the primary key if none matches so that the caller reports it. """
+   ring = _key_ring(crypto_key)
+   kid  = bytes(header[-8:])
+   for candidate in ring:
+      if key_id(candidate) == kid: return candidate
+   return ring[0]
+
+# ----------------------------------------------------------------------------- _unpack_header()
+def _unpack_header(header, crypto_key):
+   """ Validates a header and returns a dictionary of its fields. """
+   if len(header) != HEADER_SIZE: raise ValueError("Truncated stream header")
+   magic, version, cipher, flags, compression, chunk_size, file_id, kid = _HEADER.unpack(header)
+   if magic != MAGIC: raise ValueError("Not a framed stream (bad magic)")
+   if version not in (FORMAT_VERSION, COMPRESSED_VERSION): raise ValueError(f"Unsupported stream format version {version}")
+   if cipher not in cipher_lib.CIPHERS.values(): raise ValueError(f"Unsupported cipher id {cipher}")
+   if (version == COMPRESSED_VERSION) != (compression != compress_lib.COMPRESS_NONE) or \
+      compression not in compress_lib.COMPRESSIONS.values(): raise ValueError(f"Unsupported compression id {compression}")
+   if cipher_lib.is_aead(cipher) and not flags & FLAG_BINARY: raise ValueError("AEAD frames must be stored raw")
+   if not 0 < chunk_size <= MAX_CHUNK_SIZE: raise ValueError(f"Invalid chunk size {chunk_size}")
+   if kid != key_id(crypto_key): raise ValueError("Stream was encrypted with a different key")
+   return {"version": version, "cipher": cipher, "flags": flags, "chunk_size": chunk_size,
+           "file_id": file_id, "key_id": kid, "binary": bool(flags & FLAG_BINARY),
+           "compression": compression, "binding": _binding(header)}
+
+# ----------------------------------------------------------------------------- read_header()
+def read_header(source_file):
+   """ Returns the header fields of a framed file without needing the key,
+       e.g. to find out which key it was written with, or None for a
+       legacy single token file.  Raises ValueError for anything else. """
+   with open(source_file, 'rb') as in_file: header = _read_full(in_file, HEADER_SIZE)
+   file_format = detect_format(header[:DETECT_SIZE])
+   if file_format == "fernet": return None
+   if file_format != "framed" or len(header) != HEADER_SIZE: raise ValueError(f"{source_file} is not an encrypted file")
+   magic, version, cipher, flags, compression, chunk_size, file_id, kid = _HEADER.unpack(header)
+   return {"version": version, "cipher": cipher, "flags": flags, "chunk_size": chunk_size,
+           "file_id": file_id, "key_id": kid, "binary": bool(flags & FLAG_BINARY), "compression": compression}
+
+# ----------------------------------------------------------------------------- get_cipher()
+def get_cipher(crypto_key):
+   """ Returns a Fernet object for crypto_key, or a MultiFernet for a key
+       ring, built once per process.  Pool workers call this so each
+       worker sets up the key only once. """
+   ring = _key_ring(crypto_key)
+   cryptographic_component = _CIPHERS.get(ring)
+   if cryptographic_component is None:
+      if len(ring) == 1: cryptographic_component = Fernet(ring[0])
+      else:              cryptographic_component = MultiFernet([Fernet(k) for k in ring])
+      _CIPHERS[ring] = cryptographic_component
+   return cryptographic_component
+
+# ----------------------------------------------------------------------------- _seal_frame()
+def _seal_frame(crypto_key, binding, sequence, flags, chunk, binary=False, cipher=CIPHER_FERNET,
+                compression=compress_lib.COMPRESS_NONE, level=None):
+   """ Compresses, if that makes it smaller, and encrypts one frame and
+       returns its token. """
+   if compression:
+      packed = compress_lib.compress(compression, chunk, level)
+      if packed is not None: chunk, flags = packed, flags | FRAME_COMPRESSED
+   if cipher != CIPHER_FERNET: return cipher_lib.seal(crypto_key, cipher, _FRAME.pack(binding, sequence, flags) + chunk)
+   if binary: return encrypt_token(crypto_key, _FRAME.pack(binding, sequence, flags) + chunk, encoded=False)
+   return get_cipher(crypto_key).encrypt(_FRAME.pack(binding, sequence, flags) + chunk)
+
+# ----------------------------------------------------------------------------- _open_frame()
+def _open_frame(crypto_key, token, binary=False, cipher=CIPHER_FERNET, compression=compress_lib.COMPRESS_NONE,
+                chunk_size=MAX_CHUNK_SIZE):
+   """ Decrypts, and decompresses if need be, one frame token and returns
+       (binding, sequence, flags, data). """
+   if cipher != CIPHER_FERNET:
+      frame = cipher_lib.open_token(crypto_key, cipher, token)
+   elif binary:
+      frame = bytearray(len(token))
+      del frame[decrypt_token_into(crypto_key, token, frame, encoded=False):]
+   else:
+      frame = get_cipher(crypto_key).decrypt(token)
+   binding, sequence, flags = _FRAME.unpack_from(frame)
+   return binding, sequence, flags, _frame_data(frame[_FRAME.size:], flags, compression, chunk_size)
+
+# ----------------------------------------------------------------------------- _frame_data()
+def _frame_data(data, flags, compression, chunk_size):
+   """ Returns the clear text of a decrypted frame's DATA. """
+   if not flags & FRAME_COMPRESSED: return data
+   if not compression: raise ValueError("Compressed frame in a stream without compression")
+   return compress_lib.decompress(compression, data, chunk_size)
+
+# ----------------------------------------------------------------------------- ordered_map()
+def ordered_map(function, tasks, jobs=1, executor="process"):
+   """ Generator that applies function to every argument tuple in tasks
+       and yields the results in task order.  With jobs > 1 the work runs
+       on a process or thread pool; at most 2 * jobs tasks are in flight
+       so the reorder buffer, and with it memory, stays bounded. """
+   if jobs <= 1:
+      for task in tasks: yield function(*task)
+      return
+   if executor not in EXECUTORS: raise ValueError(f"Unknown executor '{executor}', use one of {EXECUTORS}")
+   # Imported here, pools are rare and multiprocessing is slow to import
+   import multiprocessing
+   from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+   if executor == "process" and "fork" in multiprocessing.get_all_start_methods():
+      # Fork so workers never re-import __main__; the command line utilities
+      # are plain scripts that would run again under spawn or forkserver.
+      pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"))
+   else:
+      pool = ThreadPoolExecutor(max_workers=jobs)
+   pending = collections.deque()
+   with pool:
+      try:
+         for task in tasks:
+            pending.append(pool.submit(function, *task))
+            if len(pending) >= 2 * jobs: yield pending.popleft().result()
+         while pending: yield pending.popleft().result()
+      finally:
+         for future in pending: future.cancel()
+
+# ----------------------------------------------------------------------------- _iter_frame_tasks()
+def _iter_frame_tasks(crypto_key, binding, in_stream, chunk_size, binary=False, cipher=CIPHER_FERNET,
+                      compression=compress_lib.COMPRESS_NONE, level=None):
+   """ Generator of _seal_frame() arguments for every chunk of in_stream. """
+   sequence = 0
+   chunk    = _read_full(in_stream, chunk_size)
+   while True:
+      # Read one chunk ahead so the last frame can be marked as final.
+      next_chunk = _read_full(in_stream, chunk_size) if len(chunk) == chunk_size else b""
+      flags = FRAME_FINAL if len(next_chunk) == 0 else 0
+      yield (crypto_key, binding, sequence, flags, chunk, binary, cipher, compression, level)
+      if flags & FRAME_FINAL: break
+      sequence += 1
+      chunk = next_chunk
+
+# ----------------------------------------------------------------------------- _iter_tokens()
+def _iter_tokens(crypto_key, in_stream, max_token, binary=False, cipher=CIPHER_FERNET,
+                 compression=compress_lib.COMPRESS_NONE, chunk_size=MAX_CHUNK_SIZE):
+   """ Generator of _open_frame() arguments for every frame of in_stream. """
+   sequence = 0
+   while True:
+      length = _read_full(in_stream, _LENGTH.size)
+      if len(length) == 0: return
+      if len(length) != _LENGTH.size: raise ValueError("Truncated frame length")
+      (token_length,) = _LENGTH.unpack(length)
+      if token_length > max_token: raise ValueError(f"Frame {sequence} is larger than the chunk size allows")
+      token = _read_full(in_stream, token_length)
+      if len(token) != token_length: raise ValueError(f"Truncated frame {sequence}")
+      yield (crypto_key, token, binary, cipher, compression, chunk_size)
+      sequence += 1
+
+# ----------------------------------------------------------------------------- encrypt_stream()
+def encrypt_stream(crypto_key, in_stream, out_stream, chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, executor="process",
+                   binary=False, cipher="fernet", compression=None):
+   """ Reads clear text from in_stream and writes the framed encrypted
+       stream to out_stream.  Frames are encrypted on jobs workers and
+       written in order; memory use is about 2 * jobs chunks.  With 
+       binary set the tokens are stored raw instead of base64.  cipher
+       names the frame cipher, AEAD ciphers always store raw tokens.
+       compression, e.g. "zlib" or "lzma:9", compresses frames first.
+       Returns the number of clear text bytes consumed. """
+   crypto_key = _key_ring(crypto_key)[0]
+   cipher  = cipher_lib.cipher_id(cipher)
+   binary  = binary or cipher_lib.is_aead(cipher)
+   compression, level = compress_lib.parse_compression(compression)
+   header  = _pack_header(crypto_key, chunk_size, FLAG_BINARY if binary else 0, cipher, compression)
+   binding = _binding(header)
+   out_stream.write(header)
+   total = 0
+   def counted(tasks):
+      nonlocal total
+      for task in tasks:
+         total += len(task[4])
+         yield task
+   with metrics_lib.phase("encrypt") as timer:
+      tasks = counted(_iter_frame_tasks(crypto_key, binding, in_stream, chunk_size, binary, cipher, compression, level))
+      for token in ordered_map(_seal_frame, tasks, jobs, executor):
+         out_stream.write(_LENGTH.pack(len(token)))
+         out_stream.write(token)
+      timer.add(total)
+   return total
+
+# ----------------------------------------------------------------------------- iter_decrypt_stream()
+def iter_decrypt_stream(crypto_key, in_stream, jobs=1, executor="process"):
+   """ Generator that reads a framed encrypted stream and yields the
+       clear text one chunk at a time, in order, with frames decrypted on
+       jobs workers.  Raises ValueError if the stream is corrupt, truncated,
+       reordered or was encrypted with another key. """
+   header   = _read_full(in_stream, HEADER_SIZE)
+   crypto_key = _header_key(crypto_key, header)
+   info     = _unpack_header(header, crypto_key)
+   tokens   = _iter_tokens(crypto_key, in_stream, _max_token_length(info["chunk_size"], info["binary"], info["cipher"]),
+                           info["binary"], info["cipher"], info["compression"], info["chunk_size"])
+   sequence = 0
+   final    = False
+   for binding, frame_sequence, flags, data in ordered_map(_open_frame, tokens, jobs, executor):
+      if final: raise ValueError("Unexpected data after the final frame")
+      if binding != info["binding"]: raise ValueError(f"Frame {sequence} does not belong to this stream")
+      if frame_sequence != sequence: raise ValueError(f"Frame out of order, expected {sequence} got {frame_sequence}")
+      yield data
+      sequence += 1
+      final = bool(flags & FRAME_FINAL)
+   if not final: raise ValueError("Truncated stream, final frame is missing")
+
+# ----------------------------------------------------------------------------- decrypt_stream()
+def decrypt_stream(crypto_key, in_stream, out_stream, jobs=1, executor="process"):
+   """ Decrypts a framed stream from in_stream to out_stream.
+       Returns the number of clear text bytes written. """
+   total = 0
+   with metrics_lib.phase("decrypt") as timer:
+      for chunk in iter_decrypt_stream(crypto_key, in_stream, jobs, executor):
+         out_stream.write(chunk)
+         total += len(chunk)
+      timer.add(total)
+   return total
+
+# ----------------------------------------------------------------------------- class IterableReader
+class IterableReader(io.RawIOBase):
+   """ A read-only stream over an iterable of bytes pieces, so data that
+       is produced incrementally can be fed to encrypt_stream(). """
+
+   def __init__(self, pieces):
+      self._pieces  = iter(pieces)
+      self._pending = memoryview(b"")
+
+   def readable(self):
+      return True
+
+   def readinto(self, buffer):
+      while len(self._pending) == 0:
+         piece = next(self._pieces, None)
+         if piece is None: return 0
+         self._pending = memoryview(piece)
+      size = min(len(buffer), len(self._pending))
+      buffer[:size] = self._pending[:size]
+      self._pending = self._pending[size:]
+      return size
+
+# ----------------------------------------------------------------------------- encrypt_iterable()
+def encrypt_iterable(crypto_key, pieces, out_stream, chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, executor="process",
+                     binary=False, cipher="fernet", compression=None):
+   """ Encrypts an iterable of bytes pieces into a framed stream without
+       joining them first.  Returns the number of clear text bytes. """
+   return encrypt_stream(crypto_key, IterableReader(pieces), out_stream, chunk_size, jobs, executor, binary, cipher,
+                         compression)
+
+# ----------------------------------------------------------------------------- encrypt_file()
+def encrypt_file(crypto_key, source_file, output_file, chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, executor="process",
+                 binary=False, cipher="fernet", compression=None):
+   """ Encrypts source_file into output_file using the framed format.
+       Returns the number of clear text bytes encrypted. """
+   with open(source_file, 'rb') as in_file, open(output_file, 'wb') as out_file:
+      return encrypt_stream(crypto_key, in_file, out_file, chunk_size, jobs, executor, binary, cipher, compression)
+
+# ----------------------------------------------------------------------------- decrypt_file()
+def decrypt_file(crypto_key, source_file, out_stream, jobs=1, executor="process"):
+   """ Decrypts source_file to out_stream.  Both the framed format and
+       legacy single token files are accepted; the format is detected
+       from the first bytes of the file.
+       Returns the number of clear text bytes written. """
+   with open(source_file, 'rb') as in_file:
+      file_format = detect_format(in_file.read(DETECT_SIZE))
+      in_file.seek(0)
+      if file_format == "framed":
+         return decrypt_stream(crypto_key, in_file, out_stream, jobs, executor)
+      if file_format == "fernet":
+         with metrics_lib.phase("read") as timer:
+            token = in_file.read().strip()
+            timer.add(len(token))
+         with metrics_lib.phase("decrypt") as timer:
+            clear_text = get_cipher(crypto_key).decrypt(token)
+            timer.add(len(clear_text))
+         out_stream.write(clear_text)
+         return len(clear_text)
+   raise ValueError(f"{source_file} is not an encrypted file")
+
+# ----------------------------------------------------------------------------- _fernet_keys()
+def _fernet_keys(crypto_key):
+   """ Splits a Fernet key into its signing and encryption halves. """
+   keys = _KEYS.get(crypto_key)
+   if keys is None:
+      raw = base64.urlsafe_b64decode(crypto_key)
+      if len(raw) != 32: raise ValueError("Fernet key must be 32 url-safe base64-encoded bytes")
+      keys = _KEYS[crypto_key] = (raw[:16], raw[16:])
+   return keys
+
+# ----------------------------------------------------------------------------- encrypt_token()
+def encrypt_token(crypto_key, data, encoded=True):
+   """ Encrypts data exactly like Fernet.encrypt() does.  With encoded
+       False the raw token is returned, skipping the base64 step. """
+   signing_key, encryption_key = _fernet_keys(crypto_key)
+   iv = os.urandom(16)
+   padder = padding.PKCS7(128).padder()
+   padded = padder.update(data) + padder.finalize()
+   encryptor = Cipher(algorithms.AES(encryption_key), modes.CBC(iv)).encryptor()
+   body = b"\x80" + _TIME.pack(int(time.time())) + iv + encryptor.update(padded) + encryptor.finalize()
+   signature = hmac.HMAC(signing_key, hashes.SHA256())
+   signature.update(body)
+   token = body + signature.finalize()
+   return base64.urlsafe_b64encode(token) if encoded else token
+
+# ----------------------------------------------------------------------------- decrypt_token_into()
+def decrypt_token_into(crypto_key, token, buffer, encoded=True):
+   """ Verifies and decrypts one Fernet token into buffer, which must hold
+       at least len(token) bytes, and returns the number of clear text
+       bytes placed at its start.  With encoded False the token is raw and
+       may be a memoryview, e.g. of a memory mapped file, and is not copied.
+       Same checks as Fernet.decrypt(); raises InvalidToken on failure. """
+   signing_key, encryption_key = _fernet_keys(crypto_key)
+   try:
+      data = memoryview(base64.urlsafe_b64decode(token) if encoded else token)
+   except (TypeError, ValueError):
+      raise InvalidToken
+   if len(data) < FERNET_OVERHEAD + 16 or data[0] != 0x80 or (len(data) - FERNET_OVERHEAD) % 16:
+      raise InvalidToken
+   signature = hmac.HMAC(signing_key, hashes.SHA256())
+   signature.update(data[:-32])
+   try:
+      signature.verify(bytes(data[-32:]))
+   except InvalidSignature:
+      raise InvalidToken
+   decryptor = Cipher(algorithms.AES(encryption_key), modes.CBC(bytes(data[9:25]))).decryptor()
+   size = decryptor.update_into(data[25:-32], buffer)
+   decryptor.finalize()
+   pad_length = buffer[size - 1]
+   if not 0 < pad_length <= 16 or buffer[size - pad_length:size] != bytes([pad_length]) * pad_length:
+      raise InvalidToken
+   return size - pad_length
+
+# ----------------------------------------------------------------------------- token_signed_by()
+def token_signed_by(crypto_key, token, encoded=True):
+   """ True if the Fernet token carries a valid HMAC under crypto_key.
+       Only the signature is checked, nothing is decrypted, so this is a
+       cheap way to tell which key of a key ring wrote a legacy file. """
+   signing_key, _ = _fernet_keys(crypto_key)
+   try:
+      data = base64.urlsafe_b64decode(token) if encoded else bytes(token)
+   except (TypeError, ValueError):
+      return False
+   if len(data) < FERNET_OVERHEAD: return False
+   signature = hmac.HMAC(signing_key, hashes.SHA256())
+   signature.update(data[:-32])
+   try:
+      signature.verify(data[-32:])
+   except InvalidSignature:
+      return False
+   return True
+
+# ----------------------------------------------------------------------------- _write_all()
+def _write_all(out, data):
+   """ Writes data to a file descriptor, a binary stream or a bytearray. """
+   if isinstance(out, int):
+      while len(data):
+         data = data[os.write(out, data):]
+   elif isinstance(out, bytearray):
+      out += data
+   else:
+      out.write(data)
+
+# ----------------------------------------------------------------------------- _decrypt_mapped()
+def _decrypt_mapped(crypto_key, view, out):
+   """ Decrypts the mapped file in view to out.  Returns the byte count. """
+   file_format = detect_format(bytes(view[:DETECT_SIZE]))
+   if file_format == "fernet":
+      token  = bytes(view).strip()
+      buffer = bytearray(len(token))
+      ring   = _key_ring(crypto_key)
+      for candidate in ring:
+         try:
+            size = decrypt_token_into(candidate, token, buffer)
+            break
+         except InvalidToken:
+            if candidate is ring[-1]: raise
+      _write_all(out, memoryview(buffer)[:size])
+      return size
+   if file_format != "framed": raise ValueError("Not an encrypted file")
+   header    = bytes(view[:HEADER_SIZE])
+   crypto_key = _header_key(crypto_key, header)
+   info      = _unpack_header(header, crypto_key)
+   encoded   = not info["binary"]
+   cipher    = info["cipher"]
+   max_token = _max_token_length(info["chunk_size"], info["binary"], cipher)
+   buffer    = bytearray(max_token + 16)
+   offset    = HEADER_SIZE
+   sequence  = 0
+   total     = 0
+   final     = False
+   while offset < len(view):
+      if final: raise ValueError("Unexpected data after the final frame")
+      if offset + _LENGTH.size > len(view): raise ValueError("Truncated frame length")
+      (token_length,) = _LENGTH.unpack_from(view, offset)
+      offset += _LENGTH.size
+      if token_length > max_token: raise ValueError(f"Frame {sequence} is larger than the chunk size allows")
+      if offset + token_length > len(view): raise ValueError(f"Truncated frame {sequence}")
+      token = view[offset:offset + token_length]
+      if cipher == CIPHER_FERNET: size = decrypt_token_into(crypto_key, token, buffer, encoded)
+      else:                       size = cipher_lib.open_token_into(crypto_key, cipher, token, buffer)
+      offset += token_length
+      binding, frame_sequence, flags = _FRAME.unpack_from(buffer)
+      if binding != info["binding"]: raise ValueError(f"Frame {sequence} does not belong to this stream")
+      if frame_sequence != sequence: raise ValueError(f"Frame out of order, expected {sequence} got {frame_sequence}")
+      data = _frame_data(memoryview(buffer)[_FRAME.size:size], flags, info["compression"], info["chunk_size"])
+      _write_all(out, data)
+      total   += len(data)
+      sequence += 1
+      final = bool(flags & FRAME_FINAL)
+   if not final: raise ValueError("Truncated stream, final frame is missing")
+   return total
+
+# ----------------------------------------------------------------------------- mmap_decrypt_file()
+def mmap_decrypt_file(crypto_key, source_file, out):
+   """ Decrypts source_file, framed or legacy token, to out: a file
+       descriptor, a binary stream (e.g. sys.stdout.buffer) or a bytearray.
+       source_file may also be an open file descriptor, which is left open.
+       The file is memory mapped and decrypted into reused buffers.
+       Returns the number of clear text bytes written. """
+   closefd = not isinstance(source_file, int)
+   with metrics_lib.phase("read") as timer, open(source_file, 'rb', closefd=closefd) as in_file:
+      size = os.fstat(in_file.fileno()).st_size
+      if size == 0: raise ValueError(f"{source_file} is empty")
+      mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+      timer.add(size)
+   try:
+      with metrics_lib.phase("decrypt") as timer, memoryview(mapped) as view:
+         total = _decrypt_mapped(crypto_key, view, out)
+         timer.add(total)
+         return total
+   finally:
+      try:
+         mapped.close()
+      except BufferError:
+         pass  # A traceback still holds a slice, the map goes with it
+
+# ----------------------------------------------------------------------------- read_decrypted()
+def read_decrypted(crypto_key, source_file):
+   """ Returns the clear text of source_file as a bytearray, using the
+       mmap decrypt path.  json.loads() accepts the result directly. """
+   clear_text = bytearray()
+   mmap_decrypt_file(crypto_key, source_file, clear_text)
+   return clear_text
+
+# ----------------------------------------------------------------------------- reencrypt_changed()
+def reencrypt_changed(crypto_key, in_stream, old_stream, out_stream, unchanged, level=None):
+   """ Encrypts in_stream into out_stream as the next version of the
+       framed stream old_stream, re-encrypting only what changed.  The old
+       header, and so its file id, chunk size, encoding, cipher and
+       compression, is kept; frame i is copied from old_stream as is,
+       without decrypting it, when unchanged(i, chunk) is true and its
+       final flag still fits, and compressed (at level) and encrypted
+       afresh otherwise.  old_stream must be seekable and
+       encrypted with crypto_key.  Returns (clear text bytes, frames reused).
+       Note that the versions share their BINDING, so a frame of any older
+       version could equally be swapped back in, undetected, by anyone
+       holding it; callers should only do this when asked to (see
+       sync_lib's reuse_chunks). """
+   crypto_key = _key_ring(crypto_key)[0]
+   header = _read_full(old_stream, HEADER_SIZE)
+   info   = _unpack_header(header, crypto_key)
+   max_token = _max_token_length(info["chunk_size"], info["binary"], info["cipher"])
+   frames = []  # (offset, length) of every old token, read from the length fields only
+   offset = HEADER_SIZE
+   while True:
+      length = _read_full(old_stream, _LENGTH.size)
+      if len(length) == 0: break
+      if len(length) != _LENGTH.size: raise ValueError("Truncated frame length")
+      (token_length,) = _LENGTH.unpack(length)
+      if token_length > max_token: raise ValueError(f"Frame {len(frames)} is larger than the chunk size allows")
+      frames.append((offset + _LENGTH.size, token_length))
+      offset += _LENGTH.size + token_length
+      old_stream.seek(offset)
+   if offset != old_stream.seek(0, os.SEEK_END): raise ValueError("Truncated frame")
+   out_stream.write(header)
+   total  = 0
+   reused = 0
+   with metrics_lib.phase("encrypt") as timer:
+      for task in _iter_frame_tasks(crypto_key, info["binding"], in_stream, info["chunk_size"], info["binary"], info["cipher"],
+                                    info["compression"], level):
+         sequence, flags, chunk = task[2], task[3], task[4]
+         total += len(chunk)
+         final  = sequence == len(frames) - 1
+         if sequence < len(frames) and final == bool(flags & FRAME_FINAL) and unchanged(sequence, chunk):
+            old_stream.seek(frames[sequence][0])
+            token = _read_full(old_stream, frames[sequence][1])
+            if len(token) != frames[sequence][1]: raise ValueError(f"Truncated frame {sequence}")
+            reused += 1
+         else:
+            token = _seal_frame(*task)
+         out_stream.write(_LENGTH.pack(len(token)))
+         out_stream.write(token)
+      timer.add(total)
+   return total, reused
+
+# ----------------------------------------------------------------------------- convert_file()
+def convert_file(crypto_key, source_file, output_file, binary=True, durability=None):
+   """ Writes source_file to output_file in the framed format with raw
+       (binary True) or base64 tokens.  A framed source is re-encoded frame
+       by frame without decrypting the frames, the key only checks the
+       header; a legacy single token file is decrypted and encrypted again.
+       AEAD files are always raw, they are copied as they are.  output_file
+       is written atomically with durability (see atomic_lib), so it may be
+       source_file itself.  Returns the bytes written. """
+   with open(source_file, 'rb') as in_file, atomic_lib.atomic_write(output_file, durability=durability) as out_file:
+      file_format = detect_format(in_file.read(DETECT_SIZE))
+      in_file.seek(0)
+      if file_format == "fernet":
+         clear_text = get_cipher(crypto_key).decrypt(in_file.read().strip())
+         encrypt_stream(crypto_key, io.BytesIO(clear_text), out_file, binary=binary)
+         return out_file.tell()
+      if file_format != "framed": raise ValueError(f"{source_file} is not an encrypted file")
+      header = bytearray(_read_full(in_file, HEADER_SIZE))
+      info   = _unpack_header(bytes(header), _header_key(crypto_key, header))
+      if cipher_lib.is_aead(info["cipher"]):
+         if not binary: raise ValueError("AEAD frames can not be stored as base64 tokens")
+         binary = True
+      header[_FLAGS_OFFSET] = (header[_FLAGS_OFFSET] & ~FLAG_BINARY & 0xFF) | (FLAG_BINARY if binary else 0)
+      out_file.write(header)
+      max_token = _max_token_length(info["chunk_size"], info["binary"], info["cipher"])
+      for task in _iter_tokens(crypto_key, in_file, max_token, info["binary"], info["cipher"]):
+         token = task[1]
+         if info["binary"] and not binary:  token = base64.urlsafe_b64encode(token)
+         elif binary and not info["binary"]: token = base64.urlsafe_b64decode(token)
+         out_file.write(_LENGTH.pack(len(token)))
+         out_file.write(token)
+      return out_file.tell()
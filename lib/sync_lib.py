@@ -0,0 +1,251 @@
+#
+# This library keeps an encrypted mirror of a directory tree up to date,
+# doing work only for what changed since the last run.  A manifest next to
+# the encrypted output records for every source file its size, mtime,
+# content hash and where its encrypted copy is.  A sync then
+#
+#    - skips files whose size and mtime match the manifest, without
+#      reading them, so an unchanged tree costs one stat() per file;
+#    - hashes the other files, on jobs workers, and leaves those whose
+#      content is unchanged (e.g. only touched) alone;
+#    - encrypts new and modified files; with the framed format and
+#      reuse_chunks only the chunks that changed are encrypted again, the
+#      frames of unchanged chunks are copied from the previous output (see
+#      stream_lib.reencrypt_changed);
+#    - removes the encrypted copies of sources that were deleted.
+#
+# Outputs are replaced atomically (see atomic_lib.py), and the manifest is
+# saved even if the run is interrupted, so a sync can simply be run again.
+# The output directories are fsync'd once per sync (group commit), before
+# the manifest that describes them is saved.
+#
+# The content hashes are keyed BLAKE2b, keyed from the primary key, so they
+# reveal nothing about the clear text to whoever can read the manifest, and
+# the manifest itself is stored encrypted.
+#
+# Chunk reuse is off by default.  A new version that reuses frames keeps
+# the old header and file id, and so the BINDING of its frames: a frame of
+# any earlier version of the file still authenticates at the same position
+# in the current one.  Whoever holds an old copy of the output can swap
+# old chunks back in, a silent partial rollback.  Pass reuse_chunks=True
+# only where the outputs are trusted not to be tampered with, or where
+# that risk is accepted for the faster sync; otherwise a changed file is
+# encrypted completely, under a new file id.
+#
+# Manifest, Json encrypted in the binary container:
+#    {"version": 1, "settings": {"stream", "chunk_size", "binary", "cipher", "compression", "extension"},
+#     "files": {RELATIVE_PATH: {"size", "mtime_ns", "hash", "chunks", "output"}}}
+#
+# Function Prototypes:
+#    hash_file(crypto_key, source_file, chunk_size=DEFAULT_CHUNK_SIZE)
+#    load_manifest(crypto_key, manifest_file)
+#    save_manifest(crypto_key, manifest_file, manifest, durability=None)
+#    sync_file(crypto_key, source_file, output_file, entry, settings, reuse_chunks=False, durability=None)
+#    sync_tree(crypto_key, source_dir, output_dir, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, binary=False,
+#              cipher="fernet", extension="enc", jobs=1, executor="process", reuse_chunks=False, compression=None,
+#              durability=None)
+#
+# The unit tests are in test_sync_lib.py, run them with pytest.
+
+import os
+import json
+import time
+import hashlib
+import batch_lib
+import cipher_lib
+import compress_lib
+import atomic_lib
+import stream_lib
+
+MANIFEST_NAME    = ".filecryptor-manifest"
+MANIFEST_VERSION = 1
+RACY_WINDOW_NS   = 2 * 10**9  # Files changed this close to a sync are hashed again next time
+
+# ----------------------------------------------------------------------------- _hash_key()
+def _hash_key(crypto_key):
+   """ Returns the BLAKE2b key of the content hashes of crypto_key. """
+   return hashlib.sha256(b"filecryptor sync\x00" + crypto_key.strip()).digest()
+
+# ----------------------------------------------------------------------------- _chunk_hash()
+def _chunk_hash(hash_key, chunk):
+   """ Returns the keyed hash of one chunk as hex. """
+   return hashlib.blake2b(chunk, key=hash_key, digest_size=16).hexdigest()
+
+# ----------------------------------------------------------------------------- hash_file()
+def hash_file(crypto_key, source_file, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE):
+   """ Returns (content hash, [chunk hashes]) of source_file, keyed from
+       crypto_key, with one chunk hash per chunk_size bytes. """
+   hash_key = _hash_key(crypto_key)
+   chunks   = []
+   size     = 0
+   with open(source_file, 'rb') as in_file:
+      while True:
+         chunk = in_file.read(chunk_size)
+         if not chunk: break
+         chunks.append(_chunk_hash(hash_key, chunk))
+         size += len(chunk)
+   whole = hashlib.blake2b(f"{size}:{''.join(chunks)}".encode(), key=hash_key, digest_size=32)
+   return whole.hexdigest(), chunks
+
+# ----------------------------------------------------------------------------- load_manifest()
+def load_manifest(crypto_key, manifest_file):
+   """ Returns the manifest saved in manifest_file, or an empty one if
+       there is none yet.  Raises ValueError if it can not be read with
+       crypto_key (a key or key ring). """
+   if not os.path.isfile(manifest_file): return {"version": MANIFEST_VERSION, "settings": {}, "files": {}}
+   try:
+      manifest = json.loads(stream_lib.read_decrypted(crypto_key, manifest_file))
+   except Exception as e:
+      raise ValueError(f"Unable to read manifest {manifest_file}: {str(e) or type(e).__name__}")
+   if manifest.get("version") != MANIFEST_VERSION: raise ValueError(f"Unsupported manifest version in {manifest_file}")
+   return manifest
+
+# ----------------------------------------------------------------------------- save_manifest()
+def save_manifest(crypto_key, manifest_file, manifest, durability=None):
+   """ Encrypts and atomically saves the manifest with durability. """
+   primary = crypto_key[0] if isinstance(crypto_key, (list, tuple)) else crypto_key
+   with atomic_lib.atomic_write(manifest_file, durability=durability) as out_file:
+      stream_lib.encrypt_iterable(primary, [json.dumps(manifest).encode()], out_file, binary=True)
+
+# ----------------------------------------------------------------------------- _reusable()
+def _reusable(crypto_key, output_file, entry, settings):
+   """ True if the frames of the existing output_file can be reused: it
+       is framed, under crypto_key and in the format settings ask for. """
+   if not (settings["stream"] and entry and entry.get("chunks") and os.path.isfile(output_file)): return False
+   try:
+      header = stream_lib.read_header(output_file)
+   except ValueError:
+      return False
+   return header is not None and header["key_id"] == stream_lib.key_id(crypto_key) and \
+          header["chunk_size"] == settings["chunk_size"] and header["binary"] == settings["binary"] and \
+          header["cipher"] == cipher_lib.cipher_id(settings["cipher"]) and \
+          header["compression"] == compress_lib.parse_compression(settings["compression"])[0]
+
+# ----------------------------------------------------------------------------- sync_file()
+def sync_file(crypto_key, source_file, output_file, entry, settings, reuse_chunks=False, durability=None):
+   """ Brings output_file up to date with source_file, given the manifest
+       entry of the previous sync (or None).  Returns a result dictionary
+       like batch_lib.process_file() with the action taken, 'encrypted',
+       'updated' (changed chunks only, with reuse_chunks, see above), or
+       'unchanged', and the new manifest entry.  Never raises; on failure
+       the old output stays.  The output is written with durability, see
+       atomic_lib. """
+   result = {"source": source_file, "output": output_file, "status": batch_lib.STATUS_OK, "error": "",
+             "action": "unchanged", "entry": entry}
+   try:
+      stat = os.stat(source_file)
+      content_hash, chunks = hash_file(crypto_key, source_file, settings["chunk_size"])
+      new_entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash,
+                   "chunks": chunks if settings["stream"] else [], "output": entry["output"] if entry else None}
+      if time.time_ns() - stat.st_mtime_ns < RACY_WINDOW_NS: new_entry["mtime_ns"] = 0
+      if entry and entry["hash"] == content_hash and os.path.isfile(output_file):
+         result["entry"] = new_entry
+         return result
+      reuse = reuse_chunks and _reusable(crypto_key, output_file, entry, settings)
+      os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+      with open(source_file, 'rb') as in_file, atomic_lib.atomic_write(output_file, durability=durability) as out_file:
+         if reuse:
+            hash_key, old = _hash_key(crypto_key), entry["chunks"]
+            unchanged = lambda i, chunk: i < len(old) and _chunk_hash(hash_key, chunk) == old[i]
+            with open(output_file, 'rb') as old_file:
+               stream_lib.reencrypt_changed(crypto_key, in_file, old_file, out_file, unchanged,
+                                            compress_lib.parse_compression(settings["compression"])[1])
+         elif settings["stream"]:
+            stream_lib.encrypt_stream(crypto_key, in_file, out_file, settings["chunk_size"],
+                                      binary=settings["binary"], cipher=settings["cipher"],
+                                      compression=settings["compression"])
+         else:
+            out_file.write(stream_lib.get_cipher(crypto_key).encrypt(in_file.read()))
+      result["action"] = "updated" if reuse else "encrypted"
+      result["entry"]  = new_entry
+   except Exception as e:
+      batch_lib.record_error(result, e, True)
+   return result
+
+# ----------------------------------------------------------------------------- _walk()
+def _walk(source_dir, output_dir):
+   """ Generator of the relative paths of all files below source_dir in
+       sorted order, leaving out output_dir if it lies inside. """
+   skip = os.path.realpath(output_dir)
+   for root, dirs, files in os.walk(source_dir):
+      dirs[:] = sorted(d for d in dirs if os.path.realpath(os.path.join(root, d)) != skip)
+      for file_name in sorted(files):
+         path = os.path.join(root, file_name)
+         if os.path.isfile(path): yield os.path.relpath(path, source_dir)
+
+# ----------------------------------------------------------------------------- sync_tree()
+def sync_tree(crypto_key, source_dir, output_dir, stream=False, chunk_size=stream_lib.DEFAULT_CHUNK_SIZE, binary=False,
+              cipher="fernet", extension="enc", jobs=1, executor="process", reuse_chunks=False, compression=None,
+              durability=None):
+   """ Generator that mirrors every file below source_dir encrypted into
+       output_dir (as RELATIVE_PATH.extension), working only on what
+       changed since the last sync, and yields one result dictionary per
+       file: unchanged files first, then the hashed and encrypted ones on
+       jobs workers, then 'removed' for deleted sources.  crypto_key may
+       be a key ring, the primary key encrypts.  binary, cipher and
+       compression work as in batch_lib.process_file(), durability as in
+       batch_lib.process_files().  reuse_chunks lets old frames be
+       rolled back into new versions, see above.  Raises
+       ValueError if the manifest in output_dir can not be read with the
+       keys. """
+   ring     = tuple(crypto_key) if isinstance(crypto_key, (list, tuple)) else (crypto_key,)
+   primary  = ring[0]
+   binary   = binary or cipher != "fernet"
+   stream   = stream or binary or compression is not None
+   settings = {"stream": stream, "chunk_size": chunk_size, "binary": binary, "cipher": cipher,
+               "compression": compression, "extension": extension}
+   compress_lib.parse_compression(compression)  # Bad names fail here, not once per file
+   manifest_file = os.path.join(output_dir, MANIFEST_NAME)
+   manifest = load_manifest(ring, manifest_file)
+   previous = manifest["files"]
+   # Entries written with other settings or another key describe outputs
+   # that have to be made again, they still tell what to remove though.
+   current  = previous if manifest["settings"] == settings and manifest.get("key_id") == stream_lib.key_id(primary).hex() else {}
+   files    = {}
+   removed  = set()
+   group    = atomic_lib.GroupCommit(durability)
+   os.makedirs(output_dir, exist_ok=True)
+   try:
+      pending = []
+      for relative in _walk(source_dir, output_dir):
+         source_file = os.path.join(source_dir, relative)
+         entry = current.get(relative)
+         output_file = os.path.join(output_dir, entry["output"] if entry and entry["output"] else f"{relative}.{extension}")
+         try:
+            stat = os.stat(source_file)
+         except OSError:
+            continue  # Vanished while walking, handled as deleted
+         if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns and os.path.isfile(output_file):
+            files[relative] = entry
+            yield {"source": source_file, "output": output_file, "status": batch_lib.STATUS_OK, "error": "",
+                   "action": "unchanged"}
+         else:
+            files[relative] = entry  # Kept until the file is done, so a failure does not remove its output
+            pending.append((primary, source_file, output_file, entry, settings, reuse_chunks, group.write_durability))
+      for result in stream_lib.ordered_map(sync_file, pending, jobs, executor):
+         relative = os.path.relpath(result["source"], source_dir)
+         entry = result.pop("entry")
+         if entry is not None:
+            entry["output"] = os.path.relpath(result["output"], output_dir)
+            files[relative] = entry
+         if result["action"] != "unchanged": group.add(os.path.dirname(os.path.realpath(result["output"])))
+         yield result
+      for relative in sorted(set(previous) - set(files)):
+         output_file = os.path.join(output_dir, previous[relative]["output"] or f"{relative}.{extension}")
+         result = {"source": os.path.join(source_dir, relative), "output": output_file, "status": batch_lib.STATUS_OK,
+                   "error": "", "action": "removed"}
+         try:
+            if os.path.isfile(output_file): os.remove(output_file)
+            removed.add(relative)
+            group.add(os.path.dirname(os.path.abspath(output_file)))
+         except OSError as e:
+            batch_lib.record_error(result, e, True)  # The entry stays, to try again next time
+         yield result
+   finally:
+      # Files not reached before an interruption keep their old entries
+      for relative, entry in previous.items():
+         if relative not in removed: files.setdefault(relative, entry)
+      files = {relative: entry for relative, entry in files.items() if entry is not None}
+      group.commit()
+      save_manifest(primary, manifest_file, {"version": MANIFEST_VERSION, "settings": settings,
+                                             "key_id": stream_lib.key_id(primary).hex(), "files": files}, durability)
@@ -0,0 +1,131 @@
+#
+# Unit tests of archive_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import shutil
+import tempfile
+import pytest
+from cryptography.fernet import Fernet
+from archive_lib import *
+from archive_lib import _member_name
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: A tree of small files, an empty one and one of a few chunks
+   key  = Fernet.generate_key()
+   tree = tempfile.mkdtemp(prefix="archive_lib_")
+   os.makedirs(os.path.join(tree, "src", "sub"))
+   files = {os.path.join(tree, "src", f"small-{i}.txt"): f"file {i} ".encode() * i for i in range(1, 41)}
+   files[os.path.join(tree, "src", "sub", "empty.enc")] = b""
+   files[os.path.join(tree, "src", "sub", "large.bin")] = os.urandom(5 * 4096 + 17)
+   for file_name, data in files.items():
+      with open(file_name, 'wb') as f: f.write(data)
+   os.chmod(os.path.join(tree, "src", "small-2.txt"), 0o4755)  # setuid, never restored
+   request.cls.key     = key
+   request.cls.tree    = tree
+   request.cls.files   = files
+   request.cls.archive = os.path.join(tree, "src.har")
+   yield
+   # Test Takedown: Remove the tree
+   shutil.rmtree(tree, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_archive_lib:
+
+   def test_01_pack_and_read(self):
+      results = list(pack_files(self.key, self.archive, [os.path.join(self.tree, "src")], chunk_size=4096,
+                                cipher="aes-gcm", compression="zlib", jobs=3, executor="thread", durability="none"))
+      assert [r["status"] for r in results] == [0] * len(self.files)
+      assert {r["action"] for r in results} == {"added"}
+      with Archive(self.archive, self.key) as archive:
+         assert sorted(archive.names()) == sorted(_member_name(f) for f in self.files)
+         for file_name, data in self.files.items():
+            assert archive.read(_member_name(file_name)) == data
+         large = archive.info(_member_name(os.path.join(self.tree, "src", "sub", "large.bin")))
+         assert large["size"] == 5 * 4096 + 17
+      with open(self.archive, 'rb') as f: data = f.read()
+      assert b"small-1.txt" not in data and b"file 1" not in data  # Names and contents are encrypted
+
+   def test_02_member_is_one_read_and_one_decrypt(self, monkeypatch):
+      name  = _member_name(os.path.join(self.tree, "src", "small-7.txt"))
+      reads = []
+      with Archive(self.archive, self.key) as archive:
+         pread = os.pread
+         monkeypatch.setattr(os, "pread", lambda fd, size, offset: reads.append(size) or pread(fd, size, offset))
+         assert archive.read(name) == self.files[os.path.join(self.tree, "src", "small-7.txt")]
+      assert len(reads) == 1
+
+   def test_03_append_keeps_the_archive(self):
+      with open(self.archive, 'rb') as f: before = f.read()
+      changed = os.path.join(self.tree, "src", "small-3.txt")
+      with open(changed, 'wb') as f: f.write(b"changed")
+      extra = os.path.join(self.tree, "extra.txt")
+      with open(extra, 'wb') as f: f.write(b"extra")
+      results = list(pack_files(self.key, self.archive, [changed, extra, os.path.join(self.tree, "nope")]))
+      assert [(r["status"], r["action"]) for r in results] == [(0, "replaced"), (0, "added"), (6, "")]
+      with open(self.archive, 'rb') as f: after = f.read()
+      assert after.startswith(before)
+      with Archive(self.archive, self.key) as archive:
+         assert len(archive) == len(self.files) + 1
+         assert archive.read(_member_name(changed)) == b"changed"
+         assert archive.read(_member_name(extra)) == b"extra"
+
+   def test_04_torn_append(self):
+      with open(self.archive, 'rb') as f: before = f.read()
+      with open(self.archive, 'ab') as f: f.write(b"\0" * 10 + b"\x89HWA" + os.urandom(1000))
+      with Archive(self.archive, self.key) as archive: assert len(archive) == len(self.files) + 1
+      list(pack_files(self.key, self.archive, []))
+      with open(self.archive, 'rb') as f: assert f.read() == before
+
+   def test_05_unpack(self):
+      output_dir = os.path.join(self.tree, "out")
+      results = list(unpack_files(self.key, self.archive, output_dir, jobs=2, durability="none"))
+      assert all(r["status"] == 0 for r in results) and len(results) == len(self.files) + 1
+      expected = dict(self.files, **{os.path.join(self.tree, "src", "small-3.txt"): b"changed"})
+      for file_name, data in expected.items():
+         with open(os.path.join(output_dir, _member_name(file_name)), 'rb') as f: assert f.read() == data
+      setuid = os.path.join(output_dir, _member_name(os.path.join(self.tree, "src", "small-2.txt")))
+      assert os.stat(setuid).st_mode & 0o7777 == 0o755
+      sub = _member_name(os.path.join(self.tree, "src", "sub"))
+      results = list(unpack_files(self.key, self.archive, output_dir, [sub, "nothing/here"]))
+      assert [r["status"] for r in results] == [8, 8, 6]  # Never overwritten, and missing
+
+   def test_06_tampering_and_wrong_key(self):
+      with pytest.raises(ValueError, match="different key"):
+         Archive(self.archive, Fernet.generate_key())
+      name = _member_name(os.path.join(self.tree, "src", "small-9.txt"))
+      with Archive(self.archive, [Fernet.generate_key(), self.key]) as archive:
+         offset = archive._members[name]["offset"]
+      with open(self.archive, 'r+b') as f:
+         f.seek(offset + 40)
+         byte = f.read(1)
+         f.seek(offset + 40)
+         f.write(bytes([byte[0] ^ 1]))
+      with Archive(self.archive, self.key) as archive:
+         with pytest.raises(ValueError, match="tampered"):
+            archive.read(name)
+         assert archive.read(_member_name(os.path.join(self.tree, "src", "small-8.txt")))
+      with open(self.archive, 'r+b') as f:
+         f.seek(-20, os.SEEK_END)
+         f.write(b"\0")
+      with pytest.raises(ValueError, match="damaged"):
+         Archive(self.archive, self.key)
+
+   def test_07_links_in_output_dir(self):
+      archive = os.path.join(self.tree, "linked.har")  # The one of the tests above is damaged by now
+      list(pack_files(self.key, archive, [os.path.join(self.tree, "src")], durability="none"))
+      output_dir = os.path.join(self.tree, "linked")
+      outside    = os.path.join(self.tree, "outside")
+      os.makedirs(os.path.join(output_dir, _member_name(os.path.join(self.tree, "src"))))
+      os.makedirs(outside)
+      small = _member_name(os.path.join(self.tree, "src", "small-5.txt"))
+      os.symlink(os.path.join(outside, "planted.txt"), os.path.join(output_dir, small))  # Dangling
+      os.symlink(outside, os.path.join(output_dir, _member_name(os.path.join(self.tree, "src", "sub"))))
+      results = list(unpack_files(self.key, archive, output_dir, [small, _member_name(os.path.join(self.tree, "src", "sub"))]))
+      assert [r["status"] for r in results] == [8, 8, 8]
+      assert os.listdir(outside) == []
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
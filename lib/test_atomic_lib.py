@@ -0,0 +1,98 @@
+#
+# Unit tests of atomic_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import shutil
+import tempfile
+import pytest
+import atomic_lib
+from atomic_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Work in a scratch directory
+   directory = tempfile.mkdtemp(prefix="atomic_lib_")
+   request.cls.directory = directory
+   request.cls.file_name = os.path.join(directory, "target.txt")
+   yield
+   # Test Takedown: Remove the scratch directory
+   shutil.rmtree(directory, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_atomic_lib:
+
+   def test_01_write(self):
+      with atomic_write(self.file_name, 'w') as f: f.write("first")
+      with open(self.file_name) as f: assert f.read() == "first"
+      assert os.listdir(self.directory) == ["target.txt"]
+
+   def test_02_failure_keeps_old_file(self):
+      os.chmod(self.file_name, 0o600)
+      with pytest.raises(RuntimeError):
+         with atomic_write(self.file_name, 'w') as f:
+            f.write("partial")
+            raise RuntimeError("interrupted")
+      with open(self.file_name) as f: assert f.read() == "first"
+      assert os.listdir(self.directory) == ["target.txt"]
+
+   def test_03_keeps_permissions(self):
+      with atomic_write(self.file_name) as f: f.write(b"second")
+      assert os.stat(self.file_name).st_mode & 0o777 == 0o600
+
+   def test_04_durability(self, monkeypatch):
+      synced = []
+      monkeypatch.setattr(atomic_lib, "_sync_directory", synced.append)
+      for durability in DURABILITIES:
+         with atomic_write(self.file_name, durability=durability) as f: f.write(durability.encode())
+         with open(self.file_name, 'rb') as f: assert f.read() == durability.encode()
+      assert synced == [self.directory]  # Only "dir" syncs the directory
+      with pytest.raises(ValueError, match="durability"):
+         with atomic_write(self.file_name, durability="disk") as f: f.write(b"never")
+      assert os.listdir(self.directory) == ["target.txt"]
+
+   def test_05_group_commit(self, monkeypatch):
+      synced = []
+      monkeypatch.setattr(atomic_lib, "_sync_directory", synced.append)
+      sub = os.path.join(self.directory, "sub")
+      os.makedirs(sub)
+      with group_commit() as group:
+         for i in range(5):
+            with atomic_write(os.path.join(self.directory, f"{i}.txt")) as f: f.write(b"x")
+            with atomic_write(os.path.join(sub, f"{i}.txt")) as f: f.write(b"y")
+         assert synced == []
+      assert sorted(synced) == sorted([self.directory, sub])  # Once per directory
+      assert GroupCommit().write_durability == DURABILITY_FILE
+      assert GroupCommit("none").write_durability == DURABILITY_NONE
+      group = GroupCommit("file")
+      group.add(sub)
+      assert group.directories == set()
+
+
+   def test_06_guard_stops_the_rename(self):
+      class Refuse:
+         def __enter__(self): raise RuntimeError("too late")
+         def __exit__(self, *args): pass
+      before = os.listdir(self.directory)
+      with pytest.raises(RuntimeError, match="too late"):
+         with atomic_write(self.file_name, guard=Refuse()) as f: f.write(b"never")
+      with open(self.file_name, 'rb') as f: assert f.read() == b"dir"
+      assert os.listdir(self.directory) == before
+
+   def test_07_new_file_permissions_and_links(self):
+      new_file = os.path.join(self.directory, "new.txt")
+      mask = os.umask(0o027)
+      try:
+         with atomic_write(new_file) as f: f.write(b"new")
+      finally:
+         os.umask(mask)
+      assert os.stat(new_file).st_mode & 0o777 == 0o640  # As open() would make it, not 0600
+      link = os.path.join(self.directory, "link.txt")
+      os.symlink(new_file, link)
+      with atomic_write(link) as f: f.write(b"through the link")
+      assert os.path.islink(link)
+      with open(new_file, 'rb') as f: assert f.read() == b"through the link"
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
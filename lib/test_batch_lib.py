@@ -0,0 +1,82 @@
+#
+# Unit tests of batch_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import shutil
+import tempfile
+import pytest
+import stream_lib
+from cryptography.fernet import Fernet
+from batch_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Build a small directory tree of clear text files
+   key  = Fernet.generate_key()
+   tree = tempfile.mkdtemp(prefix="batch_lib_")
+   os.makedirs(os.path.join(tree, "sub", "deeper"))
+   files = {os.path.join(tree, "a.txt"): b"alpha",
+            os.path.join(tree, "sub", "b.txt"): b"bravo" * 1000,
+            os.path.join(tree, "sub", "deeper", "c.log"): b""}
+   for file_name, data in files.items():
+      with open(file_name, 'wb') as f: f.write(data)
+   request.cls.key   = key
+   request.cls.tree  = tree
+   request.cls.files = files
+   yield
+   # Test Takedown: Remove the tree
+   shutil.rmtree(tree, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_batch_lib:
+
+   def test_01_expand_directory(self):
+      assert list(expand_sources([self.tree])) == sorted(self.files)
+
+   def test_02_expand_glob(self):
+      pattern = os.path.join(self.tree, "**", "*.txt")
+      assert list(expand_sources([pattern])) == sorted(f for f in self.files if f.endswith(".txt"))
+
+   def test_03_read_file_list(self):
+      assert list(read_file_list(["a\n", "\n", "# comment\n", "b c\r\n"])) == ["a", "b c"]
+
+   def test_04_encrypt_tree(self):
+      results = list(process_files(self.key, [self.tree], stream=True, chunk_size=1000, jobs=2))
+      assert [r["status"] for r in results] == [STATUS_OK] * len(self.files)
+      assert all(os.path.isfile(r["output"]) for r in results)
+
+   def test_05_decrypt_tree(self):
+      encrypted = process_file(self.key, sorted(self.files)[0], stream=False)
+      assert encrypted["status"] == STATUS_OK
+      for file_name in self.files: os.remove(file_name)
+      results = list(process_files(self.key, [self.tree], encrypt=False, jobs=2, executor="thread"))
+      assert [r["status"] for r in results] == [STATUS_OK] * len(self.files)
+      for file_name, data in self.files.items():
+         with open(file_name, 'rb') as f: assert f.read() == data
+
+   def test_06_per_file_status(self):
+      missing = os.path.join(self.tree, "missing.txt")
+      results = list(process_files(self.key, [missing, *sorted(self.files)], encrypt=False))
+      assert results[0]["status"] == STATUS_MISSING
+      assert all(r["status"] == STATUS_DECRYPT for r in results[1:])
+
+   def test_07_convert_in_place(self):
+      user_file = f"{sorted(self.files)[0]}.enc.tmp"
+      with open(user_file, 'wb') as f: f.write(b"not ours")
+      results = list(convert_files(self.key, [self.tree], jobs=2, durability="none"))
+      assert [r["status"] for r in results] == [STATUS_OK] * len(self.files)
+      with open(user_file, 'rb') as f: assert f.read() == b"not ours"
+      os.remove(user_file)
+      for result in results:
+         with open(result["source"], 'rb') as f: assert f.read(4) == stream_lib.MAGIC
+      assert stream_lib.read_decrypted(self.key, f"{sorted(self.files)[1]}.enc") == self.files[sorted(self.files)[1]]
+
+   def test_08_no_overwrite_on_decrypt(self):
+      encrypted = f"{sorted(self.files)[0]}.enc"
+      result = process_file(self.key, encrypted, encrypt=False)
+      assert result["status"] == STATUS_WRITE
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
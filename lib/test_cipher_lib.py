@@ -0,0 +1,48 @@
+#
+# Unit tests of cipher_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+from cipher_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Define test keys.  Everything runs in memory.
+   request.cls.key       = Fernet.generate_key()
+   request.cls.other_key = Fernet.generate_key()
+
+@pytest.mark.usefixtures("setup")
+class Test_cipher_lib:
+
+   def test_01_names(self):
+      assert cipher_name(cipher_id("aes-gcm")) == "aes-gcm"
+      with pytest.raises(ValueError, match="Unknown cipher"):
+         cipher_id("rot13")
+      assert not is_aead(CIPHER_FERNET) and is_aead(CIPHER_CHACHA20)
+
+   def test_02_round_trip(self):
+      for cipher in (CIPHER_AES_GCM, CIPHER_CHACHA20):
+         token  = seal(self.key, cipher, b"secret")
+         buffer = bytearray(len(token))
+         assert len(token) == len(b"secret") + AEAD_OVERHEAD
+         assert open_token(self.key, cipher, token) == b"secret"
+         assert buffer[:open_token_into(self.key, cipher, memoryview(token), buffer)] == b"secret"
+
+   def test_03_keys_are_separate(self):
+      assert derive_key(self.key, CIPHER_AES_GCM) != derive_key(self.key, CIPHER_CHACHA20)
+      token = seal(self.key, CIPHER_AES_GCM, b"secret")
+      with pytest.raises(InvalidToken):
+         open_token(self.other_key, CIPHER_AES_GCM, token)
+
+   def test_04_tampering(self):
+      token = bytearray(seal(self.key, CIPHER_CHACHA20, b"secret"))
+      token[-1] ^= 1
+      with pytest.raises(InvalidToken):
+         open_token(self.key, CIPHER_CHACHA20, bytes(token))
+      with pytest.raises(InvalidToken):
+         open_token_into(self.key, CIPHER_CHACHA20, bytes(token[:10]), bytearray(10))
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
@@ -0,0 +1,50 @@
+#
+# Unit tests of compress_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import pytest
+from compress_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Define compressible and incompressible data.  Everything runs in memory.
+   request.cls.text  = b"".join(b'{"id": %d, "name": "user %d", "active": true}\n' % (i, i) for i in range(5000))
+   request.cls.noise = os.urandom(200000)
+
+@pytest.mark.usefixtures("setup")
+class Test_compress_lib:
+
+   def test_01_parse(self):
+      assert parse_compression(None) == (COMPRESS_NONE, None)
+      assert parse_compression("zlib") == (COMPRESS_ZLIB, DEFAULT_LEVEL)
+      assert parse_compression("LZMA:9") == (COMPRESS_LZMA, 9)
+      assert compression_name(COMPRESS_LZMA) == "lzma"
+      for spec in ("bzip2", "zlib:0", "zlib:x", "none:3"):
+         with pytest.raises(ValueError):
+            parse_compression(spec)
+
+   def test_02_round_trip(self):
+      for compression in (COMPRESS_ZLIB, COMPRESS_LZMA):
+         for level in (1, 9):
+            packed = compress(compression, self.text, level)
+            assert len(packed) * 5 < len(self.text)
+            assert decompress(compression, packed, len(self.text)) == self.text
+
+   def test_03_skips_what_does_not_shrink(self):
+      assert compress(COMPRESS_ZLIB, self.noise) is None        # Caught by the probe
+      assert compress(COMPRESS_LZMA, self.noise[:1000]) is None  # Tried and dropped
+      assert compress(COMPRESS_NONE, self.text) is None
+
+   def test_04_size_limit_and_damage(self):
+      packed = compress(COMPRESS_ZLIB, self.text)
+      with pytest.raises(ValueError, match="expands"):
+         decompress(COMPRESS_ZLIB, packed, len(self.text) - 1)
+      with pytest.raises(ValueError, match="Truncated"):
+         decompress(COMPRESS_ZLIB, packed[:len(packed) // 2], len(self.text))
+      with pytest.raises(ValueError, match="Damaged"):
+         decompress(COMPRESS_LZMA, b"not lzma at all", 100)
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
@@ -0,0 +1,408 @@
+#
+# Unit tests of crypto_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import io
+import os
+import json
+import random
+import asyncio
+import pytest
+import crypto_lib
+import stream_lib
+import metrics_lib
+from cryptography.fernet import Fernet
+from crypto_lib import *
+from crypto_lib import _get_async_executor, _key_cache, _load_config_file, _load_json_file, _config_blocks, _parse_config
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Define test data and create test files 
+   key             = Fernet.generate_key()
+   key_file        = "a.key"
+   config_file     = "test_config_file.txt"
+   enc_config_file = "test_config_file.txt.enc"
+   config_data     = {"Key_1":"Value 1", "Key_2":"2", "Key_3":"3.1415926"}
+   json_data       = {"Key_1":"Value 1", "Key_2":2, "Key_3":3.1415926}
+   json_file       = "json_file.json"
+   enc_json_file   = "json_file.json.enc" 
+   request.cls.key_file        = key_file         # \
+   request.cls.config_data     = config_data      #  \
+   request.cls.config_file     = config_file      #   \
+   request.cls.enc_config_file = enc_config_file  #    >-- Data for test cases 
+   request.cls.json_file       = json_file        #   /
+   request.cls.enc_json_file   = enc_json_file    #  /
+   request.cls.json_data       = json_data        # /
+   with open(key_file, 'wb') as filekey: filekey.write(key)
+   # Execute test cases in class Test_crypto_lib
+   yield  
+   # Test Takedown: Clean up any left over files
+   cleanup_filelist = [key_file, config_file, enc_config_file, json_file, enc_json_file]
+   for file_name in cleanup_filelist:
+      if os.path.isfile(file_name): os.remove(file_name) 
+
+@pytest.mark.usefixtures("setup")
+class Test_crypto_lib:
+
+   def test_01_write_config_file(self):
+      assert write_config_file(self.config_file, self.config_data)
+
+   def test_02_read_config_file(self):
+      config_data = read_config_file(self.config_file)
+      assert config_data == self.config_data
+
+   def test_03_write_enc_config_file(self):
+      assert write_config_file(self.enc_config_file, self.config_data, self.key_file)
+
+   def test_04_read_enc_config_file(self):
+      config_data = read_config_file(self.enc_config_file, self.key_file)
+      assert config_data == self.config_data
+
+   def test_05_write_json_file(self):
+      assert write_json_file(self.json_file, self.json_data)
+
+   def test_06_read_json_file(self):
+      json_data = read_json_file(self.json_file)
+      assert json_data == self.json_data
+
+   def test_07_write_enc_json_file(self):
+      assert write_json_file(self.enc_json_file, self.json_data, self.key_file)
+
+   def test_08_read_enc_json_file(self):
+      json_data = read_json_file(self.enc_json_file, self.key_file)
+      assert json_data == self.json_data
+
+   def test_09_key_cache_hit(self):
+      clear_key_cache()
+      assert load_key(self.key_file) is load_key(self.key_file)
+
+   def test_10_key_cache_invalidation(self):
+      context = load_key(self.key_file)
+      with open(self.key_file, 'rb') as filekey: key = filekey.read()
+      with open(self.key_file, 'wb') as filekey: filekey.write(key)
+      stat = os.stat(self.key_file)
+      os.utime(self.key_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+      assert load_key(self.key_file) is not context
+      clear_key_cache()
+      assert len(_key_cache) == 0
+
+   def test_11_crypto_context(self):
+      with open(self.key_file, 'rb') as filekey: context = CryptoContext(filekey.read())
+      assert write_json_file(self.enc_json_file, self.json_data, context)
+      assert read_json_file(self.enc_json_file, context) == self.json_data
+      assert read_json_file(self.enc_json_file, self.key_file) == self.json_data
+      assert read_config_file(self.enc_config_file, context) == self.config_data
+
+   def test_12_missing_key_file(self):
+      with pytest.raises(ValueError, match="Unable to locate key file"):
+         load_key("no_such.key")
+      assert read_json_file(self.enc_json_file, "no_such.key") == {}
+
+   def test_13_cached_json_hits_and_misses(self):
+      clear_config_cache()
+      first  = read_json_file_cached(self.enc_json_file, self.key_file)
+      second = read_json_file_cached(self.enc_json_file, self.key_file)
+      assert first is second
+      assert thaw(first) == self.json_data
+      assert config_cache_stats()["hits"] == 1 and config_cache_stats()["misses"] == 1
+
+   def test_14_cached_data_is_read_only(self):
+      json_data = read_json_file_cached(self.enc_json_file, self.key_file)
+      with pytest.raises(TypeError):
+         json_data["Key_1"] = "changed"
+      private = read_json_file_cached(self.enc_json_file, self.key_file, copy=True)
+      private["Key_1"] = "changed"
+      assert read_json_file_cached(self.enc_json_file, self.key_file)["Key_1"] == "Value 1"
+
+   def test_15_cached_config_invalidation(self):
+      clear_config_cache()
+      assert read_config_file_cached(self.config_file) == self.config_data
+      changed = dict(self.config_data, Key_4="4")
+      assert write_config_file(self.config_file, changed)
+      stat = os.stat(self.config_file)
+      os.utime(self.config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+      assert read_config_file_cached(self.config_file) == changed
+      assert config_cache_stats()["misses"] == 2
+      assert write_config_file(self.config_file, self.config_data)
+
+   def test_16_cached_lru_eviction(self):
+      cache = ConfigCache(max_entries=1)
+      cache.load(_load_config_file, self.config_file, None, ' ')
+      cache.load(_load_json_file, self.json_file, None)
+      cache.load(_load_config_file, self.config_file, None, ' ')
+      assert cache.stats()["evictions"] == 2 and cache.stats()["misses"] == 3
+
+   def test_17_json_lines_round_trip(self):
+      records = [{"id": i, "name": f"record {i}", "tags": ["a", "\u00e9\n"]} for i in range(2000)]
+      assert write_json_lines_file(self.json_file, iter(records))
+      assert list(iter_json_lines_file(self.json_file)) == records
+      assert write_json_lines_file(self.enc_json_file, iter(records), self.key_file, chunk_size=1000)
+      assert list(iter_json_lines_file(self.enc_json_file, self.key_file)) == records
+
+   def test_18_json_lines_truncated(self):
+      assert write_json_lines_file(self.enc_json_file, ({"id": i} for i in range(500)), self.key_file, chunk_size=100)
+      with open(self.enc_json_file, 'rb') as f: encrypted = f.read()
+      with open(self.enc_json_file, 'wb') as f: f.write(encrypted[:len(encrypted) // 2])
+      with pytest.raises(ValueError):
+         list(iter_json_lines_file(self.enc_json_file, self.key_file))
+
+   def test_19_binary_container(self):
+      assert write_json_file(self.enc_json_file, self.json_data, self.key_file, binary=True)
+      assert read_json_file(self.enc_json_file, self.key_file) == self.json_data
+      assert write_config_file(self.enc_config_file, self.config_data, self.key_file, binary=True)
+      assert read_config_file(self.enc_config_file, self.key_file) == self.config_data
+      with open(self.enc_config_file, 'rb') as f: assert f.read(4) == stream_lib.MAGIC
+      assert write_json_lines_file(self.enc_json_file, [self.json_data] * 3, self.key_file, binary=True)
+      assert list(iter_json_lines_file(self.enc_json_file, self.key_file)) == [self.json_data] * 3
+      assert write_config_file(self.enc_config_file, self.config_data, self.key_file)
+
+   def test_20_aead_ciphers(self):
+      for cipher in ("aes-gcm", "chacha20"):
+         assert write_json_file(self.enc_json_file, self.json_data, self.key_file, cipher=cipher)
+         assert read_json_file(self.enc_json_file, self.key_file) == self.json_data
+         assert write_json_lines_file(self.enc_json_file, [self.json_data] * 3, self.key_file, cipher=cipher)
+         assert list(iter_json_lines_file(self.enc_json_file, self.key_file)) == [self.json_data] * 3
+      assert not write_config_file(self.enc_config_file, self.config_data, self.key_file, cipher="rot13")
+      assert write_config_file(self.enc_config_file, self.config_data, self.key_file)
+
+   def test_21_key_ring(self):
+      new_key_file = "b.key"
+      try:
+         with open(new_key_file, 'wb') as filekey: filekey.write(Fernet.generate_key())
+         ring = load_key([new_key_file, self.key_file])
+         assert ring is load_key([new_key_file, self.key_file])
+         assert ring.keys == (load_key(new_key_file).crypto_key, load_key(self.key_file).crypto_key)
+         assert write_json_file(self.enc_json_file, self.json_data, self.key_file, binary=True)
+         assert read_json_file(self.enc_json_file, [new_key_file, self.key_file]) == self.json_data
+         assert write_config_file(self.enc_config_file, self.config_data, self.key_file)
+         assert read_config_file(self.enc_config_file, [new_key_file, self.key_file]) == self.config_data
+         with open(self.enc_config_file, 'rb') as f: token = ring.rotate(f.read())
+         assert load_key(new_key_file).decrypt(token) == ring.decrypt(token)
+         assert write_json_file(self.enc_json_file, self.json_data, [new_key_file, self.key_file])
+         assert read_json_file(self.enc_json_file, new_key_file) == self.json_data
+      finally:
+         if os.path.isfile(new_key_file): os.remove(new_key_file)
+
+   def test_22_async_round_trip(self):
+      async def round_trip():
+         assert await awrite_json_file(self.enc_json_file, self.json_data, self.key_file, cipher="aes-gcm")
+         assert await aread_json_file(self.enc_json_file, self.key_file) == self.json_data
+         assert await awrite_config_file(self.enc_config_file, self.config_data, self.key_file)
+         assert await aread_config_file(self.enc_config_file, self.key_file) == self.config_data
+         assert await aread_json_file("no_such_file.json") == {}
+         assert not await awrite_json_file(self.json_file, ["not", "a", "dictionary"])
+      asyncio.run(round_trip())
+
+   def test_23_async_single_flight(self, monkeypatch):
+      calls, load = [], _load_json_file
+      def counted(json_file, key_file=None):
+         calls.append(json_file)
+         return load(json_file, key_file)
+      monkeypatch.setattr(crypto_lib, "_load_json_file", counted)
+      async def readers():
+         return await asyncio.gather(*[aread_json_file(self.enc_json_file, self.key_file) for _ in range(10)])
+      results = asyncio.run(readers())
+      assert len(calls) == 1 and all(r == self.json_data for r in results)
+      results[0]["Key_1"] = "changed"
+      assert results[1]["Key_1"] == "Value 1"
+
+   def test_24_async_timeout_leaves_no_partial_file(self):
+      with open(self.json_file, 'w') as f: f.write('{"old": 1}')
+      big_data = {f"key_{i}": "x" * 100 for i in range(100000)}
+      async def write():
+         with pytest.raises(asyncio.TimeoutError):
+            await awrite_json_file(self.json_file, big_data, self.key_file, timeout=0.001)
+      asyncio.run(write())
+      executor = _get_async_executor()
+      set_async_workers(ASYNC_WORKERS)
+      executor.shutdown(wait=True)  # Let the abandoned write run to its end
+      assert [f for f in os.listdir(".") if f.startswith(f".{self.json_file}.")] == []
+      assert read_json_file(self.json_file) == {"old": 1}
+
+   def test_25_metrics_phases(self):
+      collector = metrics_lib.MetricsCollector()
+      metrics_lib.add_hook(collector)
+      try:
+         clear_key_cache()
+         assert write_json_file(self.enc_json_file, self.json_data, self.key_file, binary=True)
+         assert read_json_file(self.enc_json_file, self.key_file) == self.json_data
+         assert read_config_file(self.config_file) == self.config_data
+      finally:
+         metrics_lib.remove_hook(collector)
+      phases = {(s["operation"], s["phase"]): s for s in collector.snapshot()}
+      assert [p for o, p in phases if o == "write_json_file"] == ["key_load", "serialize", "encrypt", "write"]
+      assert [p for o, p in phases if o == "read_json_file"] == ["key_load", "read", "decrypt", "parse"]
+      assert [p for o, p in phases if o == "read_config_file"] == ["read", "parse"]  # Decoded as it is parsed
+      assert phases[("write_json_file", "key_load")]["bytes"] == 44
+      assert phases[("read_json_file", "key_load")]["bytes"] == 0  # Served from the key cache
+      assert phases[("read_json_file", "parse")]["bytes"] == len(json.dumps(self.json_data))
+
+   def test_26_compressed_writes(self):
+      export = {f"Key_{i}": f"Value {i % 10}" for i in range(2000)}
+      assert write_json_file(self.enc_json_file, export, self.key_file, compression="zlib:9")
+      assert os.path.getsize(self.enc_json_file) * 4 < len(json.dumps(export))
+      assert read_json_file(self.enc_json_file, self.key_file) == export
+      assert write_config_file(self.enc_config_file, export, self.key_file, compression="lzma")
+      assert read_config_file(self.enc_config_file, self.key_file) == export
+      assert asyncio.run(awrite_json_file(self.enc_json_file, export, self.key_file, compression="zlib"))
+      assert stream_lib.read_header(self.enc_json_file)["compression"] > 0
+      assert not write_json_file(self.enc_json_file, export, self.key_file, compression="zip")
+
+   @staticmethod
+   def random_text(rng, alphabet, length):
+      return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, length))).strip()
+
+   def test_27_config_round_trip_property(self):
+      # Any keys and values that a config line can hold come back as written
+      rng = random.Random(27)
+      for delimiter in (" ", "=", ": ", "\t"):
+         for _ in range(40):
+            config_data = {}
+            for _ in range(rng.randint(0, 30)):
+               key   = self.random_text(rng, "abZ09_-.#=: \té€", 12)
+               value = self.random_text(rng, "abZ09_-.#=: \té€\u00a0", 20)
+               if not key or key[0] == '#' or delimiter in key or not value: continue
+               config_data[key] = value
+            assert write_config_file(self.config_file, config_data, delimiter=delimiter, durability="none")
+            assert read_config_file(self.config_file, delimiter=delimiter) == config_data
+            assert list(iter_config_file(self.config_file, delimiter=delimiter)) == list(config_data.items())
+      assert write_config_file(self.enc_config_file, config_data, self.key_file, binary=True, delimiter=delimiter)
+      assert read_config_file(self.enc_config_file, self.key_file, delimiter=delimiter) == config_data
+
+   def test_28_config_parser_matches_reference(self, capsys):
+      # The parser reads any text, blank and comment lines, stray white
+      # space and bad lines included, as the line by line loop it replaced
+      def reference(text, delimiter):
+         configs = {}
+         for line in text.split('\n'):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#') or delimiter not in line: continue
+            data_elements = line.split(delimiter, 1)
+            configs[data_elements[0]] = str(data_elements[-1]).strip()
+         return configs
+      rng = random.Random(28)
+      for delimiter in (" ", "="):
+         for _ in range(200):
+            text = "\n".join(self.random_text(rng, "ab#= \t\r\u2028é", 8) if rng.random() < 0.8 else ""
+                             for _ in range(rng.randint(0, 20)))
+            assert _parse_config(text.split('\n'), delimiter, "test", {}) == reference(text, delimiter)
+            data  = text.encode()
+            cuts  = sorted(rng.sample(range(len(data) + 1), min(3, len(data) + 1)))
+            parts = [data[i:j] for i, j in zip([0] + cuts, cuts + [len(data)])]
+            assert sum(_config_blocks(parts), []) == text.split('\n')  # Cuts may split a character
+      capsys.readouterr()
+
+   def test_29_config_bad_line_is_skipped(self, capsys, monkeypatch):
+      with open(self.config_file, 'w') as f: f.write("# Settings\nKey_1 Value 1\n\nbroken\nKey_2 2\n")
+      for block_size in (crypto_lib.CONFIG_BLOCK_SIZE, 5):  # Line numbers run on across blocks
+         monkeypatch.setattr(crypto_lib, "CONFIG_BLOCK_SIZE", block_size)
+         assert read_config_file(self.config_file) == {"Key_1": "Value 1", "Key_2": "2"}
+         assert "line 4\n" in capsys.readouterr().err
+         assert list(iter_config_file(self.config_file)) == [("Key_1", "Value 1"), ("Key_2", "2")]
+         assert "line 4\n" in capsys.readouterr().err
+      assert read_config_file(self.config_file, delimiter="") == {}
+
+   def test_30_iter_config_file_streams_frames(self):
+      config_data = {f"Key_{i}": f"Value {i} é" for i in range(300)}
+      clear = io.BytesIO("".join(f"{k} {v}\n" for k, v in config_data.items()).encode())
+      with open(self.enc_config_file, 'wb') as f:
+         stream_lib.encrypt_stream(load_key(self.key_file).crypto_key, clear, f, chunk_size=100)
+      assert dict(iter_config_file(self.enc_config_file, self.key_file)) == config_data
+      assert read_config_file(self.enc_config_file, self.key_file) == config_data
+
+   def test_31_load_store_key(self):
+      import keystore_lib
+      store_file = "test_keys.store"
+      try:
+         keys = dict(zip(["tenant-1", "tenant-2"], keystore_lib.generate_keys(2)))
+         keystore_lib.write_keystore(store_file, keys.items(), load_key(self.key_file).crypto_key)
+         context = load_store_key(store_file, "tenant-2", self.key_file)
+         assert context.crypto_key == keys["tenant-2"]
+         assert load_store_key(store_file, "tenant-2", self.key_file) is context  # Cached
+         assert write_config_file(self.enc_config_file, self.config_data, context)
+         assert read_config_file(self.enc_config_file, context) == self.config_data
+         with pytest.raises(ValueError, match="No key named"):
+            load_store_key(store_file, "tenant-3", self.key_file)
+      finally:
+         if os.path.isfile(store_file): os.remove(store_file)
+
+   def test_32_encrypt_and_decrypt_values(self):
+      values = ["plain", "ünïcode", "", "x" * 1000]
+      for cipher in ("fernet", "aes-gcm", "chacha20"):
+         tokens = encrypt_values(values, self.key_file, cipher)
+         assert all(isinstance(token, str) for token in tokens) and len(set(tokens)) == len(tokens)
+         assert decrypt_values(tokens, self.key_file) == values
+         assert decrypt_values(encrypt_values([b"\x00\xff"], self.key_file, cipher), self.key_file, None) == [b"\x00\xff"]
+         new_key = CryptoContext(Fernet.generate_key(), [load_key(self.key_file).crypto_key])
+         assert decrypt_values(tokens, new_key) == values  # Old keys of a ring still decrypt
+         with pytest.raises(ValueError, match="Value 0"):
+            decrypt_values(tokens, CryptoContext(Fernet.generate_key()))
+      assert load_key(self.key_file).decrypt(encrypt_values(["plain"], self.key_file)[0].encode()) == b"plain"
+
+   def test_33_json_fields(self):
+      document = {"name": "billing", "db": {"host": "db1", "password": "s3cret", "port": 5432},
+                  "tenants": [{"id": 1, "api_key": "k1"}, {"id": 2, "api_key": {"scopes": ["read"]}}]}
+      encrypted = encrypt_json_fields(document, ["db.password", ("db", "port"), "tenants.*.api_key", "no.such"],
+                                      self.key_file, "aes-gcm")
+      assert encrypted["name"] == "billing" and encrypted["db"]["host"] == "db1" and encrypted["tenants"][1]["id"] == 2
+      assert encrypted["db"]["password"].startswith("ENC[") and "s3cret" not in json.dumps(encrypted)
+      assert document["db"]["password"] == "s3cret"  # The input is left as it was
+      assert encrypt_json_fields(encrypted, ["db.password"], self.key_file) == encrypted  # Not encrypted twice
+      assert decrypt_json_fields(encrypted, self.key_file) == document
+      encrypted["db"]["host"] = encrypted["db"]["password"]
+      with pytest.raises(ValueError, match="moved"):
+         decrypt_json_fields(encrypted, self.key_file)
+
+   def test_34_json_file_with_fields(self, monkeypatch):
+      document = {"public": {f"setting_{i}": i for i in range(100)}, "secrets": {"token": "t0k3n", "pin": 1234}}
+      assert write_json_file(self.json_file, document, self.key_file, fields=["secrets.*"])
+      with open(self.json_file) as f: assert json.load(f)["public"] == document["public"]
+      assert read_json_file(self.json_file, self.key_file, fields=True) == document
+      decrypted = []
+      decrypt = crypto_lib.decrypt_values
+      monkeypatch.setattr(crypto_lib, "decrypt_values", lambda tokens, *args: decrypted.extend(tokens) or decrypt(tokens, *args))
+      lazy = read_json_file_lazy(self.json_file, self.key_file)
+      assert lazy["public"]["setting_42"] == 42 and len(lazy["public"]) == 100
+      assert decrypted == []  # Nothing read that is encrypted, nothing decrypted
+      assert lazy["secrets"]["pin"] == 1234 and lazy["secrets"]["pin"] == 1234
+      assert len(decrypted) == 1  # One field read, once
+      assert lazy.to_dict() == document
+      assert read_json_file_lazy("no_such_file.json", self.key_file) == {}
+
+   def test_35_async_single_flight_first_caller_mutates(self):
+      assert write_json_file(self.enc_json_file, self.json_data, self.key_file)
+      async def first():
+         data = await aread_json_file(self.enc_json_file, self.key_file)
+         data["Key_1"] = "MUTATED"  # Before the other callers resume
+         return data
+      async def readers():
+         return await asyncio.gather(first(), *[aread_json_file(self.enc_json_file, self.key_file) for _ in range(5)])
+      results = asyncio.run(readers())
+      assert results[0]["Key_1"] == "MUTATED"
+      assert all(r == self.json_data for r in results[1:])
+
+
+   def test_36_async_timeout_after_rename_succeeds(self, monkeypatch):
+      import time
+      import atomic_lib
+      monkeypatch.setattr(atomic_lib, "_sync_directory", lambda directory: time.sleep(0.3))
+      async def write():
+         return await awrite_json_file(self.json_file, {"new": 1}, timeout=0.1)
+      assert asyncio.run(write())  # The timeout came after the rename, the write went through
+      assert read_json_file(self.json_file) == {"new": 1}
+
+   def test_37_async_single_flight_per_loop(self):
+      import threading
+      assert write_json_file(self.enc_json_file, self.json_data, self.key_file)
+      results = []
+      async def readers():
+         return await asyncio.gather(*[aread_json_file(self.enc_json_file, self.key_file) for _ in range(20)])
+      threads = [threading.Thread(target=lambda: results.extend(asyncio.run(readers()))) for _ in range(4)]
+      for thread in threads: thread.start()
+      for thread in threads: thread.join()
+      assert len(results) == 80 and all(r == self.json_data for r in results)
+      assert not any(crypto_lib._flights.values())  # Nothing left in flight, on any loop
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
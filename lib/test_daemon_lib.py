@@ -0,0 +1,94 @@
+#
+# Unit tests of daemon_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+import pytest
+import stream_lib
+from cryptography.fernet import Fernet
+from daemon_lib import *
+
+LIB_PATH   = os.path.dirname(os.path.abspath(__file__))
+UTILS_PATH = os.path.join(LIB_PATH, "..", "utils")
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: A daemon holding one key, listening in a scratch directory
+   directory   = tempfile.mkdtemp(prefix="daemon_lib_")
+   key         = Fernet.generate_key()
+   key_file    = os.path.join(directory, "a.key")
+   socket_path = os.path.join(directory, "daemon.sock")
+   with open(key_file, 'wb') as f: f.write(key)
+   daemon = subprocess.Popen([sys.executable, "-c", "import sys, daemon_lib; "
+                              "daemon_lib.serve([open(sys.argv[1], 'rb').read()], sys.argv[2], 2)", key_file, socket_path],
+                             cwd=LIB_PATH)
+   deadline = time.time() + 10
+   while not os.path.exists(socket_path) and time.time() < deadline: time.sleep(0.01)
+   request.cls.directory   = directory
+   request.cls.key         = key
+   request.cls.key_file    = key_file
+   request.cls.socket_path = socket_path
+   request.cls.data        = os.urandom(100000)
+   request.cls.daemon      = daemon
+   yield
+   # Test Takedown: Stop the daemon and remove the scratch directory
+   daemon.send_signal(signal.SIGTERM)
+   daemon.wait(10)
+   shutil.rmtree(directory, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_daemon_lib:
+
+   def run(self, operation, source, output, keys=None, **options):
+      with open(source, 'rb') as in_file, open(output, 'wb') as out_file:
+         return submit(operation, keys or [self.key], in_file.fileno(), out_file.fileno(),
+                       socket_path=self.socket_path, **options)
+
+   def test_01_round_trip(self):
+      clear  = os.path.join(self.directory, "clear")
+      framed = os.path.join(self.directory, "clear.enc")
+      back   = os.path.join(self.directory, "clear.out")
+      with open(clear, 'wb') as f: f.write(self.data)
+      for options in ({}, {"stream": True, "chunk_size": 4096, "binary": True, "cipher": "aes-gcm"}):
+         assert self.run("encrypt", clear, framed, **options) == (STATUS_OK, len(self.data), "")
+         assert self.run("decrypt", framed, back) == (STATUS_OK, len(self.data), "")
+         with open(back, 'rb') as f: assert f.read() == self.data
+      assert stream_lib.read_header(framed)["chunk_size"] == 4096
+
+   def test_02_unknown_key_or_no_daemon(self):
+      source = os.path.join(self.directory, "clear")
+      output = os.path.join(self.directory, "unused")
+      assert self.run("encrypt", source, output, keys=[Fernet.generate_key()]) is None
+      with open(source, 'rb') as in_file:
+         assert submit("encrypt", [self.key], in_file.fileno(), 1, socket_path=self.socket_path + ".none") is None
+
+   def test_03_failure_is_reported(self):
+      damaged = os.path.join(self.directory, "damaged.enc")
+      with open(damaged, 'wb') as f: f.write(Fernet(Fernet.generate_key()).encrypt(b"other key"))
+      status, size, error = self.run("decrypt", damaged, os.path.join(self.directory, "unused"))
+      assert (status, size, error) == (STATUS_DECRYPT, 0, "InvalidToken")
+
+   def test_04_one_daemon_per_socket(self):
+      with pytest.raises(ValueError, match="already listening"):
+         serve([self.key], self.socket_path, 1)
+      assert self.daemon.poll() is None
+
+   def test_05_filecryptor_uses_daemon(self):
+      source = os.path.join(self.directory, "report.txt")
+      with open(source, 'wb') as f: f.write(b"quarterly numbers\n")
+      environment = dict(os.environ, FILECRYPTOR_SOCKET=self.socket_path)
+      command = [sys.executable, "-X", "importtime", os.path.join(UTILS_PATH, "filecryptor.py")]
+      subprocess.run(command + ["-e", self.key_file, source], env=environment, check=True, capture_output=True)
+      process = subprocess.run(command + [self.key_file, source + ".enc"], env=environment, capture_output=True)
+      assert process.returncode == 0 and process.stdout == b"quarterly numbers\n"
+      assert b"cryptography" not in process.stderr  # The client never imported it
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
@@ -0,0 +1,110 @@
+#
+# Unit tests of keystore_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import shutil
+import tempfile
+import pytest
+from cryptography.fernet import Fernet
+import keystore_lib
+from keystore_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Keys for a few hundred tenants and a master key, in a scratch directory
+   directory = tempfile.mkdtemp(prefix="keystore_lib_")
+   request.cls.directory  = directory
+   request.cls.store_file = os.path.join(directory, "tenants.store")
+   request.cls.clear_file = os.path.join(directory, "clear.store")
+   request.cls.master_key = Fernet.generate_key()
+   request.cls.keys       = {f"tenant-{i}": key for i, key in enumerate(generate_keys(300), 1)}
+   yield
+   # Test Takedown: Remove the scratch directory
+   shutil.rmtree(directory, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_keystore_lib:
+
+   def test_01_write_and_load(self):
+      assert write_keystore(self.store_file, self.keys.items(), self.master_key) == len(self.keys)
+      assert load_keystore_key(self.store_file, "tenant-17", self.master_key) == self.keys["tenant-17"]
+      with KeyStore(self.store_file, self.master_key) as store:
+         assert len(store) == len(self.keys)
+         assert all(store[name] == key for name, key in self.keys.items())
+         assert store.get("tenant-0") is None and "tenant-301" not in store
+      with pytest.raises(ValueError, match="No key named"):
+         load_keystore_key(self.store_file, "nobody", self.master_key)
+
+   def test_02_names_are_not_stored_in_clear(self):
+      with open(self.store_file, 'rb') as f: data = f.read()
+      assert b"tenant-" not in data
+      assert not any(key in data for key in self.keys.values())
+
+   def test_03_master_key_is_checked(self):
+      with pytest.raises(ValueError, match="different master key"):
+         load_keystore_key(self.store_file, "tenant-1", Fernet.generate_key())
+      with pytest.raises(ValueError, match="master key is needed"):
+         KeyStore(self.store_file)
+
+   def test_04_add_keeps_existing_keys(self):
+      with open(self.store_file, 'rb') as f: before = f.read()
+      new = dict(zip(["alice", "bob"], generate_keys(2)))
+      assert write_keystore(self.store_file, new.items(), self.master_key) == 2
+      assert dict(iter_keystore(self.store_file, self.master_key)) == dict(self.keys, **new)
+      with pytest.raises(ValueError, match="already in"):
+         write_keystore(self.store_file, [("tenant-5", new["bob"])], self.master_key)
+      with pytest.raises(ValueError, match="Invalid cryptographic key"):
+         write_keystore(self.store_file, [("carol", b"not a key")], self.master_key)
+      with KeyStore(self.store_file, self.master_key) as store:
+         assert store.names()[:len(self.keys)] == list(self.keys)  # Order of addition
+         assert len(store) == len(self.keys) + 2
+      with open(self.store_file, 'rb') as f: after = f.read()
+      assert len(after) > len(before)
+
+   def test_05_clear_store_lookups_read_little(self, monkeypatch):
+      write_keystore(self.clear_file, self.keys.items())
+      with open(self.clear_file, 'rb') as f: assert b"tenant-42" in f.read()
+      reads = []
+      with KeyStore(self.clear_file) as store:
+         read = store._file.read
+         monkeypatch.setattr(store._file, "read", lambda size=-1: reads.append(size) or read(size), raising=False)
+         assert store["tenant-42"] == self.keys["tenant-42"]
+      assert 0 < len(reads) <= 4 and -1 not in reads  # A slot or two and the record, never the whole file
+
+   def test_06_damaged_store(self):
+      with open(self.clear_file, 'rb') as f: data = f.read()
+      with open(self.clear_file, 'wb') as f: f.write(data[:100])
+      with pytest.raises(ValueError, match="damaged"):
+         KeyStore(self.clear_file)
+      with open(self.clear_file, 'wb') as f: f.write(b"plain text, not a store")
+      with pytest.raises(ValueError, match="not a key store"):
+         KeyStore(self.clear_file)
+
+
+   def test_07_crafted_table(self):
+      os.remove(self.clear_file)
+      write_keystore(self.clear_file, list(self.keys.items())[:3])
+      with open(self.clear_file, 'rb') as f: data = bytearray(f.read())
+      header = keystore_lib._HEADER.unpack_from(data)
+      slots, table = header[5], keystore_lib._HEADER.size
+      records = table + slots * keystore_lib._SLOT.size
+      for slot in range(slots):  # No free slot left, every record out of the file
+         keystore_lib._SLOT.pack_into(data, table + slot * keystore_lib._SLOT.size, bytes([slot + 1]) * 16, records, 10**9)
+      with open(self.clear_file, 'wb') as f: f.write(data)
+      with KeyStore(self.clear_file) as store:
+         with pytest.raises(ValueError, match="damaged"):
+            store.get("tenant-1")  # Probes every slot once, then gives up
+         digest = store._codec.digest("tenant-1")
+      keystore_lib._SLOT.pack_into(data, table + keystore_lib._slot_of(digest, slots) * keystore_lib._SLOT.size,
+                                   digest, records, 10**9)
+      with open(self.clear_file, 'wb') as f: f.write(data)
+      with KeyStore(self.clear_file) as store:
+         with pytest.raises(ValueError, match="damaged"):
+            store.get("tenant-1")  # Found, but its record lies past the end of the file
+      with pytest.raises(ValueError, match="damaged"):
+         list(iter_keystore(self.clear_file))
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
@@ -0,0 +1,129 @@
+#
+# Unit tests of kvstore_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import struct
+import pytest
+import crypto_lib
+from cryptography.fernet import Fernet
+import kvstore_lib
+from kvstore_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Define test data and create a key file
+   key_file   = "kvstore_test.key"
+   store_file = "kvstore_test.kvs"
+   with open(key_file, 'wb') as filekey: filekey.write(Fernet.generate_key())
+   request.cls.key_file    = key_file
+   request.cls.store_file  = store_file
+   request.cls.config_file = "kvstore_test.cfg"
+   request.cls.config_data = {f"key_{i}": f"value {i}" for i in range(200)}
+   yield
+   # Test Takedown: Clean up any left over files
+   for file_name in [key_file, store_file, f"{store_file}.idx", request.cls.config_file]:
+      if os.path.isfile(file_name): os.remove(file_name)
+
+@pytest.mark.usefixtures("setup")
+class Test_kvstore_lib:
+
+   def test_01_put_get(self):
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         for key, value in self.config_data.items(): store.put(key, value)
+         assert store.get("key_7") == "value 7"
+         assert store.get("missing") is None
+         assert len(store) == len(self.config_data)
+
+   def test_02_reopen_update_delete(self):
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store["key_42"] == "value 42"
+         store["key_42"] = "changed"
+         assert store.delete("key_43")
+         assert not store.delete("key_43")
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store["key_42"] == "changed"
+         assert "key_43" not in store
+         assert len(store) == len(self.config_data) - 1
+
+   def test_03_single_decrypt_per_get(self):
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         calls = []
+         decrypt = store._context.decrypt
+         store._context = crypto_lib.CryptoContext(store._context.crypto_key)
+         store._context.decrypt = lambda token: calls.append(1) or decrypt(token)
+         store.get("key_99")
+         assert len(calls) == 1
+
+   def test_04_index_rebuilt(self):
+      index_size = os.path.getsize(f"{self.store_file}.idx")
+      os.remove(f"{self.store_file}.idx")
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store["key_42"] == "changed"
+         assert "key_43" not in store
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert os.path.getsize(f"{self.store_file}.idx") == index_size
+
+   def test_05_compact(self):
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         for i in range(5): store["key_1"] = f"again {i}"
+         assert store.garbage_bytes() > 0
+         store.compact()
+         assert store.garbage_bytes() == 0
+         assert store["key_1"] == "again 4"
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store["key_1"] == "again 4"
+         assert len(store) == len(self.config_data) - 1
+
+   def test_06_config_export_import(self):
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store.export_config(self.config_file, self.key_file)
+         exported = crypto_lib.read_config_file(self.config_file, self.key_file)
+         assert exported == dict(store.items())
+      os.remove(self.store_file)
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store.import_config(self.config_file, self.key_file) == len(exported)
+         assert dict(store.items()) == exported
+
+   def test_07_wrong_key(self):
+      with pytest.raises(ValueError, match="different key"):
+         EncryptedKVStore(self.store_file, crypto_lib.CryptoContext(Fernet.generate_key()))
+
+   def test_08_edited_index_does_not_roll_back(self):
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         store["rolled"] = "old"
+         old_entry = os.path.getsize(store.index_file) - kvstore_lib._ENTRY.size
+         store["rolled"] = "new"
+         new_entry = os.path.getsize(store.index_file) - kvstore_lib._ENTRY.size
+      with open(f"{self.store_file}.idx", 'r+b') as f:
+         f.seek(old_entry)
+         _, offset, length, _, _ = kvstore_lib._ENTRY.unpack(f.read(kvstore_lib._ENTRY.size))
+         f.seek(new_entry + 16)
+         f.write(struct.pack(">QI", offset, length))  # Point the key back to its old record
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store["rolled"] == "new"
+
+   def test_09_index_ahead_of_store(self):
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         store[1] = "one"
+         store["lost"] = "in the crash"
+         assert store.delete(1) and 1 not in store and store.get(1) is None
+         store["kept"] = "yes"
+         size = os.path.getsize(self.store_file)
+      with open(self.store_file, 'r+b') as f: f.truncate(size - 30)  # The last record never reached the disk
+      with EncryptedKVStore(self.store_file, self.key_file) as store:
+         assert store.get("kept") is None and store["lost"] == "in the crash"
+
+   def test_10_compact_leaves_other_files(self):
+      other = f"{self.store_file}.tmp"
+      with open(other, 'wb') as f: f.write(b"not ours")
+      try:
+         with EncryptedKVStore(self.store_file, self.key_file) as store: store.compact()
+         with open(other, 'rb') as f: assert f.read() == b"not ours"
+         with EncryptedKVStore(self.store_file, self.key_file) as store: assert store["lost"] == "in the crash"
+      finally:
+         os.remove(other)
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
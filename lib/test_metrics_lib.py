@@ -0,0 +1,57 @@
+#
+# Unit tests of metrics_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import json
+import pytest
+from metrics_lib import *
+from metrics_lib import _NO_PHASE
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: One collector registered for the whole class
+   collector = MetricsCollector()
+   request.cls.collector = collector
+   yield
+   # Test Takedown: Leave no hook behind
+   remove_hook(collector)
+
+@pytest.mark.usefixtures("setup")
+class Test_metrics_lib:
+
+   def test_01_no_op_default(self):
+      assert not enabled()
+      assert phase("read") is _NO_PHASE and operation("x") is _NO_PHASE
+      with phase("read") as timer: timer.add(10)
+      assert self.collector.snapshot() == []
+
+   def test_02_collect(self):
+      add_hook(self.collector)
+      with operation("read_json_file"):
+         with operation("nested"):
+            with phase("read", 100): pass
+         with phase("parse") as timer: timer.add(40)
+      with phase("parse"): pass
+      snapshot = self.collector.snapshot()
+      assert [(s["operation"], s["phase"], s["bytes"]) for s in snapshot] == \
+             [("", "parse", 0), ("read_json_file", "read", 100), ("read_json_file", "parse", 40)]
+
+   def test_03_exporters(self):
+      assert json.loads(self.collector.to_json())[1]["calls"] == 1
+      prometheus = self.collector.to_prometheus()
+      assert 'filecryptor_phase_bytes_total{operation="read_json_file",phase="read"} 100' in prometheus
+      assert "# TYPE filecryptor_phase_seconds_total counter" in prometheus
+      assert "read_json_file" in self.collector.to_text()
+
+   def test_04_failing_hook(self):
+      def broken(*args): raise RuntimeError("broken hook")
+      add_hook(broken)
+      try:
+         with phase("write", 5): pass
+      finally:
+         remove_hook(broken)
+      assert ("", "write", 5) in [(s["operation"], s["phase"], s["bytes"]) for s in self.collector.snapshot()]
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
@@ -0,0 +1,92 @@
+#
+# Unit tests of rotate_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import io
+import os
+import json
+import shutil
+import tempfile
+import pytest
+import atomic_lib
+import batch_lib
+import stream_lib
+from cryptography.fernet import Fernet
+from rotate_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: A tree of files encrypted with the old key in every format
+   old_key = Fernet.generate_key()
+   new_key = Fernet.generate_key()
+   tree    = tempfile.mkdtemp(prefix="rotate_lib_")
+   data    = os.urandom(5000)
+   files   = []
+   for name, cipher, binary in (("a", None, False), ("b", "fernet", False), ("c", "fernet", True), ("d", "aes-gcm", True)):
+      file_name = os.path.join(tree, f"{name}.enc")
+      with open(file_name, 'wb') as f:
+         if cipher is None: f.write(Fernet(old_key).encrypt(data))
+         else: stream_lib.encrypt_stream(old_key, io.BytesIO(data), f, 1024, binary=binary, cipher=cipher)
+      files.append(file_name)
+   request.cls.old_key = old_key
+   request.cls.new_key = new_key
+   request.cls.tree    = tree
+   request.cls.data    = data
+   request.cls.files   = files
+   request.cls.journal = os.path.join(tree, "rotate.journal")
+   yield
+   # Test Takedown: Remove the tree
+   shutil.rmtree(tree, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_rotate_lib:
+
+   def test_01_key_is_current(self):
+      assert all(key_is_current(self.old_key, f) for f in self.files)
+      assert not any(key_is_current(self.new_key, f) for f in self.files)
+
+   def test_02_rotate_one(self):
+      formats = stream_lib.read_header(self.files[2])
+      result  = rotate_file([self.new_key, self.old_key], self.files[2])
+      assert result["status"] == batch_lib.STATUS_OK and result["action"] == "rotated"
+      assert stream_lib.read_decrypted(self.new_key, self.files[2]) == self.data
+      header = stream_lib.read_header(self.files[2])
+      assert (header["binary"], header["chunk_size"]) == (formats["binary"], formats["chunk_size"])
+
+   def test_03_wrong_ring_keeps_file(self):
+      with open(self.files[0], 'rb') as f: before = f.read()
+      result = rotate_file([Fernet.generate_key(), self.new_key], self.files[0])
+      assert result["status"] == batch_lib.STATUS_DECRYPT
+      with open(self.files[0], 'rb') as f: assert f.read() == before
+
+   def test_04_rotate_tree_with_journal(self):
+      keys = [self.new_key, self.old_key]
+      first = next(rotate_files(keys, [self.tree], self.journal))
+      assert first["action"] == "rotated"
+      results = list(rotate_files(keys, [self.tree], self.journal, jobs=2))
+      assert [r["source"] for r in results] == self.files[1:]
+      assert [r["action"] for r in results] == ["rotated", "current", "rotated"]
+      for file_name in self.files:
+         assert key_is_current(self.new_key, file_name)
+         assert stream_lib.read_decrypted(self.new_key, file_name) == self.data
+      assert list(rotate_files(keys, [self.tree], self.journal)) == []
+
+   def test_05_journal_of_other_rotation(self):
+      with pytest.raises(ValueError, match="another key"):
+         list(rotate_files([self.old_key], [self.tree], self.journal))
+
+   def test_06_journal_written_after_directories(self, monkeypatch):
+      journal_file = os.path.join(self.tree, "ordered.journal")
+      seen = []
+      monkeypatch.setattr(atomic_lib, "_sync_directory", lambda directory: seen.append(open(journal_file).read()))
+      group = atomic_lib.GroupCommit()
+      with RotationJournal(journal_file, self.new_key, group) as journal:
+         group.add(self.tree)
+         journal.record({"source": self.files[0], "status": batch_lib.STATUS_OK})
+         assert json.dumps(os.path.abspath(self.files[0])) not in open(journal_file).read()
+      assert len(seen) == 1 and json.dumps(os.path.abspath(self.files[0])) not in seen[0]
+      with RotationJournal(journal_file, self.new_key) as journal: assert self.files[0] in journal
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
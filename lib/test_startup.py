@@ -0,0 +1,79 @@
+#
+# Startup budget of the command line utilities.  filecryptor.py and
+# keygen.py are run thousands of times from shell scripts, so for small
+# files their start up time is most of the run time.  These tests run them
+# under python -X importtime and fail if a module that only some runs need
+# is imported anyway, or if the imports take longer than the budget.
+#
+# The budget is generous on purpose, it catches a heavy import slipping back
+# in (pytest alone takes well over 100ms), not noise.  Set the environment
+# variable STARTUP_BUDGET_MS to tighten or relax it on a given host.
+#
+# Run them with pytest from this folder, or run this file as a main program.
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import pytest
+
+UTILS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils")
+BUDGET_MS  = float(os.environ.get("STARTUP_BUDGET_MS", 150))
+NOT_NEEDED = ("pytest", "asyncio", "multiprocessing", "concurrent.futures", "json", "batch_lib", "rotate_lib", "sync_lib", "keystore_lib", "archive_lib")
+
+# ----------------------------------------------------------------------------- import_times()
+def import_times(script, arguments, cwd):
+   """ Runs a utility under -X importtime and returns a dictionary of
+       module name to (cumulative microseconds, imported at top level). """
+   command = [sys.executable, "-X", "importtime", os.path.join(UTILS_PATH, script)] + arguments
+   process = subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+   assert process.returncode == 0, process.stderr
+   times = {}
+   for line in process.stderr.splitlines():
+      if not line.startswith("import time:") or "cumulative" in line: continue
+      _, cumulative, name = line.split("|")
+      times[name.strip()] = (int(cumulative), not name.startswith("  "))
+   return times
+
+# ----------------------------------------------------------------------------- startup_ms()
+def startup_ms(script, arguments, cwd, runs=3):
+   """ Returns the total import time of a run in milliseconds, the best of
+       runs so that a busy host does not fail the budget. """
+   return min(sum(cumulative for cumulative, top in import_times(script, arguments, cwd).values() if top)
+              for _ in range(runs)) / 1000
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: A key and a small encrypted file made with the utilities
+   directory = tempfile.mkdtemp(prefix="test_startup_")
+   with open(os.path.join(directory, "small.txt"), 'w') as f: f.write("small secret\n")
+   for script, arguments in (("keygen.py", ["a.key"]), ("filecryptor.py", ["-e", "a.key", "small.txt"])):
+      subprocess.run([sys.executable, os.path.join(UTILS_PATH, script)] + arguments, cwd=directory,
+                     stdout=subprocess.DEVNULL, check=True)
+   request.cls.directory = directory
+   yield
+   # Test Takedown: Remove the scratch directory
+   shutil.rmtree(directory, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_startup:
+
+   def test_01_decrypt_imports_only_what_it_needs(self):
+      times = import_times("filecryptor.py", ["a.key", "small.txt.enc"], self.directory)
+      assert "stream_lib" in times
+      assert [name for name in NOT_NEEDED if name in times] == []
+
+   def test_02_library_imports_without_pytest(self):
+      process = subprocess.run([sys.executable, "-c", "import sys, crypto_lib; print('pytest' in sys.modules)"],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+      assert process.stdout.strip() == "False", process.stderr
+
+   def test_03_startup_budget(self):
+      for script, arguments in (("filecryptor.py", ["a.key", "small.txt.enc"]), ("keygen.py", ["b.key"])):
+         elapsed = startup_ms(script, arguments, self.directory)
+         assert elapsed < BUDGET_MS, f"{script} imports took {elapsed:.1f}ms, budget {BUDGET_MS:.0f}ms"
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
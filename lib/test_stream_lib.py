@@ -0,0 +1,244 @@
+#
+# Unit tests of stream_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import io
+import os
+import pytest
+import cipher_lib
+from cryptography.fernet import Fernet, InvalidToken
+from stream_lib import *
+from stream_lib import _LENGTH, _unpack_header
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: Define test data.  Everything runs in memory.
+   request.cls.key       = Fernet.generate_key()
+   request.cls.other_key = Fernet.generate_key()
+   request.cls.data      = os.urandom(10000)
+
+@pytest.mark.usefixtures("setup")
+class Test_stream_lib:
+
+   def encrypt(self, data, chunk_size=1024):
+      out = io.BytesIO()
+      assert encrypt_stream(self.key, io.BytesIO(data), out, chunk_size) == len(data)
+      return out.getvalue()
+
+   def decrypt(self, encrypted, key=None):
+      out = io.BytesIO()
+      decrypt_stream(key or self.key, io.BytesIO(encrypted), out)
+      return out.getvalue()
+
+   def frames(self, encrypted):
+      frames, offset = [], HEADER_SIZE
+      while offset < len(encrypted):
+         (length,) = _LENGTH.unpack_from(encrypted, offset)
+         frames.append(encrypted[offset:offset + _LENGTH.size + length])
+         offset += _LENGTH.size + length
+      return frames
+
+   def test_01_round_trip(self):
+      encrypted = self.encrypt(self.data)
+      assert detect_format(encrypted) == "framed"
+      assert self.decrypt(encrypted) == self.data
+
+   def test_02_round_trip_chunk_multiple(self):
+      assert self.decrypt(self.encrypt(self.data[:4096])) == self.data[:4096]
+
+   def test_03_empty_input(self):
+      assert self.decrypt(self.encrypt(b"")) == b""
+
+   def test_04_truncated_stream(self):
+      encrypted = self.encrypt(self.data)
+      frames = self.frames(encrypted)
+      with pytest.raises(ValueError, match="final frame"):
+         self.decrypt(encrypted[:HEADER_SIZE] + b"".join(frames[:-1]))
+
+   def test_05_reordered_frames(self):
+      encrypted = self.encrypt(self.data)
+      frames = self.frames(encrypted)
+      frames[0], frames[1] = frames[1], frames[0]
+      with pytest.raises(ValueError, match="out of order"):
+         self.decrypt(encrypted[:HEADER_SIZE] + b"".join(frames))
+
+   def test_06_spliced_frames(self):
+      first, second = self.encrypt(self.data), self.encrypt(self.data)
+      with pytest.raises(ValueError, match="does not belong"):
+         self.decrypt(first[:HEADER_SIZE] + second[HEADER_SIZE:])
+
+   def test_07_wrong_key(self):
+      with pytest.raises(ValueError, match="different key"):
+         self.decrypt(self.encrypt(self.data), self.other_key)
+
+   def test_08_parallel_round_trip(self):
+      for executor in EXECUTORS:
+         encrypted, decrypted = io.BytesIO(), io.BytesIO()
+         encrypt_stream(self.key, io.BytesIO(self.data), encrypted, 512, jobs=3, executor=executor)
+         decrypt_stream(self.key, io.BytesIO(encrypted.getvalue()), decrypted, jobs=3, executor=executor)
+         assert decrypted.getvalue() == self.data
+         assert self.decrypt(encrypted.getvalue()) == self.data
+
+   def test_09_parallel_detects_truncation(self):
+      encrypted = self.encrypt(self.data)
+      frames = self.frames(encrypted)
+      with pytest.raises(ValueError, match="final frame"):
+         decrypt_stream(self.key, io.BytesIO(encrypted[:HEADER_SIZE] + b"".join(frames[:-1])),
+                        io.BytesIO(), jobs=2, executor="thread")
+
+   def test_10_encrypt_iterable(self):
+      pieces = [self.data[i:i + 700] for i in range(0, len(self.data), 700)]
+      out = io.BytesIO()
+      assert encrypt_iterable(self.key, iter(pieces), out, 1024) == len(self.data)
+      assert self.decrypt(out.getvalue()) == self.data
+
+   def test_11_mmap_decrypt(self):
+      file_name = "stream_lib_test.enc"
+      try:
+         for encrypted in (self.encrypt(self.data), Fernet(self.key).encrypt(self.data), self.encrypt(b"")):
+            with open(file_name, 'wb') as f: f.write(encrypted)
+            expected = b"" if len(encrypted) < 200 else self.data
+            out = io.BytesIO()
+            assert mmap_decrypt_file(self.key, file_name, out) == len(expected)
+            assert out.getvalue() == expected
+            assert read_decrypted(self.key, file_name) == expected
+         with open(file_name, 'wb') as f: f.write(self.encrypt(self.data)[:-10])
+         with pytest.raises(ValueError, match="Truncated"):
+            mmap_decrypt_file(self.key, file_name, bytearray())
+      finally:
+         if os.path.isfile(file_name): os.remove(file_name)
+
+   def test_12_decrypt_token_into_rejects_tampering(self):
+      token  = bytearray(Fernet(self.key).encrypt(b"secret"))
+      buffer = bytearray(len(token))
+      assert buffer[:decrypt_token_into(self.key, bytes(token), buffer)] == b"secret"
+      token[-5] ^= 1
+      with pytest.raises(InvalidToken):
+         decrypt_token_into(self.key, bytes(token), buffer)
+      with pytest.raises(InvalidToken):
+         decrypt_token_into(self.other_key, Fernet(self.key).encrypt(b"x"), buffer)
+
+   def test_13_binary_round_trip(self):
+      encrypted, decrypted = io.BytesIO(), io.BytesIO()
+      encrypt_stream(self.key, io.BytesIO(self.data), encrypted, 1024, binary=True)
+      assert len(encrypted.getvalue()) < len(self.encrypt(self.data)) * 0.8
+      assert self.decrypt(encrypted.getvalue()) == self.data
+      decrypt_stream(self.key, io.BytesIO(encrypted.getvalue()), decrypted, jobs=2, executor="thread")
+      assert decrypted.getvalue() == self.data
+
+   def test_14_raw_tokens_match_fernet(self):
+      token = encrypt_token(self.key, b"secret")
+      assert Fernet(self.key).decrypt(token) == b"secret"
+      raw, buffer = encrypt_token(self.key, b"secret", encoded=False), bytearray(100)
+      assert buffer[:decrypt_token_into(self.key, memoryview(raw), buffer, encoded=False)] == b"secret"
+      assert token_signed_by(self.key, token) and not token_signed_by(self.other_key, token)
+
+   def test_15_convert_file(self):
+      names = ["stream_lib_test.src", "stream_lib_test.bin", "stream_lib_test.b64"]
+      try:
+         with open(names[0], 'wb') as f: f.write(Fernet(self.key).encrypt(self.data))
+         convert_file(self.key, names[0], names[1])
+         convert_file(self.key, names[1], names[2], binary=False)
+         for file_name in names[1:]:
+            assert read_decrypted(self.key, file_name) == self.data
+         with open(names[1], 'rb') as f: assert _unpack_header(f.read(HEADER_SIZE), self.key)["binary"]
+      finally:
+         for file_name in names:
+            if os.path.isfile(file_name): os.remove(file_name)
+
+   def test_16_legacy_detection(self):
+      token = Fernet(self.key).encrypt(self.data)
+      assert detect_format(token[:DETECT_SIZE]) == "fernet"
+      assert detect_format(b"plain text") is None
+
+   def test_17_aead_ciphers(self):
+      file_name = "stream_lib_test.enc"
+      try:
+         for cipher in ("aes-gcm", "chacha20"):
+            encrypted, decrypted = io.BytesIO(), io.BytesIO()
+            encrypt_stream(self.key, io.BytesIO(self.data), encrypted, 1024, cipher=cipher)
+            assert _unpack_header(encrypted.getvalue()[:HEADER_SIZE], self.key)["cipher"] == cipher_lib.cipher_id(cipher)
+            assert self.decrypt(encrypted.getvalue()) == self.data
+            decrypt_stream(self.key, io.BytesIO(encrypted.getvalue()), decrypted, jobs=2, executor="thread")
+            assert decrypted.getvalue() == self.data
+            with open(file_name, 'wb') as f: f.write(encrypted.getvalue())
+            assert read_decrypted(self.key, file_name) == self.data
+            frames = self.frames(encrypted.getvalue())
+            with pytest.raises(ValueError, match="out of order"):
+               self.decrypt(encrypted.getvalue()[:HEADER_SIZE] + frames[1] + frames[0] + b"".join(frames[2:]))
+      finally:
+         if os.path.isfile(file_name): os.remove(file_name)
+
+
+   def test_18_key_ring(self):
+      file_name = "stream_lib_test.enc"
+      ring = (self.other_key, self.key)
+      try:
+         for encrypted in (self.encrypt(self.data), Fernet(self.key).encrypt(self.data)):
+            with open(file_name, 'wb') as f: f.write(encrypted)
+            assert read_decrypted(ring, file_name) == self.data
+            out = io.BytesIO()
+            decrypt_file(list(ring), file_name, out)
+            assert out.getvalue() == self.data
+         assert read_header(file_name) is None
+         out = io.BytesIO()
+         encrypt_stream(ring, io.BytesIO(self.data), out)
+         with open(file_name, 'wb') as f: f.write(out.getvalue())
+         assert read_header(file_name)["key_id"] == key_id(self.other_key)
+         with pytest.raises(ValueError, match="different key"):
+            read_decrypted(self.key, file_name)
+      finally:
+         if os.path.isfile(file_name): os.remove(file_name)
+
+   def test_19_reencrypt_changed(self):
+      old = io.BytesIO()
+      encrypt_stream(self.key, io.BytesIO(self.data), old, 1000, binary=True)
+      changed = bytearray(self.data)
+      changed[4500] ^= 1
+      for new_data, expected in ((bytes(changed), 9), (self.data + b"more", 9), (self.data[:9000], 8)):
+         old.seek(0)
+         out = io.BytesIO()
+         unchanged = lambda i, chunk: chunk == self.data[i * 1000:(i + 1) * 1000]
+         assert reencrypt_changed(self.key, io.BytesIO(new_data), old, out, unchanged) == (len(new_data), expected)
+         assert out.getvalue()[:HEADER_SIZE] == old.getvalue()[:HEADER_SIZE]
+         assert b"".join(iter_decrypt_stream(self.key, io.BytesIO(out.getvalue()))) == new_data
+      with pytest.raises(ValueError, match="different key"):
+         old.seek(0)
+         reencrypt_changed(self.other_key, io.BytesIO(self.data), old, io.BytesIO(), unchanged)
+
+   def test_20_compression(self):
+      file_name = "stream_lib_test.enc"
+      text = b"".join(b"line %d of a very repetitive export\n" % i for i in range(3000))
+      mixed = text[:5000] + self.data + text[:5000]  # Compressible, random, compressible frames
+      try:
+         for compression, binary in (("zlib", False), ("lzma:1", True)):
+            out = io.BytesIO()
+            assert encrypt_stream(self.key, io.BytesIO(text), out, 4096, binary=binary, compression=compression) == len(text)
+            assert len(out.getvalue()) * 4 < len(text)
+            header = _unpack_header(out.getvalue()[:HEADER_SIZE], self.key)
+            assert header["version"] == COMPRESSED_VERSION and header["compression"] > 0
+            assert self.decrypt(out.getvalue()) == text
+            out = io.BytesIO()
+            encrypt_stream(self.key, io.BytesIO(mixed), out, 4096, compression=compression)
+            decrypted = io.BytesIO()
+            decrypt_stream(self.key, io.BytesIO(out.getvalue()), decrypted, jobs=2, executor="thread")
+            assert decrypted.getvalue() == mixed
+            with open(file_name, 'wb') as f: f.write(out.getvalue())
+            assert read_decrypted(self.key, file_name) == mixed
+         assert _unpack_header(self.encrypt(text)[:HEADER_SIZE], self.key)["version"] == FORMAT_VERSION
+      finally:
+         if os.path.isfile(file_name): os.remove(file_name)
+
+   def test_21_compression_is_authenticated(self):
+      out = io.BytesIO()
+      encrypt_stream(self.key, io.BytesIO(b"abc" * 1000), out, compression="zlib")
+      tampered = bytearray(out.getvalue())
+      tampered[7] = 2  # Claim lzma instead of zlib, fails in lzma or on the binding
+      with pytest.raises(ValueError):
+         self.decrypt(bytes(tampered))
+      tampered[4], tampered[7] = FORMAT_VERSION, 0  # Claim no compression
+      with pytest.raises(ValueError):
+         self.decrypt(bytes(tampered))
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
@@ -0,0 +1,121 @@
+#
+# Unit tests of sync_lib.py.  Run them with pytest from this folder, or run
+# this file as a main program.
+
+import os
+import shutil
+import tempfile
+import struct
+import pytest
+import sync_lib
+import stream_lib
+from cryptography.fernet import Fernet
+from sync_lib import *
+
+@pytest.fixture(scope="class")
+def setup(request):
+   # Test Setup: A small source tree, with its mirror inside it, and a key
+   key  = Fernet.generate_key()
+   tree = tempfile.mkdtemp(prefix="sync_lib_")
+   os.makedirs(os.path.join(tree, "sub"))
+   files = {"a.txt": b"alpha", os.path.join("sub", "b.bin"): os.urandom(10000), "c.txt": b""}
+   for relative, data in files.items():
+      with open(os.path.join(tree, relative), 'wb') as f: f.write(data)
+   request.cls.key    = key
+   request.cls.tree   = tree
+   request.cls.mirror = os.path.join(tree, "mirror")
+   request.cls.files  = files
+   yield
+   # Test Takedown: Remove the tree
+   shutil.rmtree(tree, ignore_errors=True)
+
+@pytest.mark.usefixtures("setup")
+class Test_sync_lib:
+
+   def sync(self, **options):
+      return {os.path.relpath(r["source"], self.tree): r for r in sync_tree(self.key, self.tree, self.mirror, **options)}
+
+   def age(self, relative):
+      # Move the mtime out of the racy window, as if the file was older
+      path = os.path.join(self.tree, relative)
+      stat = os.stat(path)
+      os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 * RACY_WINDOW_NS))
+
+   def frames(self, output):
+      with open(output, 'rb') as f: data = f.read()
+      frames, offset = [], stream_lib.HEADER_SIZE
+      while offset < len(data):
+         (length,) = struct.unpack(">I", data[offset:offset + 4])
+         frames.append(data[offset + 4:offset + 4 + length])
+         offset += 4 + length
+      return data[:stream_lib.HEADER_SIZE], frames
+
+   def check_mirror(self):
+      for relative, data in self.files.items():
+         assert stream_lib.read_decrypted(self.key, os.path.join(self.mirror, f"{relative}.enc")) == data
+
+   def test_01_first_sync_encrypts_everything(self):
+      results = self.sync()
+      assert sorted(results) == sorted(self.files)
+      assert {r["action"] for r in results.values()} == {"encrypted"}
+      assert all(r["status"] == 0 for r in results.values())
+      self.check_mirror()
+      assert sorted(load_manifest(self.key, os.path.join(self.mirror, MANIFEST_NAME))["files"]) == sorted(self.files)
+
+   def test_02_unchanged_tree_reads_nothing(self, monkeypatch):
+      for relative in self.files: self.age(relative)
+      self.sync()  # Records the settled mtimes
+      def fail(*args): raise AssertionError("hashed an unchanged file")
+      monkeypatch.setattr(sync_lib, "hash_file", fail)
+      assert {r["action"] for r in self.sync().values()} == {"unchanged"}
+
+   def test_03_touched_file_is_hashed_not_encrypted(self):
+      self.age("a.txt")
+      os.utime(os.path.join(self.tree, "a.txt"), ns=(0, os.stat(os.path.join(self.tree, "a.txt")).st_mtime_ns - 10**9))
+      results = self.sync()
+      assert results["a.txt"]["action"] == "unchanged"
+
+   def test_04_modify_add_delete(self):
+      self.files["a.txt"] = b"alpha, changed"
+      self.files["d.txt"] = b"delta"
+      del self.files["c.txt"]
+      for relative in ("a.txt", "d.txt"):
+         with open(os.path.join(self.tree, relative), 'wb') as f: f.write(self.files[relative])
+      os.remove(os.path.join(self.tree, "c.txt"))
+      results = self.sync(jobs=2)
+      assert results["a.txt"]["action"] == "encrypted"
+      assert results["d.txt"]["action"] == "encrypted"
+      assert results["c.txt"]["action"] == "removed"
+      assert not os.path.exists(os.path.join(self.mirror, "c.txt.enc"))
+      self.check_mirror()
+
+   def test_05_only_changed_chunks_are_encrypted(self):
+      results = self.sync(stream=True, chunk_size=1000)  # New settings, everything is encrypted again
+      assert {r["action"] for r in results.values()} == {"encrypted"}
+      output = os.path.join(self.mirror, "sub", "b.bin.enc")
+      before = self.frames(output)
+      data = bytearray(self.files[os.path.join("sub", "b.bin")])
+      data[4500] ^= 0xFF
+      self.files[os.path.join("sub", "b.bin")] = bytes(data)
+      with open(os.path.join(self.tree, "sub", "b.bin"), 'wb') as f: f.write(data)
+      results = self.sync(stream=True, chunk_size=1000, reuse_chunks=True)
+      assert results[os.path.join("sub", "b.bin")]["action"] == "updated"
+      after = self.frames(output)
+      assert after[0] == before[0]
+      assert [old == new for old, new in zip(before[1], after[1])] == [True] * 4 + [False] + [True] * 5
+      self.check_mirror()
+      data[4500] ^= 0xFF
+      self.files[os.path.join("sub", "b.bin")] = bytes(data)
+      with open(os.path.join(self.tree, "sub", "b.bin"), 'wb') as f: f.write(data)
+      results = self.sync(stream=True, chunk_size=1000)  # No reuse by default
+      assert results[os.path.join("sub", "b.bin")]["action"] == "encrypted"
+      assert self.frames(output)[0] != after[0]  # New file id, old frames no longer fit
+      self.check_mirror()
+
+   def test_06_wrong_key(self):
+      with pytest.raises(ValueError, match="manifest"):
+         list(sync_tree(Fernet.generate_key(), self.tree, self.mirror))
+
+
+if __name__ == "__main__":
+   pytest.main(['-vv', '-s', __file__])
@@ -0,0 +1,167 @@
+#
+# Throughput benchmark for the cryptographic utilities.
+#
+# Measures encryption and decryption throughput (MB/s) of the chunked
+# streaming engine in lib/stream_lib.py for a range of worker counts and
+# compares it with the single-shot Fernet path that filecryptor.py uses
+# without --stream, i.e. cryptographic_component.encrypt(clear_text).
+#
+# A second table compares the frame ciphers of lib/cipher_lib.py, Fernet
+# and the AEAD modes AES-256-GCM and ChaCha20-Poly1305, over a spread of
+# file sizes (--sizes), since most files we encrypt are small and per file
+# overhead matters as much as raw throughput there.
+#
+import sys
+import os
+import io
+import time
+from getopt import getopt
+
+ME         = os.path.split(sys.argv[0])[-1]  # Name of this file
+MY_PATH    = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+VERSION    = "1.0.1"
+VERBOSE    = False
+SIZE_MB    = 64
+CHUNK_SIZE = 1024 * 1024
+REPEAT     = 3
+JOBS_LIST  = sorted({1, 2, 4, os.cpu_count() or 1})
+EXECUTOR   = "process"
+SIZES_KB   = [1, 16, 256, 4096, 65536]
+CIPHERS    = ["fernet", "aes-gcm", "chacha20"]
+
+def write_message(message, level="info"):
+   """ Write a message to the console """
+   WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
+   ERROR   = "\033[31mERROR\033[0m"   # /
+   if level   == "info":
+      sys.stdout.write(f"{message}\n")
+      sys.stdout.flush()
+   elif level == "warning":
+      sys.stderr.write(f"{WARNING} -- {message}\n")
+      sys.stderr.flush()
+   elif level == "error":
+      sys.stderr.write(f"{ERROR} -- {message}\n")
+      sys.stderr.flush()
+   else:
+      sys.stdout.write(f"{message}\n")
+      sys.stdout.flush()
+
+def usage():
+   """ Prints a usage message to the console """
+   print(f"\n\n{ME}, Version {VERSION}, Harold's cryptography benchmark.")
+   print(" ")
+   print("SUMMARY:")
+   print("Measures encrypt and decrypt throughput in MB/s of the chunked streaming")
+   print("engine against the number of worker processes, and compares it with the")
+   print("single-shot Fernet encrypt used by filecryptor.py without --stream.")
+   print(" ")
+   print(f"USAGE: {ME} [OPTIONS]")
+   print(" ")
+   print("OPTIONS: ")
+   print("   -h --help            Display this message. ")
+   print("   -v --verbose         Runs the program in verbose mode. ")
+   print(f"   -s --size MB         Size of the test data in MB, default: {SIZE_MB}")
+   print(f"   -c --chunk-size N    Clear text bytes per frame, default: {CHUNK_SIZE}")
+   print(f"   -j --jobs LIST       Comma separated worker counts, default: {','.join(map(str, JOBS_LIST))}")
+   print(f"   -r --repeat N        Best of N runs per measurement, default: {REPEAT}")
+   print("   -t --threads         Use a thread pool instead of processes")
+   print(f"   -z --sizes LIST      Comma separated file sizes in KB for the cipher table, default: {','.join(map(str, SIZES_KB))}")
+   print(" ")
+   print("EXAMPLES: ")
+   print(f"   {ME} --size 256 --jobs 1,2,4,8,16,32")
+   print(f"   {ME} --size 16 --jobs 1 --sizes 4,64,1024")
+   print(" ")
+
+def best_time(function, repeat):
+   """ Runs function repeat times and returns the fastest wall time. """
+   best = None
+   for _ in range(repeat):
+      start = time.perf_counter()
+      function()
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+   return best
+
+def rate(size, seconds):
+   """ Formats a throughput in MB/s """
+   return f"{size / seconds / 1e6:10.1f}"
+
+# Parse and Process the command line options
+try:
+   arguments = getopt(sys.argv[1:], 'hvs:c:j:r:tz:', ['help', 'verbose', 'size=', 'chunk-size=', 'jobs=', 'repeat=', 'threads', 'sizes='])
+   for arg in arguments[0]:
+      if arg[0] == "-h" or arg[0] == "--help":
+         usage()
+         sys.exit(0)
+      elif arg[0] == "-v" or arg[0] == "--verbose":    VERBOSE    = True
+      elif arg[0] == "-s" or arg[0] == "--size":       SIZE_MB    = float(arg[1])
+      elif arg[0] == "-c" or arg[0] == "--chunk-size": CHUNK_SIZE = int(arg[1])
+      elif arg[0] == "-j" or arg[0] == "--jobs":       JOBS_LIST  = [int(j) for j in arg[1].split(',')]
+      elif arg[0] == "-r" or arg[0] == "--repeat":     REPEAT     = int(arg[1])
+      elif arg[0] == "-t" or arg[0] == "--threads":    EXECUTOR   = "thread"
+      elif arg[0] == "-z" or arg[0] == "--sizes":      SIZES_KB   = [float(z) for z in arg[1].split(',')]
+   if SIZE_MB <= 0 or CHUNK_SIZE <= 0 or REPEAT <= 0 or min(JOBS_LIST) <= 0 or min(SIZES_KB) <= 0:
+      raise ValueError("Sizes, counts and jobs must be positive")
+except Exception as e:
+   write_message(f"Bad or missing command line option(s)\n         {str(e)}\n\n", 'error')
+   usage()
+   sys.exit(1)
+
+try:
+   from cryptography.fernet import Fernet
+   sys.path.insert(0, os.path.join(MY_PATH, "..", "lib"))
+   import stream_lib
+except ImportError:
+   write_message("Missing Cryptography Library\nTry: pip install cryptography", "error")
+   sys.exit(3)
+
+key  = Fernet.generate_key()
+size = int(SIZE_MB * 1024 * 1024)
+if VERBOSE: write_message(f"   -- Generating {size} bytes of test data ...")
+clear_text = os.urandom(size)
+
+write_message(f"Data size {size} bytes, chunk size {CHUNK_SIZE}, {os.cpu_count()} cores, {EXECUTOR} pool, best of {REPEAT}")
+write_message(f"{'MODE':<24}{'JOBS':>6}{'ENCRYPT MB/s':>14}{'DECRYPT MB/s':>14}{'SPEEDUP':>10}")
+
+# Baseline: the single-shot path, the whole file in one Fernet token.
+cryptographic_component = Fernet(key)
+token = cryptographic_component.encrypt(clear_text)
+encrypt_seconds  = best_time(lambda: cryptographic_component.encrypt(clear_text), REPEAT)
+decrypt_seconds  = best_time(lambda: cryptographic_component.decrypt(token), REPEAT)
+baseline_seconds = encrypt_seconds
+write_message(f"{'single-shot Fernet':<24}{1:>6}{rate(size, encrypt_seconds):>14}{rate(size, decrypt_seconds):>14}{1.0:>10.2f}")
+del token
+
+# Chunked streaming engine with an increasing number of workers.
+encrypted = io.BytesIO()
+stream_lib.encrypt_stream(key, io.BytesIO(clear_text), encrypted, CHUNK_SIZE)
+encrypted = encrypted.getvalue()
+for jobs in JOBS_LIST:
+   encrypt_seconds = best_time(lambda: stream_lib.encrypt_stream(key, io.BytesIO(clear_text), io.BytesIO(), CHUNK_SIZE, jobs, EXECUTOR), REPEAT)
+   decrypt_seconds = best_time(lambda: stream_lib.decrypt_stream(key, io.BytesIO(encrypted), io.BytesIO(), jobs, EXECUTOR), REPEAT)
+   write_message(f"{'stream_lib ' + EXECUTOR:<24}{jobs:>6}{rate(size, encrypt_seconds):>14}{rate(size, decrypt_seconds):>14}{baseline_seconds / encrypt_seconds:>10.2f}")
+
+# Frame ciphers over the file size distribution, one job, about --size MB
+# of files per measurement.  SPEEDUP is against the single-shot Fernet path.
+write_message("")
+write_message(f"{'CIPHER':<24}{'FILE KB':>10}{'FILES':>7}{'ENCRYPT MB/s':>14}{'DECRYPT MB/s':>14}{'SPEEDUP':>10}")
+for size_kb in SIZES_KB:
+   file_size = max(1, int(size_kb * 1024))
+   files     = max(1, min(10000, size // file_size))
+   clear     = clear_text[:file_size] if file_size <= size else os.urandom(file_size)
+   def encrypt_files(encrypt):
+      for _ in range(files): encrypt()
+   token = cryptographic_component.encrypt(clear)
+   baseline_seconds = best_time(lambda: encrypt_files(lambda: cryptographic_component.encrypt(clear)), REPEAT)
+   decrypt_seconds  = best_time(lambda: encrypt_files(lambda: cryptographic_component.decrypt(token)), REPEAT)
+   total = files * file_size
+   write_message(f"{'single-shot Fernet':<24}{size_kb:>10g}{files:>7}{rate(total, baseline_seconds):>14}{rate(total, decrypt_seconds):>14}{1.0:>10.2f}")
+   for cipher in CIPHERS:
+      encrypted = io.BytesIO()
+      stream_lib.encrypt_stream(key, io.BytesIO(clear), encrypted, CHUNK_SIZE, binary=True, cipher=cipher)
+      encrypted = encrypted.getvalue()
+      encrypt_seconds = best_time(lambda: encrypt_files(lambda: stream_lib.encrypt_stream(key, io.BytesIO(clear), io.BytesIO(), CHUNK_SIZE, binary=True, cipher=cipher)), REPEAT)
+      decrypt_seconds = best_time(lambda: encrypt_files(lambda: stream_lib.decrypt_stream(key, io.BytesIO(encrypted), io.BytesIO())), REPEAT)
+      write_message(f"{'stream_lib ' + cipher:<24}{size_kb:>10g}{files:>7}{rate(total, encrypt_seconds):>14}{rate(total, decrypt_seconds):>14}{baseline_seconds / encrypt_seconds:>10.2f}")
+
+sys.exit(0)
@@ -0,0 +1,328 @@
+#
+# Benchmark suite and regression harness.
+#
+# Times the hot paths of lib/crypto_lib.py (write/read_json_file and
+# write/read_config_file, clear and with a key) over a range of data sizes,
+# and filecryptor.py and keygen.py end to end as a user runs them, i.e.
+# including interpreter start up and imports.  For every case it reports
+# the p50 and p99 latency, the throughput in MB/s at p50 and the peak
+# resident set size (RSS).
+#
+# Library cases run in a forked child process each, and the CLI runs are
+# child processes anyway, so the peak RSS of one case is not hidden behind
+# the high-water mark of an earlier, larger one.
+#
+# Results can be saved as a baseline JSON file (--output) and later runs
+# compared against it (--baseline): a case whose p50 latency or peak RSS
+# grew by more than --tolerance percent is flagged as a regression and the
+# run exits with code 10, so it can gate a CI job.
+#
+import sys
+import os
+import json
+import math
+import time
+import shutil
+import random
+import platform
+import tempfile
+import subprocess
+from getopt import getopt
+
+ME         = os.path.split(sys.argv[0])[-1]  # Name of this file
+MY_PATH    = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+VERSION    = "1.0.1"
+VERBOSE    = False
+SIZES      = ["1K", "64K", "1M", "16M"]
+SUITES     = ["json", "config", "filecryptor", "keygen"]
+REPEAT     = 10
+TOLERANCE  = 10.0
+BASELINE   = None
+OUTPUT     = None
+FILTER     = None
+UNITS      = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def write_message(message, level="info"):
+   """ Write a message to the console """
+   WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
+   ERROR   = "\033[31mERROR\033[0m"   # /
+   if level   == "info":
+      sys.stdout.write(f"{message}\n")
+      sys.stdout.flush()
+   elif level == "warning":
+      sys.stderr.write(f"{WARNING} -- {message}\n")
+      sys.stderr.flush()
+   elif level == "error":
+      sys.stderr.write(f"{ERROR} -- {message}\n")
+      sys.stderr.flush()
+   else:
+      sys.stdout.write(f"{message}\n")
+      sys.stdout.flush()
+
+def usage():
+   """ Prints a usage message to the console """
+   print(f"\n\n{ME}, Version {VERSION}, Harold's cryptography benchmark suite.")
+   print(" ")
+   print("SUMMARY:")
+   print("Measures p50/p99 latency, MB/s and peak RSS of the crypto_lib Json and config")
+   print("readers and writers, with and without a key, and of filecryptor.py and keygen.py")
+   print("end to end.  Results can be saved as a baseline and compared on later runs.")
+   print(" ")
+   print(f"USAGE: {ME} [OPTIONS]")
+   print(" ")
+   print("OPTIONS: ")
+   print("   -h --help            Display this message. ")
+   print("   -v --verbose         Runs the program in verbose mode. ")
+   print(f"   -s --sizes LIST      Comma separated data sizes, K/M/G suffixes, default: {','.join(SIZES)}")
+   print(f"   -k --suites LIST     Comma separated suites, default: {','.join(SUITES)}")
+   print(f"   -r --repeat N        Timed runs per case, default: {REPEAT}")
+   print("   -f --filter TEXT     Only run cases whose name contains TEXT")
+   print("   -o --output FILE     Save the results as JSON, e.g. as a new baseline")
+   print("   -b --baseline FILE   Compare against a saved baseline and flag regressions")
+   print(f"   -t --tolerance PCT   Allowed growth of p50 latency and peak RSS, default: {TOLERANCE}")
+   print(" ")
+   print("EXIT CODES: ")
+   print("    0 - Successful completion of the program. ")
+   print("    1 - Bad or missing command line arguments. ")
+   print("    3 - Missing required 'cryptography' library" )
+   print("    4 - Unable to read the baseline or write the output file")
+   print("    9 - A benchmark case failed")
+   print("   10 - One or more cases regressed against the baseline")
+   print(" ")
+   print("EXAMPLES: ")
+   print(f"   {ME} --sizes 1K,1M,64M --output baseline.json")
+   print(f"   {ME} --sizes 1K,1M,64M --baseline baseline.json --tolerance 15")
+   print(f"   {ME} --suites json --sizes 1G --repeat 3")
+   print(" ")
+
+def parse_size(text):
+   """ Converts '64K', '1M' or '4096' to a number of bytes. """
+   text = text.strip().upper()
+   if text[-1:] in UNITS: return int(float(text[:-1]) * UNITS[text[-1]])
+   return int(text)
+
+def percentile(samples, fraction):
+   """ Nearest rank percentile of a list of samples. """
+   ordered = sorted(samples)
+   return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def rss_kb(max_rss):
+   """ ru_maxrss is KB on Linux but bytes on macOS. """
+   return max_rss // 1024 if sys.platform == "darwin" else max_rss
+
+def run_isolated(function):
+   """ Runs function() in a forked child with its output discarded and
+       returns (its Json result, the child's peak RSS in KB). """
+   if not hasattr(os, "fork") or resource is None:
+      return function(), None
+   read_fd, write_fd = os.pipe()
+   pid = os.fork()
+   if pid == 0:
+      exit_code = 1
+      try:
+         os.close(read_fd)
+         null = os.open(os.devnull, os.O_WRONLY)
+         os.dup2(null, 1)
+         os.dup2(null, 2)
+         result = json.dumps(function()).encode()
+         while result: result = result[os.write(write_fd, result):]
+         exit_code = 0
+      finally:
+         os._exit(exit_code)
+   os.close(write_fd)
+   with os.fdopen(read_fd, 'rb') as pipe: result = pipe.read()
+   _, status, rusage = os.wait4(pid, 0)
+   if status != 0 or not result: raise RuntimeError("benchmark child process failed")
+   return json.loads(result), rss_kb(rusage.ru_maxrss)
+
+def run_command(command):
+   """ Runs a command, returns (wall seconds, peak RSS in KB or None). """
+   start = time.perf_counter()
+   child = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   if hasattr(os, "wait4"):
+      _, status, rusage = os.wait4(child.pid, 0)
+      child.returncode, peak = status, rss_kb(rusage.ru_maxrss)
+   else:
+      child.wait()
+      peak = None
+   elapsed = time.perf_counter() - start
+   if child.returncode != 0: raise RuntimeError(f"{' '.join(command)} failed")
+   return elapsed, peak
+
+def sample_data(size):
+   """ A dictionary whose Json and config renderings are about size bytes. """
+   rng   = random.Random(size)
+   value = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(80))
+   return {f"key_{i:09d}": value for i in range(max(1, size // 100))}
+
+def library_case(kind, operation, keyed, size, directory, key_file):
+   """ Returns a function that times one crypto_lib operation REPEAT
+       times and returns the latencies in seconds. """
+   def case():
+      data      = sample_data(size)
+      file_name = os.path.join(directory, f"{kind}.{'enc' if keyed else 'txt'}")
+      key       = key_file if keyed else None
+      if kind == "json": write, read = crypto_lib.write_json_file, crypto_lib.read_json_file
+      else:              write, read = crypto_lib.write_config_file, crypto_lib.read_config_file
+      if operation == "read" and not write(file_name, data, key): raise RuntimeError("setup write failed")
+      samples = []
+      for _ in range(REPEAT):
+         if operation == "write" and os.path.isfile(file_name): os.remove(file_name)
+         start = time.perf_counter()
+         ok = write(file_name, data, key) if operation == "write" else len(read(file_name, key)) > 0
+         samples.append(time.perf_counter() - start)
+         if not ok: raise RuntimeError(f"{kind} {operation} failed")
+      return samples
+   return case
+
+def build_cases(directory, key_file):
+   """ Returns a list of (name, size, runner) where runner() returns
+       (latency samples, peak RSS in KB). """
+   cases = []
+   for size_text in SIZES:
+      size = parse_size(size_text)
+      for kind in ("json", "config"):
+         if kind not in SUITES: continue
+         for operation in ("write", "read"):
+            for keyed in (False, True):
+               name = f"{kind}.{operation}.{'key' if keyed else 'clear'}.{size_text}"
+               cases.append((name, size, lambda c=library_case(kind, operation, keyed, size, directory, key_file): run_isolated(c)))
+      if "filecryptor" in SUITES:
+         clear_file  = os.path.join(directory, f"clear.{size_text}")
+         filecryptor = [sys.executable, os.path.join(MY_PATH, "filecryptor.py")]
+         for mode, options in (("token", ["-e"]), ("stream", ["-e", "-s"]), ("aes-gcm", ["-e", "--cipher", "aes-gcm"]),
+                               ("zlib", ["-e", "--compress", "zlib"])):  # Random data, measures the skip
+            encrypted = os.path.join(directory, f"{mode}.{size_text}.enc")
+            encrypt   = filecryptor + options + ["-o", encrypted, key_file, clear_file]
+            decrypt   = filecryptor + ["-o", f"{encrypted}.out", key_file, encrypted]
+            prepare   = lambda clear_file=clear_file, size=size: make_file(clear_file, size)
+            cases.append((f"filecryptor.encrypt.{mode}.{size_text}", size, 
+                          lambda c=encrypt, o=encrypted, p=prepare: run_commands(c, o, p)))
+            prepare   = lambda p=prepare, c=encrypt, o=encrypted: p() or os.path.isfile(o) or run_command(c)
+            cases.append((f"filecryptor.decrypt.{mode}.{size_text}", size,
+                          lambda c=decrypt, o=f"{encrypted}.out", p=prepare: run_commands(c, o, p)))
+   if "keygen" in SUITES:
+      keygen = [sys.executable, os.path.join(MY_PATH, "keygen.py"), os.path.join(directory, "bench.key")]
+      cases.append(("keygen", None, lambda: run_commands(keygen)))
+   return cases
+
+def make_file(file_name, size):
+   """ Creates a file of size random bytes unless it already exists. """
+   if os.path.isfile(file_name): return
+   with open(file_name, 'wb') as f:
+      for offset in range(0, size, 1024 * 1024): f.write(os.urandom(min(1024 * 1024, size - offset)))
+
+def run_commands(command, output_file=None, prepare=None):
+   """ Runs command REPEAT times, removing output_file before each run and
+       calling prepare() once first.  Returns (samples, peak RSS in KB). """
+   if prepare: prepare()
+   samples, peak = [], None
+   for _ in range(REPEAT):
+      if output_file and os.path.isfile(output_file): os.remove(output_file)
+      elapsed, rss = run_command(command)
+      samples.append(elapsed)
+      if rss is not None: peak = max(peak or 0, rss)
+   return samples, peak
+
+# Parse and Process the command line options
+try:
+   arguments = getopt(sys.argv[1:], 'hvs:k:r:f:o:b:t:', ['help', 'verbose', 'sizes=', 'suites=', 'repeat=', 'filter=',
+                                                        'output=', 'baseline=', 'tolerance='])
+   for arg in arguments[0]:
+      if arg[0] == "-h" or arg[0] == "--help":
+         usage()
+         sys.exit(0)
+      elif arg[0] == "-v" or arg[0] == "--verbose":   VERBOSE   = True
+      elif arg[0] == "-s" or arg[0] == "--sizes":     SIZES     = [s.strip().upper() for s in arg[1].split(',')]
+      elif arg[0] == "-k" or arg[0] == "--suites":    SUITES    = [s.strip().lower() for s in arg[1].split(',')]
+      elif arg[0] == "-r" or arg[0] == "--repeat":    REPEAT    = int(arg[1])
+      elif arg[0] == "-f" or arg[0] == "--filter":    FILTER    = arg[1]
+      elif arg[0] == "-o" or arg[0] == "--output":    OUTPUT    = arg[1]
+      elif arg[0] == "-b" or arg[0] == "--baseline":  BASELINE  = arg[1]
+      elif arg[0] == "-t" or arg[0] == "--tolerance": TOLERANCE = float(arg[1])
+   if REPEAT <= 0 or TOLERANCE < 0 or min(parse_size(s) for s in SIZES) <= 0:
+      raise ValueError("Sizes and repeat must be positive, tolerance must not be negative")
+   unknown = set(SUITES) - {"json", "config", "filecryptor", "keygen"}
+   if unknown: raise ValueError(f"Unknown suite(s) {', '.join(sorted(unknown))}")
+except Exception as e:
+   write_message(f"Bad or missing command line option(s)\n         {str(e)}\n\n", 'error')
+   usage()
+   sys.exit(1)
+
+try:
+   from cryptography.fernet import Fernet
+   sys.path.insert(0, os.path.join(MY_PATH, "..", "lib"))
+   import crypto_lib
+except ImportError:
+   write_message("Missing Cryptography Library\nTry: pip install cryptography", "error")
+   sys.exit(3)
+
+try:
+   import resource  # Unix only, peak RSS is not reported without it
+except ImportError:
+   resource = None
+
+baseline = {}
+if BASELINE:
+   try:
+      with open(BASELINE, 'r') as baseline_file: baseline = json.load(baseline_file)["results"]
+   except Exception as e:
+      write_message(f"Unable to read baseline {BASELINE}\n         {str(e)}\n\n", 'error')
+      sys.exit(4)
+
+directory = tempfile.mkdtemp(prefix="benchmark_suite_")
+key_file  = os.path.join(directory, "suite.key")
+with open(key_file, 'wb') as filekey: filekey.write(Fernet.generate_key())
+
+results     = {}
+regressions = 0
+failures    = 0
+write_message(f"Python {platform.python_version()}, {platform.system()} {platform.machine()}, {os.cpu_count()} cores, {REPEAT} runs per case")
+write_message(f"{'CASE':<40}{'P50 ms':>11}{'P99 ms':>11}{'MB/s':>10}{'RSS MB':>9}  BASELINE")
+try:
+   for name, size, runner in build_cases(directory, key_file):
+      if FILTER and FILTER not in name: continue
+      try:
+         samples, peak = runner()
+      except Exception as e:
+         write_message(f"{name}: {str(e)}", 'error')
+         failures += 1
+         continue
+      p50, p99 = percentile(samples, 0.50), percentile(samples, 0.99)
+      result = {"size": size, "runs": len(samples), "p50": p50, "p99": p99,
+                "mb_s": size / p50 / 1e6 if size else None, "peak_rss_kb": peak}
+      results[name] = result
+      verdict = "new"
+      if name in baseline:
+         before  = baseline[name]
+         growth  = p50 / before["p50"] - 1
+         verdict = f"{growth:+.0%}"
+         if growth * 100 > TOLERANCE: verdict += " REGRESSION"
+         if peak and before.get("peak_rss_kb") and (peak / before["peak_rss_kb"] - 1) * 100 > TOLERANCE:
+            verdict += f" RSS {peak / before['peak_rss_kb'] - 1:+.0%} REGRESSION"
+         if "REGRESSION" in verdict: regressions += 1
+      elif not BASELINE:
+         verdict = ""
+      rate = f"{result['mb_s']:10.1f}" if size else f"{'-':>10}"
+      rss  = f"{peak / 1024:9.1f}" if peak else f"{'-':>9}"
+      write_message(f"{name:<40}{p50 * 1000:11.2f}{p99 * 1000:11.2f}{rate}{rss}  {verdict}")
+finally:
+   shutil.rmtree(directory, ignore_errors=True)
+
+if OUTPUT:
+   try:
+      meta = {"version": VERSION, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "platform": platform.platform(), "cpu_count": os.cpu_count(), "repeat": REPEAT}
+      with open(OUTPUT, 'w') as output_file: json.dump({"meta": meta, "results": results}, output_file, indent=2)
+      if VERBOSE: write_message(f"   -- Saved results to {OUTPUT}")
+   except Exception as e:
+      write_message(f"Unable to write {OUTPUT}\n         {str(e)}\n\n", 'error')
+      sys.exit(4)
+
+if failures:
+   write_message(f"{failures} case(s) failed", 'error')
+   sys.exit(9)
+if regressions:
+   write_message(f"{regressions} case(s) regressed by more than {TOLERANCE:g}% against {BASELINE}", 'error')
+   sys.exit(10)
+sys.exit(0)
@@ -0,0 +1,185 @@
+#
+# Benchmark of the flat config file codec in lib/crypto_lib.py.
+#
+# Renders and parses a config of --lines key value lines, one million by
+# default, with the serializer and parser write_config_file() and
+# read_config_file() use, and with the implementations they replaced: a
+# serializer that adds the lines up one by one (config_string += ...) and
+# a parser that splits, strips and splits again every line.  The old code
+# is kept below as it was, for the comparison only.
+#
+# Besides the time it reports the peak memory each one allocates: the old
+# parser holds the decoded text and a list of all its lines besides the
+# result, the new one a block of lines at a time.
+#
+# Also times the whole read_config_file() and iter_config_file(), clear
+# text and with a key, so the parse can be seen against read and decrypt.
+#
+import sys
+import os
+import time
+import shutil
+import tracemalloc
+import tempfile
+from getopt import getopt
+
+ME         = os.path.split(sys.argv[0])[-1]  # Name of this file
+MY_PATH    = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+VERSION    = "1.0.1"
+VERBOSE    = False
+LINES      = 1000000
+REPEAT     = 3
+DELIMITER  = ' '
+
+def write_message(message, level="info"):
+   """ Write a message to the console """
+   WARNING = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
+   ERROR   = "\033[31mERROR\033[0m"   # /
+   if level   == "info":
+      sys.stdout.write(f"{message}\n")
+      sys.stdout.flush()
+   elif level == "warning":
+      sys.stderr.write(f"{WARNING} -- {message}\n")
+      sys.stderr.flush()
+   elif level == "error":
+      sys.stderr.write(f"{ERROR} -- {message}\n")
+      sys.stderr.flush()
+   else:
+      sys.stdout.write(f"{message}\n")
+      sys.stdout.flush()
+
+def usage():
+   """ Prints a usage message to the console """
+   print(f"\n\n{ME}, Version {VERSION}, Harold's config codec benchmark.")
+   print(" ")
+   print("SUMMARY:")
+   print("Times rendering and parsing a large flat config file with the crypto_lib")
+   print("codec against the line by line implementation it replaced.")
+   print(" ")
+   print(f"USAGE: {ME} [OPTIONS]")
+   print(" ")
+   print("OPTIONS: ")
+   print("   -h --help            Display this message. ")
+   print("   -v --verbose         Runs the program in verbose mode. ")
+   print(f"   -l --lines N         Lines in the test config, default: {LINES}")
+   print(f"   -r --repeat N        Best of N runs per measurement, default: {REPEAT}")
+   print(" ")
+   print("EXAMPLES: ")
+   print(f"   {ME}")
+   print(f"   {ME} --lines 100000 --repeat 10")
+   print(" ")
+
+def best_time(function, repeat):
+   """ Runs function repeat times and returns the fastest wall time. """
+   best = None
+   for _ in range(repeat):
+      start = time.perf_counter()
+      function()
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+   return best
+
+def peak_memory(function):
+   """ Runs function once and returns the peak of the memory it
+       allocated, in MB, as traced by tracemalloc. """
+   tracemalloc.start()
+   try:
+      function()
+      return tracemalloc.get_traced_memory()[1] / 1e6
+   finally:
+      tracemalloc.stop()
+
+def old_config_string(config_data, delimiter=' '):
+   """ The serializer before the codec, quadratic in the worst case. """
+   config_string = ""
+   for item in config_data:
+      config_string += f"{str(item)}{delimiter}{str(config_data[item])}\n"
+   return config_string
+
+def old_parse_config(config_bytes, delimiter=' '):
+   """ The parser before the codec, less its warnings. """
+   configs = {}
+   config_data = config_bytes.decode()
+   for line in config_data.split('\n'):
+      line = line.strip()
+      if len(line) == 0: pass
+      elif line.startswith('#') : pass
+      elif delimiter not in line: pass
+      else:
+         data_elements = line.split(delimiter, 1)
+         configs[data_elements[0]] = str(data_elements[-1]).strip()
+   return configs
+
+# Parse and Process the command line options
+try:
+   arguments = getopt(sys.argv[1:], 'hvl:r:', ['help', 'verbose', 'lines=', 'repeat='])
+   for arg in arguments[0]:
+      if arg[0] == "-h" or arg[0] == "--help":
+         usage()
+         sys.exit(0)
+      elif arg[0] == "-v" or arg[0] == "--verbose": VERBOSE = True
+      elif arg[0] == "-l" or arg[0] == "--lines":   LINES   = int(arg[1])
+      elif arg[0] == "-r" or arg[0] == "--repeat":  REPEAT  = int(arg[1])
+   if LINES <= 0 or REPEAT <= 0: raise ValueError("Lines and repeat must be positive")
+except Exception as e:
+   write_message(f"Bad or missing command line option(s)\n         {str(e)}\n\n", 'error')
+   usage()
+   sys.exit(1)
+
+try:
+   from cryptography.fernet import Fernet
+   sys.path.insert(0, os.path.join(MY_PATH, "..", "lib"))
+   import crypto_lib
+   from crypto_lib import _config_string, _parse_config_bytes
+except ImportError:
+   write_message("Missing Cryptography Library\nTry: pip install cryptography", "error")
+   sys.exit(3)
+
+if VERBOSE: write_message(f"   -- Generating a config of {LINES} lines ...")
+config_data  = {f"setting.{i:07d}": f"value {i} of the benchmark config" for i in range(LINES)}
+config_bytes = _config_string(config_data, DELIMITER).encode()
+assert old_config_string(config_data, DELIMITER) == _config_string(config_data, DELIMITER)
+assert old_parse_config(config_bytes, DELIMITER) == _parse_config_bytes(config_bytes, DELIMITER, "benchmark")
+
+write_message(f"{LINES} lines, {len(config_bytes)} bytes, best of {REPEAT}")
+write_message(f"{'STEP':<28}{'OLD s':>10}{'NEW s':>10}{'SPEEDUP':>10}{'OLD MB':>10}{'NEW MB':>10}")
+cases = [("serialize",
+          lambda: old_config_string(config_data, DELIMITER),
+          lambda: _config_string(config_data, DELIMITER)),
+         ("decode + parse",
+          lambda: old_parse_config(config_bytes, DELIMITER),
+          lambda: _parse_config_bytes(config_bytes, DELIMITER, "benchmark"))]
+for name, old, new in cases:
+   old_seconds = best_time(old, REPEAT)
+   new_seconds = best_time(new, REPEAT)
+   write_message(f"{name:<28}{old_seconds:>10.3f}{new_seconds:>10.3f}{old_seconds / new_seconds:>10.2f}"
+                 f"{peak_memory(old):>10.1f}{peak_memory(new):>10.1f}")
+
+# End to end, through the files, for the context of the numbers above.
+directory = tempfile.mkdtemp(prefix="config_benchmark_")
+try:
+   key_file = os.path.join(directory, "a.key")
+   with open(key_file, 'wb') as f: f.write(Fernet.generate_key())
+   write_message("")
+   write_message(f"{'FUNCTION':<28}{'CLEAR s':>10}{'KEY s':>10}")
+   clear_file = os.path.join(directory, "config.txt")
+   enc_file   = os.path.join(directory, "config.txt.enc")
+   rows = [("write_config_file", lambda: crypto_lib.write_config_file(clear_file, config_data, durability="none"),
+                                 lambda: crypto_lib.write_config_file(enc_file, config_data, key_file, binary=True, durability="none")),
+           ("read_config_file",  lambda: crypto_lib.read_config_file(clear_file),
+                                 lambda: crypto_lib.read_config_file(enc_file, key_file)),
+           ("iter_config_file",  lambda: sum(1 for _ in crypto_lib.iter_config_file(clear_file)),
+                                 lambda: sum(1 for _ in crypto_lib.iter_config_file(enc_file, key_file)))]
+   stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')  # The overwrite warnings
+   try:
+      for name, clear, encrypted in rows:
+         clear_seconds     = best_time(clear, REPEAT)
+         encrypted_seconds = best_time(encrypted, REPEAT)
+         write_message(f"{name:<28}{clear_seconds:>10.3f}{encrypted_seconds:>10.3f}")
+   finally:
+      sys.stderr.close()
+      sys.stderr = stderr
+finally:
+   shutil.rmtree(directory, ignore_errors=True)
+
+sys.exit(0)
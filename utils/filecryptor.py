@@ -10,11 +10,66 @@
 #  AES in CBC mode with a 128-bit key for encryption; using PKCS7 padding.
 #  HMAC using SHA256 for authentication.
 #  Initialization vectors are generated using os.urandom().
-# 
-# TODO: Futuire version -- implement MultiFernet([key1, key2]) option 
+#
+# With --cipher aes-gcm or --cipher chacha20 files are instead encrypted
+# with AES-256-GCM or ChaCha20-Poly1305 (see lib/cipher_lib.py), single
+# pass authenticated ciphers keyed from the same key file through HKDF.
+# The cipher is recorded in the file header, decryption picks it up.
+#
+# Large files can be encrypted with --stream.  The file is then split into
+# fixed-size frames that are each encrypted and authenticated on their own
+# (see lib/stream_lib.py), so neither encrypting nor decrypting ever holds
+# more than a couple of frames in memory.  Decryption detects the format
+# automatically, so older single token files still decrypt as before.
+# Frames are independent, so --jobs N spreads them over N worker processes.
+#
+# Many files can be handled in one run: pass several sources, directories,
+# glob patterns or --files-from a list.  The key is then loaded once and
+# the files are processed on --jobs workers (see lib/batch_lib.py), with
+# one status line per file instead of a single exit code.
+#
+# Decryption memory maps the source and decrypts into reused buffers (see
+# stream_lib.mmap_decrypt_file), writing raw bytes straight to the output
+# file descriptor, so binary files decrypt byte for byte.
+#
+# --binary writes a compact binary container: the same frames, but with raw
+# tokens instead of base64 text, about 25% smaller and decrypted without
+# decoding.  --convert rewrites existing encrypted files to that container
+# in place, without ever writing the clear text to disk.
+#
+# Key rotation: old keys passed with -k are still accepted for decryption
+# (a MultiFernet style key ring with KEY_FILE as the primary key).  With
+# --rotate every encrypted SOURCE_FILE is re-encrypted in place under
+# KEY_FILE on --jobs workers (see lib/rotate_lib.py), files already under
+# KEY_FILE are skipped, and --journal records progress so an interrupted
+# rotation picks up where it stopped when run again.
+#
+# --stats reports where the time went: calls, time and bytes of every
+# phase (key load, read, decrypt, encrypt, write, ...) are collected
+# through lib/metrics_lib.py and written to standard error on exit, as a
+# table, Json or Prometheus text (--stats-format).
+#
+# --daemon runs filecryptor as a long lived encryption daemon (see
+# lib/daemon_lib.py): it loads the keys once and keeps warm worker
+# processes listening on a local Unix socket.  While it runs, single file
+# encrypt and decrypt runs hand their open files to it and never import
+# the cryptography library or load a key themselves; without a daemon, or
+# one that does not hold the key, they do the work in process as before.
+#
+# --keystore STORE takes the keys from a key store made by keygen.py
+# --count or --names (see lib/keystore_lib.py): KEY_FILE and -k then name
+# keys in STORE, each found with a single index lookup.  --master-key
+# gives the key an encrypted store is locked with.
+#
+# --archive FILE packs the sources into one encrypted archive instead of
+# one encrypted file per source (see lib/archive_lib.py), or adds them to
+# an existing one.  Every member is encrypted on its own and an encrypted
+# index locates them, so --list and extracting a single member never read
+# the rest of the archive.  Packing and extracting run on --jobs workers.
 
 import sys
 import os
+import atexit
 from getopt import getopt
 
 ME          = os.path.split(sys.argv[0])[-1]  # Name of this file
@@ -26,7 +81,33 @@ KEY_FILE    = "a.key"
 EXTENSION   = "enc"
 ENCRYPT     = False
 SOURCE_FILE = None
+OUTPUT_FILE = None
+SOURCES     = []
+FILES_FROM  = None
+BATCH       = False
 KEY_FILE    = None
+STREAM      = False
+CHUNK_SIZE  = 1024 * 1024
+JOBS        = 1
+BINARY      = False
+CONVERT     = False
+CIPHER      = "fernet"
+COMPRESS    = None
+DURABILITY  = "dir"
+KEYSTORE    = None
+MASTER_KEY  = None
+ARCHIVE     = None
+LIST        = False
+OLD_KEYS    = []
+ROTATE      = False
+SYNC        = False
+REUSE_CHUNKS = False
+JOURNAL     = None
+STATS       = False
+STATS_FORMAT = "text"
+DAEMON      = False
+USE_DAEMON  = True
+SOCKET      = None
 
 def write_message(message, level="info"):
    """ Write a message to the console """
@@ -55,18 +136,66 @@ def usage():
    print("Decrypted reuslts are sent to Standard Out that you may redirect to a file.")
    print(f"Encrypted results are saved directly to a file with the extension .{EXTENSION}")
    print(" ")
-   print(f"USAGE: {ME}  [OPTIONS]  KEY_FILE  SOURCE_FILE")
+   print(f"USAGE: {ME}  [OPTIONS]  KEY_FILE  SOURCE_FILE [SOURCE_FILE ...]")
    print(" ")
    print("OPTIONS: ")
    print("   -h --help      Display this message. ")
    print("   -v --verbose   Runs the program in verbose mode, default: {VERBOSE}. ")
    print("   -d --debug     Runs the program in debug mode (implies verbose). ")
    print("   -e --encrypt   Used to encrypt a file, default operation is to decrypt")
+   print("   -s --stream    Encrypt in chunked streaming format, for large files.")
+   print(f"   -c --chunk-size BYTES  Clear text bytes per frame with --stream, default: {CHUNK_SIZE}")
+   print(f"   -j --jobs N    Encrypt or decrypt frames on N processes (implies --stream), default: {JOBS}")
+   print("                  In batch mode, process N files at a time instead.")
+   print("   -b --binary    Encrypt to the compact binary container (implies --stream).")
+   print("      --convert   Convert encrypted SOURCE_FILEs in place to the binary container.")
+   print(f"      --cipher NAME  Encrypt with fernet, aes-gcm or chacha20 (not fernet implies --binary), default: {CIPHER}")
+   print("      --compress ALGORITHM[:LEVEL]  Compress with zlib (level 1-9) or lzma (0-9) before encrypting")
+   print("                  (implies --stream).  Parts that do not shrink are stored as they are.")
+   print("   -k --key FILE  Old key file, still accepted for decryption, may be given many times.")
+   print("      --rotate    Re-encrypt the SOURCE_FILEs in place under KEY_FILE, see -k.")
+   print("      --journal FILE  With --rotate, record progress in FILE and skip files it lists as done.")
+   print("      --sync      Keep an encrypted mirror of one SOURCE_FILE directory in --output DIR up to date,")
+   print("                  encrypting only new and changed files and removing deleted ones.")
+   print("      --reuse-chunks  With --sync --stream, encrypt only the changed chunks of a changed file.")
+   print("                  Faster, but the frames of an older version of the file stay valid in the new")
+   print("                  one, so whoever holds both can swap old chunks back in undetected.")
+   print("      --stats     Write per phase timings and byte counts to standard error on exit.")
+   print(f"      --stats-format FORMAT  text, json or prometheus (implies --stats), default: {STATS_FORMAT}")
+   print("                  Batch work done on --jobs worker processes is not included.")
+   print("      --daemon    Run as encryption daemon for KEY_FILE (and -k keys) until stopped, no SOURCE_FILE.")
+   print("                  With --jobs N the daemon runs N worker processes, default one per CPU.")
+   print("      --no-daemon Do the work in this process even if a daemon is running.")
+   print("      --socket PATH  Daemon socket, default $FILECRYPTOR_SOCKET or filecryptor-UID.sock in")
+   print("                  $XDG_RUNTIME_DIR or /tmp.")
+   print(f"      --durability LEVEL  How far output files are fsync'd: none, file or dir, default: {DURABILITY}")
+   print("                  Output always replaces the target atomically, never a partial file.  Batch")
+   print("                  runs fsync each output directory once, at the end (with dir).")
+   print("      --keystore STORE  KEY_FILE and -k are key names in the key STORE made by keygen.py.")
+   print("      --master-key FILE  With --keystore, the key file the STORE is encrypted with.")
+   print("      --archive FILE  With --encrypt, pack the SOURCE_FILEs into the encrypted archive FILE, or add")
+   print("                  them to it.  Otherwise extract the members named by SOURCE_FILE, default all,")
+   print("                  below --output DIR, default the current directory.")
+   print("      --list      With --archive, list the size and name of every member.")
+   print("   -f --files-from FILE   Read source file names from FILE, one per line, '-' for stdin")
+   print(f"   -o --output FILE       Write the result to FILE instead of standard out or SOURCE_FILE.{EXTENSION}")
    print(" ")
    print("REQUIRED ARGUMENTS: ")
-   print("   KEY_FILE      The file that holds the cytptographic key")
+   print("   KEY_FILE      The file that holds the cytptographic key, the primary key with -k,")
+   print("                 or the name of the key with --keystore")
    print("   SOURCE_FILE   The source file to be eitehr encrypted or decrypted with the key")
    print(" ")
+   print("BATCH MODE: ")
+   print("   Given more than one SOURCE_FILE, a directory, a glob pattern or --files-from,")
+   print("   every file is processed with the same key in one run.  Directories are walked")
+   print(f"   recursively: clear files are encrypted, .{EXTENSION} files are decrypted.  Decrypted")
+   print(f"   files are written next to the source without the .{EXTENSION} extension, existing")
+   print("   files are never overwritten.  One line per file is written to standard out:")
+   print("   STATUS<tab>SOURCE_FILE<tab>MESSAGE, where STATUS uses exit codes 0 and 6 - 9.")
+   print("   With --sync the MESSAGE of a file done is encrypted, updated, unchanged or removed.")
+   print("   With --archive the SOURCE_FILE of an extracted file is its member name, and the")
+   print("   MESSAGE of a packed file is added or replaced.")
+   print(" ")
    print("EXIT CODES: ")
    print("    0 - Successful completion of the program. ")
    print("    1 - Bad or missing command line arguments. ")
@@ -78,6 +207,7 @@ def usage():
    print("    7 - Unable to read source file")   
    print("    8 - Unable write encrpyted file") 
    print("    9 - Unable decrypt encrpyted file with the key provided") 
+   print("   10 - Batch mode, one or more files failed, see the per-file status lines") 
    print(" ")
    print("EXAMPLES: ")
    print("   1.) Decrypt a file with a key and save the results to secrets.txt")
@@ -86,13 +216,62 @@ def usage():
    print(f"   2.) Encrypt a text file using a key and save to encrypted file secrets.txt.{EXTENSION}")
    print(f"   {ME} --encrypt key_file.dat secrets.txt")
    print(f"   {ME} -e key_file.dat secrets.txt")
-   print(" ") 
+   print(" ")
+   print("   3.) Encrypt a large file in chunked streaming format")
+   print(f"   {ME} --encrypt --stream key_file.dat backup.tar")
+   print(" ")
+   print("   4.) Encrypt a large file using 8 cores")
+   print(f"   {ME} --encrypt --jobs 8 key_file.dat backup.tar")
+   print(" ")
+   print("   5.) Encrypt every file below a directory, 16 files at a time")
+   print(f"   {ME} --encrypt --jobs 16 key_file.dat /data/reports")
+   print(" ")
+   print("   6.) Decrypt a list of files read from standard in")
+   print(f"   find /data -name '*.{EXTENSION}' | {ME} --files-from - key_file.dat")
+   print(" ")
+   print(f"   7.) Convert every .{EXTENSION} file below a directory to the binary container")
+   print(f"   {ME} --convert --jobs 4 key_file.dat /data/reports")
+   print(" ")
+   print("   8.) Encrypt a large file with AES-256-GCM")
+   print(f"   {ME} --encrypt --cipher aes-gcm key_file.dat backup.tar")
+   print(" ")
+   print("   9.) Rotate every encrypted file below a directory from old.key to new.key, resumable")
+   print(f"   {ME} --rotate -k old.key --journal rotate.log --jobs 8 new.key /data/reports")
+   print(" ")
+   print("   10.) Show where the time of a decrypt goes, in Prometheus text format")
+   print(f"   {ME} --stats-format prometheus key_file.dat backup.tar.{EXTENSION} > backup.tar")
+   print(" ")
+   print("   11.) Start a daemon with 4 workers, later runs with the same key use it")
+   print(f"   {ME} --daemon --jobs 4 key_file.dat &")
+   print(f"   {ME} key_file.dat secrets.dat > secrets.txt")
+   print(" ")
+   print("   12.) Mirror a directory encrypted to a backup disk, nightly runs only redo what changed")
+   print(f"   {ME} --sync --stream --reuse-chunks --jobs 4 --output /backup/reports key_file.dat /data/reports")
+   print(" ")
+   print("   13.) Encrypt a database export, compressed with lzma first")
+   print(f"   {ME} --encrypt --compress lzma:9 key_file.dat export.json")
+   print(" ")
+   print("   14.) Encrypt a tenant's report with its key from the tenants' key store")
+   print(f"   {ME} --encrypt --keystore tenants.store --master-key master.key tenant-42 report.csv")
+   print(" ")
+   print("   15.) Pack a directory of small files into one archive on 8 cores, then get one file back")
+   print(f"   {ME} --archive reports.har --encrypt --jobs 8 key_file.dat /data/reports")
+   print(f"   {ME} --archive reports.har --output /tmp key_file.dat data/reports/2024/q3.csv")
+   print(" ")
+
+def is_pattern(source):
+   """ True if source is not a file but a glob pattern """
+   import glob  # Seldom needed, keep it off the startup path
+   return not os.path.exists(source) and glob.has_magic(source)
 
 # Parse and process the command line options and arguments.
 # I know the kids today are using argparse, but I like having 
 # the help message readable in the source code. --HMW 
 try:
-   arguments = getopt(sys.argv[1:],'hvde',['help','verbose','debug', 'encrypt'])
+   arguments = getopt(sys.argv[1:],'hvdesbc:j:f:o:k:',['help','verbose','debug', 'encrypt', 'stream', 'binary', 'convert', 'cipher=', 'compress=', 'chunk-size=', 'jobs=', 
+                                                     'files-from=', 'output=', 'key=', 'rotate', 'journal=', 'sync', 'reuse-chunks', 'stats', 'stats-format=',
+                                                     'daemon', 'no-daemon', 'socket=', 'durability=', 'keystore=', 'master-key=',
+                                                     'archive=', 'list'])
    # --- Check for a help option
    for arg in arguments[0]:
       if arg[0]== "-h" or arg[0] == "--help":
@@ -111,20 +290,116 @@ try:
    for arg in arguments[0]:
       if arg[0]== "-e" or arg[0] == "--encrypt":
          ENCRYPT = True
+   # --- Check for streaming options
+   for arg in arguments[0]:
+      if arg[0]== "-s" or arg[0] == "--stream":
+         STREAM = True
+      if arg[0]== "-b" or arg[0] == "--binary":
+         BINARY = True
+         STREAM = True
+      if arg[0] == "--convert":
+         CONVERT = True
+      if arg[0] == "--cipher":
+         if arg[1].lower() not in ("fernet", "aes-gcm", "chacha20"): raise ValueError(f"Unknown cipher {arg[1]}")
+         CIPHER = arg[1].lower()
+         if CIPHER != "fernet":
+            BINARY = True
+            STREAM = True
+      if arg[0] == "--compress":
+         if arg[1].lower().partition(":")[0] not in ("zlib", "lzma"): raise ValueError(f"Unknown compression {arg[1]}")
+         COMPRESS = arg[1].lower()
+         STREAM = True
+      if arg[0]== "-c" or arg[0] == "--chunk-size":
+         CHUNK_SIZE = int(arg[1])
+         if CHUNK_SIZE <= 0: raise ValueError(f"Invalid chunk size {arg[1]}")
+      if arg[0]== "-j" or arg[0] == "--jobs":
+         JOBS = int(arg[1])
+         if JOBS <= 0: raise ValueError(f"Invalid number of jobs {arg[1]}")
+      if arg[0]== "-f" or arg[0] == "--files-from":
+         FILES_FROM = arg[1]
+      if arg[0]== "-o" or arg[0] == "--output":
+         OUTPUT_FILE = arg[1]
+      if arg[0]== "-k" or arg[0] == "--key":
+         OLD_KEYS.append(arg[1])
+      if arg[0] == "--rotate":
+         ROTATE = True
+      if arg[0] == "--journal":
+         JOURNAL = arg[1]
+      if arg[0] == "--sync":
+         SYNC = True
+      if arg[0] == "--reuse-chunks":
+         REUSE_CHUNKS = True
+      if arg[0] == "--stats":
+         STATS = True
+      if arg[0] == "--stats-format":
+         if arg[1].lower() not in ("text", "json", "prometheus"): raise ValueError(f"Unknown stats format {arg[1]}")
+         STATS_FORMAT = arg[1].lower()
+         STATS = True
+      if arg[0] == "--daemon":
+         DAEMON = True
+      if arg[0] == "--no-daemon":
+         USE_DAEMON = False
+      if arg[0] == "--socket":
+         SOCKET = arg[1]
+      if arg[0] == "--durability":
+         if arg[1].lower() not in ("none", "file", "dir"): raise ValueError(f"Unknown durability {arg[1]}")
+         DURABILITY = arg[1].lower()
+      if arg[0] == "--keystore":
+         KEYSTORE = arg[1]
+      if arg[0] == "--master-key":
+         MASTER_KEY = arg[1]
+      if arg[0] == "--archive":
+         ARCHIVE = arg[1]
+      if arg[0] == "--list":
+         LIST = True
    # -- Check for the key file and source file arguments
-   if len(sys.argv) < 3: 
+   if DAEMON and (len(arguments[1]) != 1 or FILES_FROM or ENCRYPT or OUTPUT_FILE or CONVERT or ROTATE or SYNC or STATS or ARCHIVE):
+      raise ValueError("--daemon takes only the key file(s), no sources or other operation")
+   if len(arguments[1]) < 2 and not ((FILES_FROM or (ARCHIVE and not ENCRYPT)) and len(arguments[1]) == 1) and not DAEMON: 
       raise ValueError("Missing required arguments: key file and/or source file")
    else:
-      SOURCE_FILE = sys.argv[-1]
-      KEY_FILE = sys.argv[-2]   
+      KEY_FILE = arguments[1][0]
+      SOURCES  = arguments[1][1:]
+   # -- More than one source, a directory or a pattern selects batch mode
+   BATCH = FILES_FROM is not None or len(SOURCES) > 1 or \
+           any(os.path.isdir(s) or is_pattern(s) for s in SOURCES)
+   if SYNC and (len(SOURCES) != 1 or not os.path.isdir(SOURCES[0]) or not OUTPUT_FILE or FILES_FROM or CONVERT or ROTATE):
+      raise ValueError("--sync takes one source directory and --output DIR, no other operation")
+   if ARCHIVE and (CONVERT or ROTATE or SYNC or (ENCRYPT and (OUTPUT_FILE or LIST))):
+      raise ValueError("--archive packs with --encrypt or extracts to --output DIR, no other operation")
+   if LIST and not ARCHIVE:
+      raise ValueError("--list is only used with --archive")
+   if BATCH and OUTPUT_FILE and not (SYNC or ARCHIVE):
+      raise ValueError("--output can not be used with more than one source file")
+   if CONVERT and (OUTPUT_FILE or ENCRYPT):
+      raise ValueError("--convert works in place, it can not be used with --output or --encrypt")
+   if ROTATE and (OUTPUT_FILE or ENCRYPT or CONVERT):
+      raise ValueError("--rotate works in place, it can not be used with --output, --encrypt or --convert")
+   if JOURNAL and not ROTATE:
+      raise ValueError("--journal is only used with --rotate")
+   if REUSE_CHUNKS and not SYNC:
+      raise ValueError("--reuse-chunks is only used with --sync")
+   if MASTER_KEY and not KEYSTORE:
+      raise ValueError("--master-key is only used with --keystore")
+   BATCH = BATCH or CONVERT or ROTATE or SYNC or ARCHIVE is not None
+   if not (BATCH or DAEMON):
+      SOURCE_FILE = SOURCES[0]
+      if JOBS > 1: STREAM = True
 except Exception as e:
     write_message(f"Bad or missing command line option(s) and/or argument(s)\n         {str(e)}\n\n", 'error')
     usage()
     sys.exit(1)
 
-# Check the source file exists
+# Check the source file exists, batch mode reports missing files per file
 # Доверяй, но проверяй
-if os.path.isfile(SOURCE_FILE):
+if BATCH:
+   if VERBOSE: write_message(f"   -- Batch mode, {JOBS} job(s)")
+   if ARCHIVE and not ENCRYPT and not os.path.isfile(ARCHIVE):
+      write_message(f"Unable to locate archive {ARCHIVE}", 'error')
+      sys.exit(6)
+elif DAEMON:
+   pass
+elif os.path.isfile(SOURCE_FILE):
    if VERBOSE: 
       m = f"   -- Found source file {SOURCE_FILE}" 
       write_message(m)
@@ -133,16 +408,68 @@ else:
    write_message(m, 'error')
    sys.exit(6)
 
-# Check the key file exists
+def read_key(key_file):
+   """ Returns the key bytes of a key file, or of the key so named in the
+       --keystore, found with one index lookup. """
+   if KEYSTORE is None:
+      with open(key_file, 'rb') as filekey: return filekey.read()
+   import keystore_lib
+   master_key = None
+   if MASTER_KEY:
+      with open(MASTER_KEY, 'rb') as filekey: master_key = filekey.read()
+   return keystore_lib.load_keystore_key(KEYSTORE, key_file, master_key)
+
+# Check the key files exist, with --keystore the store and master key do
 # Доверяй, но проверяй
-if os.path.isfile(KEY_FILE):
-   if VERBOSE: 
-      m = f"   -- Found cryptographic key file {KEY_FILE}" 
-      write_message(m)
-else:
-   m = f"Unable to locate supplied key file {KEY_FILE}"  
-   write_message(m, 'error')
-   sys.exit(4)
+for key_file in ([KEYSTORE] + ([MASTER_KEY] if MASTER_KEY else []) if KEYSTORE else [KEY_FILE] + OLD_KEYS):
+   if os.path.isfile(key_file):
+      if VERBOSE: 
+         m = f"   -- Found cryptographic key file {key_file}" 
+         write_message(m)
+   else:
+      m = f"Unable to locate supplied key file {key_file}"  
+      write_message(m, 'error')
+      sys.exit(4)
+
+# Hand a single file to the encryption daemon when one is running.  It has
+# the cryptography library imported and the keys loaded already, so this
+# run never has to.  A daemon that does not hold the keys leaves the work
+# to this process, as does a missing daemon or an unreadable file here.
+sys.path.insert(0, os.path.join(MY_PATH, "..", "lib"))
+if USE_DAEMON and not (BATCH or DAEMON or STATS or COMPRESS) and JOBS == 1:
+   import daemon_lib
+   SOCKET = SOCKET or daemon_lib.default_socket_path()
+   if os.path.exists(SOCKET):
+      if ENCRYPT and OUTPUT_FILE is None: OUTPUT_FILE = f"{SOURCE_FILE}.{EXTENSION}"
+      try:
+         ring = []
+         for key_file in [KEY_FILE] + OLD_KEYS: ring.append(read_key(key_file))
+         sys.stdout.flush()
+         operation = "encrypt" if ENCRYPT else "decrypt"
+         with open(SOURCE_FILE, 'rb') as in_file:
+            if OUTPUT_FILE is None:
+               result = daemon_lib.submit(operation, ring, in_file.fileno(), sys.stdout.fileno(),
+                                          STREAM, CHUNK_SIZE, BINARY, CIPHER, SOCKET)
+            else:
+               import atomic_lib
+               try:
+                  with atomic_lib.atomic_write(OUTPUT_FILE, durability=DURABILITY) as out_file:
+                     result = daemon_lib.submit(operation, ring, in_file.fileno(), out_file.fileno(),
+                                                STREAM, CHUNK_SIZE, BINARY, CIPHER, SOCKET)
+                     if result is None or result[0] != 0: raise ValueError("Not done by the daemon")
+               except ValueError:
+                  pass  # No partial output is left, the target is as it was
+      except (OSError, ValueError):
+         result = None  # A key missing from the store is reported below
+      if result is not None:
+         status, size, error = result
+         if status == 0:
+            if VERBOSE: write_message(f"   -- Daemon on {SOCKET} {'encrypted' if ENCRYPT else 'decrypted'} {size} byte(s)")
+            sys.exit(0)
+         if ENCRYPT: m = f"Unable to create encrypted file.\n         {error}\n\n"
+         else:       m = f"Unable to create decrypted {SOURCE_FILE} with {KEY_FILE}.\n         {error}\n\n"
+         write_message(m, 'error')
+         sys.exit(status)
 
 # Try to import the Cryptographic library
 #    This import is here in the middle of the code so that 
@@ -151,6 +478,12 @@ else:
 try:
    import cryptography 
    from cryptography.fernet import Fernet
+   import stream_lib
+   import metrics_lib
+   if BATCH:  import batch_lib   # \
+   if ROTATE: import rotate_lib  #  >-- Only what this run needs, startup
+   if SYNC:   import sync_lib    # /    time dominates for small files
+   if ARCHIVE: import archive_lib
    m = f"   -- Successfully imported the cryptography library version {cryptography.__version__}"
    if DEBUG: write_message(m)
 except ImportError:
@@ -158,28 +491,104 @@ except ImportError:
    write_message(m, "error")
    sys.exit(3)
 
+# Collect per phase metrics and report them however the program exits
+if STATS:
+   collector = metrics_lib.MetricsCollector()
+   metrics_lib.add_hook(collector)
+   render = {"text": collector.to_text, "json": collector.to_json, "prometheus": collector.to_prometheus}[STATS_FORMAT]
+   atexit.register(lambda: sys.stderr.write(render()))
+
 # Verify key file and initialize the cryptographic component
 # Доверяй, но проверяй
-try: 
-   with open(KEY_FILE, 'rb') as filekey: crypto_key = filekey.read()
-   cryptographic_component = Fernet(crypto_key)
-   if VERBOSE: write_message(f"   -- Valid key file '{KEY_FILE}'")
-except Exception as e:
-   m = f"Invalid cryptographic key file {KEY_FILE}\n         {str(e)}\n\n" 
-   write_message(m , 'error') 
-   sys.exit(5)
+# The key ring holds the primary key first, then the old keys
+KEYS = []
+for key_file in [KEY_FILE] + OLD_KEYS:
+   try: 
+      with metrics_lib.phase("key_load") as timer: 
+         KEYS.append(read_key(key_file))
+         timer.add(len(KEYS[-1]))
+      Fernet(KEYS[-1])
+      if VERBOSE: write_message(f"   -- Valid key file '{key_file}'")
+   except Exception as e:
+      m = f"Invalid cryptographic key file {key_file}\n         {str(e)}\n\n" 
+      write_message(m , 'error') 
+      sys.exit(5)
+crypto_key = KEYS[0]
+cryptographic_component = Fernet(crypto_key)
+KEYS = tuple(KEYS)
+
+# Daemon mode: serve the key ring on the socket until stopped
+if DAEMON:
+   import daemon_lib
+   SOCKET = SOCKET or daemon_lib.default_socket_path()
+   if VERBOSE: write_message(f"   -- Serving {len(KEYS)} key(s) on {SOCKET}")
+   try:
+      daemon_lib.serve(KEYS, SOCKET, JOBS if JOBS > 1 else None)
+   except (ValueError, OSError) as e:
+      write_message(f"Unable to start the daemon\n         {str(e)}\n\n", 'error')
+      sys.exit(1)
+   sys.exit(0)
+
+# Batch mode: process every source with the one key, report each file
+if BATCH:
+   try:
+      if FILES_FROM == "-": SOURCES += list(batch_lib.read_file_list(sys.stdin))
+      elif FILES_FROM:
+         with open(FILES_FROM, 'r') as file_list: SOURCES += list(batch_lib.read_file_list(file_list))
+   except Exception as e:
+      write_message(f"Unable to read file list {FILES_FROM}\n         {str(e)}\n\n", 'error')
+      sys.exit(1)
+   processed = 0
+   failed    = 0
+   try:
+      if ROTATE:    results = rotate_lib.rotate_files(KEYS, SOURCES, JOURNAL, EXTENSION, JOBS, durability=DURABILITY)
+      elif CONVERT: results = batch_lib.convert_files(KEYS, SOURCES, True, EXTENSION, JOBS, durability=DURABILITY)
+      elif LIST:
+         with archive_lib.Archive(ARCHIVE, KEYS) as archive:
+            for member in archive.members(): sys.stdout.write(f"{member['size']}\t{member['name']}\n")
+         sys.exit(0)
+      elif ARCHIVE and ENCRYPT:
+         results = archive_lib.pack_files(KEYS, ARCHIVE, SOURCES, CHUNK_SIZE, CIPHER, COMPRESS, JOBS, durability=DURABILITY)
+      elif ARCHIVE: results = archive_lib.unpack_files(KEYS, ARCHIVE, OUTPUT_FILE or ".", SOURCES or None, JOBS,
+                                                       durability=DURABILITY)
+      elif SYNC:    results = sync_lib.sync_tree(KEYS, SOURCES[0], OUTPUT_FILE, STREAM, CHUNK_SIZE, BINARY, CIPHER, EXTENSION, JOBS,
+                                                   reuse_chunks=REUSE_CHUNKS, compression=COMPRESS, durability=DURABILITY)
+      else:         results = batch_lib.process_files(KEYS, SOURCES, ENCRYPT, STREAM, CHUNK_SIZE, EXTENSION, JOBS, binary=BINARY, cipher=CIPHER,
+                                                        compression=COMPRESS, durability=DURABILITY)
+      for result in results:
+         processed += 1
+         if result["status"] != batch_lib.STATUS_OK: failed += 1
+         sys.stdout.write(f"{result['status']}\t{result['source']}\t{result['error'] or result.get('action', '')}\n")
+   except (OSError, ValueError) as e:
+      write_message(f"Unable to continue\n         {str(e)}\n\n", 'error')
+      sys.exit(1)
+   sys.stdout.flush()
+   if VERBOSE: write_message(f"   -- Processed {processed} file(s), {failed} failed")
+   if failed: write_message(f"{failed} of {processed} file(s) failed", 'error')
+   sys.exit(10 if failed else 0)
 
 # Either encrypt or decrypt the source file using the cryptographic component 
 if ENCRYPT:
-    OUTPUT_FILE = f"{SOURCE_FILE}.{EXTENSION}"
+    if OUTPUT_FILE is None: OUTPUT_FILE = f"{SOURCE_FILE}.{EXTENSION}"
     if VERBOSE: 
        m = f"   -- Encrypting {SOURCE_FILE} with {KEY_FILE}, saving outout to {OUTPUT_FILE}"
        write_message(m)
     try:
-       with open(SOURCE_FILE, 'rb') as file: clear_text = file.read()     
-       encrypted = cryptographic_component.encrypt(clear_text)
-       with open(OUTPUT_FILE, 'wb') as encrypted_file: encrypted_file.write(encrypted)
-       if not os.path.isfile(OUTPUT_FILE): raise ValueError(f"Output file {OUTPUT_FILE} not created") 
+       # The output replaces OUTPUT_FILE only once complete, a crash part
+       # way never leaves a truncated file that then fails to decrypt.
+       import atomic_lib
+       with open(SOURCE_FILE, 'rb') as file, atomic_lib.atomic_write(OUTPUT_FILE, durability=DURABILITY) as encrypted_file:
+          if STREAM:
+             stream_lib.encrypt_stream(crypto_key, file, encrypted_file, CHUNK_SIZE, JOBS, binary=BINARY, cipher=CIPHER,
+                                       compression=COMPRESS)
+          else:
+             with metrics_lib.phase("read") as timer: 
+                clear_text = file.read()     
+                timer.add(len(clear_text))
+             with metrics_lib.phase("encrypt", len(clear_text)):
+                encrypted = cryptographic_component.encrypt(clear_text)
+             with metrics_lib.phase("write", len(encrypted)):
+                encrypted_file.write(encrypted)
        if VERBOSE: 
           m = f"   -- Successfully generated encrypted file {OUTPUT_FILE}"
           write_message(m)
@@ -189,12 +598,25 @@ if ENCRYPT:
        sys.exit(8)
 else: # Decrypt
     if VERBOSE:
-       m = f"   -- Decrypting {SOURCE_FILE} with {KEY_FILE}, writing results to standard out"
+       m = f"   -- Decrypting {SOURCE_FILE} with {KEY_FILE}, writing results to {OUTPUT_FILE or 'standard out'}"
        write_message(m)
     try:
-       with open(SOURCE_FILE, 'rb') as enc_file: encrypted = enc_file.read()
-       clear_text = cryptographic_component.decrypt(encrypted).decode()
-       print(clear_text)
+       # Raw bytes go straight to the output file descriptor, the clear 
+       # text may be binary and is never decoded.
+       # An OUTPUT_FILE is replaced atomically, as when encrypting.
+       sys.stdout.flush()
+       if OUTPUT_FILE:
+          import atomic_lib
+          output = atomic_lib.atomic_write(OUTPUT_FILE, durability=DURABILITY)
+       else:
+          from contextlib import nullcontext
+          output = nullcontext(sys.stdout.buffer)
+       with output as out_file:
+          out_file.flush()
+          if JOBS > 1:
+             stream_lib.decrypt_file(KEYS, SOURCE_FILE, out_file, JOBS)
+          else:
+             stream_lib.mmap_decrypt_file(KEYS, SOURCE_FILE, out_file.fileno())
     except Exception as e:
        m = f"Unable to create decrypted {SOURCE_FILE} with {KEY_FILE}.\n         {str(e)}\n\n" 
        write_message(m , 'error') 
@@ -1,8 +1,10 @@
 #
 # Generate a Python Cryptograpic Key File
 #
-#
-#
+# Bulk mode: --count N or --names FILE generates many keys in one run, on
+# --jobs worker processes, verifies every one and writes them all to one
+# key store file (see lib/keystore_lib.py), optionally encrypted under a
+# --master-key.  filecryptor.py --keystore then loads a key by name.
 #
 import sys
 import os
@@ -14,6 +16,13 @@ VERSION  = "1.0.1"
 VERBOSE  = False
 DEBUG    = False
 KEY_FILE = "a.key"
+STORE    = "keys.store"
+COUNT    = None
+NAMES    = None
+PREFIX   = "key-"
+MASTER   = None
+JOBS     = 1
+BATCH    = 1000  # Keys generated per worker task
 
 def write_message(message, level="info"):
    """ Write a message to the console """
@@ -41,11 +50,18 @@ def usage():
    print("encrypt and decrypt a string or even an entire file.")
    print(" ")
    print(f"USAGE: {ME} [OPTIONS] [KEY_FILENAME]")
+   print(f"       {ME} [OPTIONS] --count N | --names FILE [KEY_STORE]")
    print(" ")
    print("OPTIONS: ")
    print("   -h --help      Display this message. ")
    print("   -v --verbose   Runs the program in verbose mode, default: {VERBOSE}. ")
    print("   -d --debug     Runs the program in debug mode (implies verbose). ")
+   print("   -n --count N   Generate N keys named PREFIX1 ... PREFIXN into a key store.")
+   print("                  Numbering continues after the highest PREFIXn the store holds already.")
+   print(f"   -p --prefix PREFIX  Name prefix with --count, default: {PREFIX}")
+   print("   -f --names FILE  Generate one key for each name in FILE, one per line, '-' for stdin.")
+   print("   -m --master-key FILE  Encrypt the key store under the key in FILE.")
+   print(f"   -j --jobs N    Generate and verify keys on N processes, default: {JOBS}")
    print(" ")
    print("EXIT CODES: ")
    print("    0 - Successful completion of the program, all tests passed. ")
@@ -54,15 +70,18 @@ def usage():
    print("    3 - Missing required 'cryptography' library" )
    print("    4 - Unable to write key to file")
    print(" ")
-   print(f"NOTE: Default KEY_FILENAME is '{KEY_FILE}'")
+   print(f"NOTE: Default KEY_FILENAME is '{KEY_FILE}', default KEY_STORE is '{STORE}'.  Keys are")
+   print("      added to an existing KEY_STORE, names it holds already are refused.")
    print(" ")
    print("EXAMPLES: ")
-   print("    TODO - I'll make some examples up later. ")
+   print(f"    {ME} tenant.key")
+   print(f"    {ME} --count 50000 --jobs 8 --master-key master.key tenants.store")
+   print(f"    {ME} --names new_tenants.txt --master-key master.key tenants.store")
    print(" ")
 
 # Parse and Process the command line options
 try:
-   arguments = getopt(sys.argv[1:],'hvd',['help','verbose','debug'])
+   arguments = getopt(sys.argv[1:],'hvdn:p:f:m:j:',['help','verbose','debug','count=','prefix=','names=','master-key=','jobs='])
    # --- Check for a help option
    for arg in arguments[0]:
       if arg[0]== "-h" or arg[0] == "--help":
@@ -77,15 +96,31 @@ try:
       if arg[0]== "-d" or arg[0] == "--debug":
          DEBUG   = True
          VERBOSE = True
+   # --- Check for the bulk mode options
+   for arg in arguments[0]:
+      if arg[0]== "-n" or arg[0] == "--count":
+         COUNT = int(arg[1])
+         if COUNT <= 0: raise ValueError(f"Invalid number of keys {arg[1]}")
+      if arg[0]== "-p" or arg[0] == "--prefix":
+         PREFIX = arg[1]
+      if arg[0]== "-f" or arg[0] == "--names":
+         NAMES = arg[1]
+      if arg[0]== "-m" or arg[0] == "--master-key":
+         MASTER = arg[1]
+      if arg[0]== "-j" or arg[0] == "--jobs":
+         JOBS = int(arg[1])
+         if JOBS <= 0: raise ValueError(f"Invalid number of jobs {arg[1]}")
+   if COUNT and NAMES: raise ValueError("Use --count or --names, not both")
+   if MASTER and not (COUNT or NAMES): raise ValueError("--master-key is only used with --count or --names")
+   if len(arguments[1]) > 1: raise ValueError("At most one key file or key store name")
+   if arguments[1]: 
+      KEY_FILE = arguments[1][0]
+      STORE    = arguments[1][0]
 except Exception as e:
     write_message(f"Bad or missing command line option(s)\n         {str(e)}\n\n", 'error')
     usage()
     sys.exit(1)
 
-# Check for an optional key file name
-if not sys.argv[-1].startswith('-') and len(sys.argv) > 1:
-   KEY_FILE = sys.argv[-1]
-
 try:
    from cryptography.fernet import Fernet
 except ImportError:
@@ -94,24 +129,7 @@ except ImportError:
    sys.exit(3)
 
 
-# Generate a random key
-if VERBOSE: write_message("   -- Generating key ...")
-# this just calls: base64.urlsafe_b64encode(os.urandom(32))
-key = Fernet.generate_key()
-
-# Try to write key to file
-try:
-   if VERBOSE: write_message(f"   -- Writing key file {KEY_FILE}  ...")
-   with open(KEY_FILE, 'wb') as filekey: filekey.write(key)
-except Exception as e:
-   m = f"Unable to write key to file: {KEY_FILE}"
-   write_message(m, "error")
-   sys.exit(4)
-
-# Verify key file
-if VERBOSE: write_message(f"   -- Verifying key file '{KEY_FILE}'")
-with open(KEY_FILE, 'rb') as filekey: test_key = filekey.read()
-fernet = Fernet(test_key)
+# The known text every key is verified with
 test_string = """
 So, so you think you can tell
 Heaven from Hell,
@@ -140,6 +158,70 @@ The same old fears.
 Wish you were here.
 """
 
+# Bulk mode: generate and verify the keys on JOBS processes, BATCH keys a
+# task, and write them all to the key store at once
+if COUNT or NAMES:
+   sys.path.insert(0, os.path.join(MY_PATH, "..", "lib"))
+   import stream_lib
+   import keystore_lib
+   try:
+      master_key = None
+      if MASTER:
+         with open(MASTER, 'rb') as filekey: master_key = filekey.read()
+      if NAMES:
+         names_file = sys.stdin if NAMES == "-" else open(NAMES)
+         with names_file: names = [line.strip() for line in names_file if line.strip()]
+      else:
+         first = 1  # After the highest PREFIXn in the store, so names neither collide nor fill gaps
+         if os.path.isfile(STORE):
+            with keystore_lib.KeyStore(STORE, master_key) as store:
+               numbers = [name[len(PREFIX):] for name in store.names() if name.startswith(PREFIX)]
+               first += max((int(n) for n in numbers if n.isdigit()), default=0)
+         names = [f"{PREFIX}{i}" for i in range(first, first + COUNT)]
+   except Exception as e:
+      write_message(f"Unable to read the key names or master key\n         {str(e)}", "error")
+      sys.exit(1)
+   if VERBOSE: write_message(f"   -- Generating {len(names)} keys on {JOBS} job(s) ...")
+   try:
+      tasks = [(min(BATCH, len(names) - i), test_string.encode()) for i in range(0, len(names), BATCH)]
+      keys  = [key for batch in stream_lib.ordered_map(keystore_lib.generate_keys, tasks, JOBS) for key in batch]
+   except ValueError as e:
+      write_message(f"Generated keys FAILED validation\n         {str(e)}", "error")
+      sys.exit(2)
+   try:
+      if VERBOSE: write_message(f"   -- Writing key store {STORE} ...")
+      added = keystore_lib.write_keystore(STORE, zip(names, keys), master_key)
+   except Exception as e:
+      write_message(f"Unable to write keys to key store: {STORE}\n         {str(e)}", "error")
+      sys.exit(4)
+   # Read every key back through the index, as filecryptor.py will
+   if VERBOSE: write_message(f"   -- Verifying key store '{STORE}'")
+   with keystore_lib.KeyStore(STORE, master_key) as store:
+      if any(store.get(name) != key for name, key in zip(names, keys)):
+         write_message(f"Key store '{STORE}' FAILED validation", "error")
+         sys.exit(2)
+   if VERBOSE: write_message(f"   -- Added {added} keys to '{STORE}', {len(store)} in all")
+   if VERBOSE: write_message("Task Complete.")
+   sys.exit(0)
+
+# Generate a random key
+if VERBOSE: write_message("   -- Generating key ...")
+# this just calls: base64.urlsafe_b64encode(os.urandom(32))
+key = Fernet.generate_key()
+
+# Try to write key to file
+try:
+   if VERBOSE: write_message(f"   -- Writing key file {KEY_FILE}  ...")
+   with open(KEY_FILE, 'wb') as filekey: filekey.write(key)
+except Exception:
+   m = f"Unable to write key to file: {KEY_FILE}"
+   write_message(m, "error")
+   sys.exit(4)
+
+# Verify key file
+if VERBOSE: write_message(f"   -- Verifying key file '{KEY_FILE}'")
+with open(KEY_FILE, 'rb') as filekey: test_key = filekey.read()
+fernet = Fernet(test_key)
 if DEBUG: print(test_string)
 encrypted_string = fernet.encrypt(test_string.encode())
 if DEBUG: print(encrypted_string)